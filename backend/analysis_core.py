@@ -0,0 +1,173 @@
+"""
+Shared analysis core for every Python service.
+
+The constitution tables are built once at import time as frozen, slotted
+dataclasses. Request handlers only allocate the small output dict they
+return, and no request can modify the shared tables.
+"""
+
+import random
+import time
+from dataclasses import dataclass
+
+FEATURE_NAMES = ("teeth_marks", "pale_white", "red", "cracked", "peeling")
+
+# (symptom, low, high) bounds for mock probabilities
+SYMPTOM_RANGES = (
+    ("obesity", 0.1, 0.9),
+    ("high_sugar", 0.1, 0.7),
+    ("indigestion", 0.2, 0.8),
+    ("fatigue", 0.2, 0.9),
+    ("insomnia", 0.1, 0.8),
+    ("acid_reflux", 0.1, 0.6),
+    ("dry_mouth", 0.2, 0.8),
+    ("constipation", 0.1, 0.7),
+    ("irritability", 0.2, 0.9),
+)
+SYMPTOM_NAMES = tuple(name for name, _, _ in SYMPTOM_RANGES)
+
+
+@dataclass(frozen=True, slots=True)
+class Recommendation:
+    product_id: str
+    name: str
+    desc: str
+
+    def as_dict(self) -> dict:
+        return {"productId": self.product_id, "name": self.name, "desc": self.desc}
+
+
+@dataclass(frozen=True, slots=True)
+class ConstitutionProfile:
+    name: str
+    score: int
+    issues: tuple[str, ...]
+    recommendation: Recommendation
+    # Mock-mode adjustments so random results still look like this constitution
+    feature_overrides: tuple[tuple[str, bool], ...] = ()
+    symptom_overrides: tuple[tuple[str, float], ...] = ()
+
+
+PROFILES: dict[str, ConstitutionProfile] = {
+    profile.name: profile
+    for profile in (
+        ConstitutionProfile(
+            name="Qi Deficiency",
+            score=62,
+            issues=("Pale tongue", "Tooth marks", "Swollen body"),
+            recommendation=Recommendation("vitality-spark", "Vitality Spark", "Specially formulated to boost Qi and restore energy"),
+            feature_overrides=(("teeth_marks", True),),
+            symptom_overrides=(("fatigue", 0.85),),
+        ),
+        ConstitutionProfile(
+            name="Yang Deficiency",
+            score=55,
+            issues=("Pale tongue", "Tooth marks", "White coating"),
+            recommendation=Recommendation("vitality-spark", "Vitality Spark", "Warming herbs to strengthen Yang energy"),
+            feature_overrides=(("pale_white", True), ("teeth_marks", True)),
+            symptom_overrides=(("fatigue", 0.9), ("obesity", 0.75)),
+        ),
+        ConstitutionProfile(
+            name="Yin Deficiency",
+            score=60,
+            issues=("Red tongue", "No coating", "Cracks"),
+            recommendation=Recommendation("dream-weave", "Dream Weave Elixir", "Nourishing blend to restore Yin balance"),
+            feature_overrides=(("red", True), ("cracked", True)),
+            symptom_overrides=(("dry_mouth", 0.8),),
+        ),
+        ConstitutionProfile(
+            name="Damp Heat",
+            score=65,
+            issues=("Thick yellow coating", "Red body", "Sticky sensation"),
+            recommendation=Recommendation("bamboo-detox", "Bamboo Detox Pad", "Clears heat and resolves dampness"),
+            feature_overrides=(("red", True), ("peeling", True)),
+            symptom_overrides=(("irritability", 0.85),),
+        ),
+        ConstitutionProfile(
+            name="Qi Stagnation",
+            score=70,
+            issues=("Purple spots", "Tense tongue body"),
+            recommendation=Recommendation("calm-flow", "Calm Flow Tonic", "Promotes smooth Qi flow and emotional balance"),
+            symptom_overrides=(("irritability", 0.8),),
+        ),
+        ConstitutionProfile(
+            name="Blood Stasis",
+            score=58,
+            issues=("Purple body", "Dark spots", "Distended veins underneath"),
+            recommendation=Recommendation("acupressure-relief", "Acupressure Relief", "Invigorates blood circulation"),
+        ),
+        ConstitutionProfile(
+            name="Phlegm Dampness",
+            score=60,
+            issues=("Thick greasy coating", "Swollen body", "Tooth marks"),
+            recommendation=Recommendation("bamboo-detox", "Bamboo Detox Pad", "Resolves phlegm and eliminates dampness"),
+            feature_overrides=(("teeth_marks", True),),
+            symptom_overrides=(("obesity", 0.8), ("indigestion", 0.75)),
+        ),
+        ConstitutionProfile(
+            name="Balanced",
+            score=92,
+            issues=("Light red body", "Thin white coating"),
+            recommendation=Recommendation("dream-weave", "Dream Weave Elixir", "Maintains overall harmony and wellness"),
+        ),
+    )
+}
+
+CONSTITUTIONS = tuple(PROFILES)
+DEFAULT_CONSTITUTION = "Balanced"
+
+
+def get_profile(constitution: str) -> ConstitutionProfile:
+    """Look up a constitution, falling back to Balanced for unknown names."""
+    return PROFILES.get(constitution) or PROFILES[DEFAULT_CONSTITUTION]
+
+
+def recommendation_for(constitution: str) -> dict:
+    return get_profile(constitution).recommendation.as_dict()
+
+
+def build_result(
+    constitution: str,
+    tongue_features: dict,
+    symptoms: dict,
+    score: int | None = None,
+    issues: list[str] | None = None,
+) -> dict:
+    """
+    Assemble a result dict in the shape every endpoint returns.
+
+    `score` and `issues` default to the constitution's table values, which is
+    what the mock paths use; model output passes its own.
+    """
+    profile = get_profile(constitution)
+    return {
+        "score": profile.score if score is None else score,
+        "constitution": constitution,
+        "issues": list(profile.issues) if issues is None else issues,
+        "recommendation": profile.recommendation.as_dict(),
+        "tongue_features": tongue_features,
+        "symptoms": symptoms,
+    }
+
+
+def mock_analysis(rng: random.Random = random) -> dict:
+    """Random but constitution-consistent result for development and fallback."""
+    profile = PROFILES[rng.choice(CONSTITUTIONS)]
+
+    features = {name: rng.choice((True, False)) for name in FEATURE_NAMES}
+    features.update(profile.feature_overrides)
+
+    symptoms = {name: round(rng.uniform(low, high), 2) for name, low, high in SYMPTOM_RANGES}
+    symptoms.update(profile.symptom_overrides)
+
+    return build_result(profile.name, features, symptoms)
+
+
+# ---------------------------------------------------------
+# [USER ACTION REQUIRED LATER]
+# Replace this function with your actual Model Inference code
+# ---------------------------------------------------------
+def run_ai_model(image_url: str, delay: float = 1.5) -> dict:
+    # Simulate processing time
+    time.sleep(delay)
+    return mock_analysis()
@@ -0,0 +1,406 @@
+"""
+Background writer that persists analyses to the analysis_logs table.
+
+Request handlers call `AnalysisLogWriter.record()`, which only appends to an
+in-memory queue and never waits on the database. A background task drains
+the queue and bulk-inserts rows in batches through a pooled connection.
+When the queue is full, new rows are dropped and counted instead of slowing
+down requests. A batch rejected because of one bad row (e.g. a user_id
+that is not in auth.users) is retried row by row, so only that row is lost.
+
+Each batch also updates the per-user trend aggregates in the same
+transaction, and the sinks serve the history pages read back from those
+tables (see history.py).
+
+Every row gets a random id when it is created. Responses return it as
+`result_id`, and `AnalysisLogWriter.result()` reads the stored result back
+by it from any process, once the row's batch has been written.
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+
+from backend.history import UserStats, decode_cursor, encode_cursor, fold, symptom_dict, symptom_vector
+
+
+def valid_user_id(value: str | None) -> str | None:
+    """Canonical form of a client-supplied user id, or None if it is not a UUID."""
+    if not value:
+        return None
+    try:
+        return str(uuid.UUID(str(value)))
+    except ValueError:
+        return None
+
+
+@dataclass(slots=True)
+class AnalysisLogRow:
+    user_id: str | None
+    image_url: str | None
+    result: dict
+    latency_ms: float
+    model_version: str
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+    # Random, so result ids can't be derived from the image (unlike cache keys)
+    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+
+    def __post_init__(self):
+        # user_id comes from the client; analysis_logs.user_id is a uuid referencing
+        # auth.users, so anything else is stored as an anonymous analysis
+        self.user_id = valid_user_id(self.user_id)
+
+    @property
+    def summary(self) -> str:
+        """Short human-readable text kept in the legacy result_summary column."""
+        return f"{self.result.get('constitution', 'Unknown')} (score: {self.result.get('score', '-')})"
+
+    @property
+    def constitution(self) -> str | None:
+        return self.result.get("constitution")
+
+    @property
+    def score(self) -> int | None:
+        return self.result.get("score")
+
+    @property
+    def symptoms(self) -> list[float] | None:
+        return symptom_vector(self.result.get("symptoms"))
+
+
+def _history_item(row_id, created_at, constitution, score, symptoms, image_url, model_version) -> dict:
+    return {
+        "id": str(row_id),
+        "created_at": created_at.isoformat() if isinstance(created_at, datetime) else created_at,
+        "constitution": constitution,
+        "score": score,
+        "symptoms": symptom_dict(symptoms),
+        "image_url": image_url,
+        "model_version": model_version,
+    }
+
+
+class PostgresSink:
+    """Bulk inserts into Postgres through a small asyncpg connection pool."""
+
+    INSERT = (
+        "insert into public.analysis_logs "
+        "(user_id, image_url, result_summary, result, latency_ms, model_version, created_at, constitution, score, symptoms, id) "
+        "values ($1, $2, $3, $4::jsonb, $5, $6, $7, $8, $9, $10, $11::uuid)"
+    )
+    HISTORY = (
+        "select id, created_at, constitution, score, symptoms, image_url, model_version "
+        "from public.analysis_logs where user_id = $1::uuid {after}"
+        "order by created_at desc, id desc limit $2"
+    )
+
+    def __init__(self, dsn: str, max_connections: int = 2):
+        self.dsn = dsn
+        self.max_connections = max_connections
+        self._pool = None
+
+    async def open(self) -> None:
+        import asyncpg
+
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.max_connections)
+
+    async def write(self, rows: list[AnalysisLogRow]) -> None:
+        async with self._pool.acquire() as conn, conn.transaction():
+            await conn.executemany(
+                self.INSERT,
+                [
+                    (r.user_id, r.image_url, r.summary, json.dumps(r.result), round(r.latency_ms), r.model_version,
+                     r.created_at, r.constitution, r.score, r.symptoms, r.id)
+                    for r in rows
+                ],
+            )
+            users = sorted({r.user_id for r in rows if r.user_id is not None})
+            if not users:
+                return
+            # Create missing rows first so `for update` locks every user in the batch,
+            # always in user_id order, so concurrent writers neither lose updates nor deadlock
+            await conn.execute(
+                "insert into public.analysis_user_stats (user_id) select unnest($1::uuid[]) on conflict do nothing", users
+            )
+            existing = {
+                user_id: UserStats.from_dict(json.loads(stats))
+                for user_id, stats in await conn.fetch(
+                    "select user_id::text, stats from public.analysis_user_stats "
+                    "where user_id = any($1::uuid[]) order by user_id for update",
+                    users,
+                )
+                if stats is not None
+            }
+            changed = fold(existing, sorted(rows, key=lambda r: r.created_at))
+            await conn.executemany(
+                "update public.analysis_user_stats set stats = $2::jsonb, updated_at = now() where user_id = $1::uuid",
+                [(user_id, json.dumps(stats.to_dict())) for user_id, stats in changed.items()],
+            )
+
+    @staticmethod
+    def rejects(error: Exception) -> bool:
+        """Whether the rows themselves caused `error` (constraint or data errors)."""
+        import asyncpg
+
+        return isinstance(error, (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError))
+
+    async def history(self, user_id: str, limit: int, cursor: str | None = None) -> tuple[list[dict], str | None]:
+        """One page, newest first, plus the cursor for the next page (None on the last)."""
+        if cursor is None:
+            rows = await self._pool.fetch(self.HISTORY.format(after=""), user_id, limit + 1)
+        else:
+            created_at, row_id = decode_cursor(cursor)
+            rows = await self._pool.fetch(
+                self.HISTORY.format(after="and (created_at, id) < ($3, $4::uuid) "), user_id, limit + 1, created_at, row_id
+            )
+        items = [_history_item(*row) for row in rows[:limit]]
+        next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+        return items, next_cursor
+
+    async def stats(self, user_id: str) -> UserStats | None:
+        data = await self._pool.fetchval(
+            "select stats from public.analysis_user_stats where user_id = $1::uuid", user_id
+        )
+        return UserStats.from_dict(json.loads(data)) if data else None
+
+    async def result(self, result_id: str) -> dict | None:
+        data = await self._pool.fetchval("select result from public.analysis_logs where id = $1::uuid", result_id)
+        return json.loads(data) if data else None
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+class SQLiteSink:
+    """Local stand-in for development and tests; same columns as Postgres."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+        # Writes and history reads run on different threads over one connection
+        self._lock = threading.Lock()
+
+    async def open(self) -> None:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            """
+            create table if not exists analysis_logs (
+                id integer primary key autoincrement,
+                user_id text,
+                image_url text,
+                result_summary text,
+                result text,
+                latency_ms integer,
+                model_version text,
+                created_at text not null
+            )
+            """
+        )
+        columns = {row[1] for row in self._conn.execute("pragma table_info(analysis_logs)")}
+        # Files created before the history columns existed
+        for column, kind in (("constitution", "text"), ("score", "integer"), ("symptoms", "text"), ("result_id", "text")):
+            if column not in columns:
+                self._conn.execute(f"alter table analysis_logs add column {column} {kind}")
+        self._conn.execute(
+            "create index if not exists analysis_logs_user_page on analysis_logs (user_id, created_at desc, id desc)"
+        )
+        self._conn.execute(
+            "create unique index if not exists analysis_logs_result_id on analysis_logs (result_id)"
+        )
+        self._conn.execute(
+            "create table if not exists analysis_user_stats (user_id text primary key, stats text not null)"
+        )
+
+    def _write(self, rows: list[AnalysisLogRow]) -> None:
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "insert into analysis_logs "
+                "(user_id, image_url, result_summary, result, latency_ms, model_version, created_at, constitution, score, symptoms, "
+                "result_id) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (r.user_id, r.image_url, r.summary, json.dumps(r.result), round(r.latency_ms), r.model_version,
+                     r.created_at.isoformat(), r.constitution, r.score, json.dumps(r.symptoms) if r.symptoms else None,
+                     r.id)
+                    for r in rows
+                ],
+            )
+            users = sorted({r.user_id for r in rows if r.user_id is not None})
+            marks = ",".join("?" * len(users))
+            existing = {
+                user_id: UserStats.from_dict(json.loads(stats))
+                for user_id, stats in self._conn.execute(
+                    f"select user_id, stats from analysis_user_stats where user_id in ({marks})", users
+                )
+            }
+            changed = fold(existing, sorted(rows, key=lambda r: r.created_at))
+            self._conn.executemany(
+                "insert or replace into analysis_user_stats (user_id, stats) values (?, ?)",
+                [(user_id, json.dumps(stats.to_dict())) for user_id, stats in changed.items()],
+            )
+
+    async def write(self, rows: list[AnalysisLogRow]) -> None:
+        await asyncio.to_thread(self._write, rows)
+
+    @staticmethod
+    def rejects(error: Exception) -> bool:
+        return isinstance(error, (sqlite3.IntegrityError, sqlite3.DataError))
+
+    def _history(self, user_id: str, limit: int, cursor: str | None) -> tuple[list[dict], str | None]:
+        query = (
+            "select id, created_at, constitution, score, symptoms, image_url, model_version "
+            "from analysis_logs where user_id = ? {after}order by created_at desc, id desc limit ?"
+        )
+        if cursor is None:
+            params = (user_id, limit + 1)
+            query = query.format(after="")
+        else:
+            created_at, row_id = decode_cursor(cursor)
+            params = (user_id, created_at.isoformat(), int(row_id), limit + 1)
+            query = query.format(after="and (created_at, id) < (?, ?) ")
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        items = [
+            _history_item(*row[:4], json.loads(row[4]) if row[4] else None, *row[5:])
+            for row in rows[:limit]
+        ]
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = encode_cursor(datetime.fromisoformat(last[1]), last[0])
+        return items, next_cursor
+
+    async def history(self, user_id: str, limit: int, cursor: str | None = None) -> tuple[list[dict], str | None]:
+        return await asyncio.to_thread(self._history, user_id, limit, cursor)
+
+    def _fetchone(self, query: str, params: tuple):
+        with self._lock:
+            return self._conn.execute(query, params).fetchone()
+
+    # Reads wait on the lock while a batch is being written; keep that off the event loop
+    async def stats(self, user_id: str) -> UserStats | None:
+        row = await asyncio.to_thread(self._fetchone, "select stats from analysis_user_stats where user_id = ?", (user_id,))
+        return UserStats.from_dict(json.loads(row[0])) if row else None
+
+    async def result(self, result_id: str) -> dict | None:
+        row = await asyncio.to_thread(self._fetchone, "select result from analysis_logs where result_id = ?", (result_id,))
+        return json.loads(row[0]) if row and row[0] else None
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class AnalysisLogWriter:
+    """
+    Buffers analysis rows and writes them in batches from a background task.
+
+    A batch is written once `batch_size` rows are waiting or `flush_interval`
+    seconds have passed. `stop()` drains everything still queued before
+    closing the sink.
+    """
+
+    def __init__(self, sink, batch_size: int = 100, flush_interval: float = 1.0, max_queue: int = 10_000):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue[AnalysisLogRow] = asyncio.Queue(maxsize=max_queue)
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        self.dropped = 0
+        self.written = 0
+
+    async def start(self) -> None:
+        if self._task is None:
+            await self.sink.open()
+            self._task = asyncio.create_task(self._run())
+
+    def record(self, row: AnalysisLogRow) -> bool:
+        """Queue a row without blocking; returns False if it had to be dropped."""
+        try:
+            self._queue.put_nowait(row)
+            return True
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+
+    async def result(self, result_id: str) -> dict | None:
+        """The stored result for a row id handed out as result_id, or None if unknown."""
+        try:
+            result_id = str(uuid.UUID(result_id))
+        except ValueError:
+            return None
+        return await self.sink.result(result_id)
+
+    async def _next_batch(self) -> list[AnalysisLogRow]:
+        """Collect up to batch_size rows, waiting at most flush_interval (may return [])."""
+        batch = []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _write(self, batch: list[AnalysisLogRow]) -> None:
+        try:
+            await self.sink.write(batch)
+            self.written += len(batch)
+        except Exception as e:
+            if len(batch) > 1 and self.sink.rejects(e):
+                # One bad row fails the whole transaction; find it instead of dropping the batch
+                for row in batch:
+                    await self._write([row])
+                return
+            self.dropped += len(batch)
+            print(f"Failed to write {len(batch)} analysis log rows: {e}")
+
+    async def _run(self) -> None:
+        while not (self._closing and self._queue.empty()):
+            batch = await self._next_batch()
+            if batch:
+                await self._write(batch)
+
+    async def stop(self) -> None:
+        """Flush everything still queued, then close the sink."""
+        if self._task is None:
+            return
+        self._closing = True
+        await self._task
+        self._task = None
+        await self.sink.close()
+
+
+def log_writer_from_env() -> AnalysisLogWriter | None:
+    """
+    Build the writer from ANALYSIS_LOG_DSN.
+
+    postgres://... or postgresql://... writes to Postgres (e.g. the Supabase
+    connection string); sqlite:///path writes to a local SQLite file; unset
+    disables logging.
+    """
+    dsn = os.environ.get("ANALYSIS_LOG_DSN")
+    if not dsn:
+        return None
+    if dsn.startswith("sqlite:///"):
+        sink = SQLiteSink(dsn[len("sqlite:///"):])
+    else:
+        sink = PostgresSink(dsn)
+    return AnalysisLogWriter(
+        sink,
+        batch_size=int(os.environ.get("ANALYSIS_LOG_BATCH_SIZE", "100")),
+        flush_interval=float(os.environ.get("ANALYSIS_LOG_FLUSH_INTERVAL", "1.0")),
+        max_queue=int(os.environ.get("ANALYSIS_LOG_MAX_QUEUE", "10000")),
+    )
@@ -0,0 +1,96 @@
+"""
+Verify Supabase access tokens for endpoints that return a user's own data.
+
+The frontend sends the session's access token as `Authorization: Bearer
+<jwt>`. Tokens are HS256 JWTs signed with the project's JWT secret
+(SUPABASE_JWT_SECRET, under Settings > API in the dashboard), so they are
+checked locally without a round trip to Supabase. The caller is the
+token's `sub` claim.
+
+Reads of a user's data require a session (`current_user`). Analyses are
+open to anonymous callers (`optional_user`): they are logged under the
+session's user, never under a user id taken from the request body.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+
+from fastapi import Header, HTTPException
+
+JWT_SECRET = os.environ.get("SUPABASE_JWT_SECRET", "")
+# Supabase signs user sessions for this audience
+JWT_AUDIENCE = "authenticated"
+# Clock skew tolerated on exp / nbf, in seconds
+JWT_LEEWAY = 30
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def _b64decode(segment: str) -> bytes:
+    return base64.urlsafe_b64decode(segment + "=" * (-len(segment) % 4))
+
+
+def verify_jwt(token: str, secret: str, audience: str = JWT_AUDIENCE, now: float | None = None) -> dict:
+    """Claims of an HS256 token signed with `secret`; raises InvalidToken otherwise."""
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        header = json.loads(_b64decode(header_b64))
+        claims = json.loads(_b64decode(payload_b64))
+        signature = _b64decode(signature_b64)
+    except ValueError:
+        raise InvalidToken("Malformed token") from None
+    if not isinstance(header, dict) or not isinstance(claims, dict) or header.get("alg") != "HS256":
+        raise InvalidToken("Unsupported token")
+
+    expected = hmac.new(secret.encode(), f"{header_b64}.{payload_b64}".encode(), hashlib.sha256).digest()
+    if not hmac.compare_digest(signature, expected):
+        raise InvalidToken("Bad signature")
+
+    now = time.time() if now is None else now
+    if not isinstance(claims.get("exp"), (int, float)) or claims["exp"] + JWT_LEEWAY < now:
+        raise InvalidToken("Token expired")
+    if isinstance(claims.get("nbf"), (int, float)) and claims["nbf"] - JWT_LEEWAY > now:
+        raise InvalidToken("Token not yet valid")
+    aud = claims.get("aud")
+    if audience not in (aud if isinstance(aud, list) else [aud]):
+        raise InvalidToken("Wrong audience")
+    if not isinstance(claims.get("sub"), str) or not claims["sub"]:
+        raise InvalidToken("Token has no subject")
+    return claims
+
+
+def current_user(authorization: str | None = Header(default=None)) -> str:
+    """FastAPI dependency: the Supabase user id of the caller (401 without a valid token)."""
+    if not JWT_SECRET:
+        raise HTTPException(status_code=503, detail="User authentication is not configured")
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Missing bearer token", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return verify_jwt(token.strip(), JWT_SECRET)["sub"]
+    except InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"}) from None
+
+
+def session_user(token: str | None) -> str | None:
+    """The user id of an optional session token: None without one (or when auth isn't configured)."""
+    if not token or not JWT_SECRET:
+        return None
+    return verify_jwt(token, JWT_SECRET)["sub"]
+
+
+def optional_user(authorization: str | None = Header(default=None)) -> str | None:
+    """FastAPI dependency: the caller's user id, None for anonymous callers (401 for an invalid token)."""
+    scheme, _, token = (authorization or "").partition(" ")
+    if authorization and scheme.lower() != "bearer":
+        raise HTTPException(status_code=401, detail="Expected a bearer token", headers={"WWW-Authenticate": "Bearer"})
+    try:
+        return session_user(token.strip())
+    except InvalidToken as e:
+        raise HTTPException(status_code=401, detail=str(e), headers={"WWW-Authenticate": "Bearer"}) from None
@@ -0,0 +1,132 @@
+"""
+Response encoding for analysis payloads: format negotiation and compression.
+
+Every service answers in JSON by default. A client can ask for a compact
+form through the Accept header:
+
+- application/vnd.nourish.compact+json: the compact form as JSON
+- application/msgpack: the compact form as MessagePack (needs `msgpack`)
+
+The compact form (schema version COMPACT_SCHEMA, in the "v" key) keeps the
+result's keys but drops the repeated names:
+
+- symptoms: list of probabilities in SYMPTOM_NAMES order
+- tongue_features: bitmask, bit i set when FEATURE_NAMES[i] is present
+- recommendations: product ids, resolved through the catalog endpoint
+  (which also carries the per-constitution reason text)
+- recommendation: dropped; it is recommendations[0]
+
+Bodies over COMPRESS_MIN_BYTES are compressed with brotli (when the
+`brotli` package is installed and the client accepts br) or gzip.
+"""
+
+import gzip
+import json
+import os
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response
+
+from backend.analysis_core import FEATURE_NAMES, SYMPTOM_NAMES
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COMPACT_SCHEMA = 1
+
+JSON = "application/json"
+COMPACT_JSON = "application/vnd.nourish.compact+json"
+MSGPACK = "application/msgpack"
+# Accept values that select each format; */* and anything unknown mean JSON
+_FORMATS = {
+    JSON: JSON,
+    "*/*": JSON,
+    COMPACT_JSON: COMPACT_JSON,
+    MSGPACK: MSGPACK,
+    "application/x-msgpack": MSGPACK,
+}
+
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "500"))
+
+
+def _weighted(header: str | None) -> list[tuple[str, float]]:
+    """Header values with their q weights, in header order; q=0 entries are dropped."""
+    values = []
+    for part in (header or "").split(","):
+        value, *params = (item.strip() for item in part.split(";"))
+        q = 1.0
+        for param in params:
+            name, _, weight = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(weight)
+                except ValueError:
+                    q = 0.0
+        if value and q > 0:
+            values.append((value.lower(), q))
+    return values
+
+
+def negotiate(accept: str | None) -> str:
+    """The response media type for an Accept header (highest q wins, earlier on ties)."""
+    best, best_q = JSON, 0.0
+    for value, q in _weighted(accept):
+        media_type = _FORMATS.get(value)
+        if media_type == MSGPACK and msgpack is None:
+            continue
+        if media_type is not None and q > best_q:
+            best, best_q = media_type, q
+    return best
+
+
+def compact(payload: dict) -> dict:
+    """The compact form of an analysis payload; anything that isn't a result passes through."""
+    if isinstance(payload.get("data"), dict):
+        # modal_ai wraps results as {"success": ..., "data": result}
+        return {**payload, "data": compact(payload["data"])}
+    symptoms = payload.get("symptoms")
+    if not isinstance(symptoms, dict):
+        return payload
+    data = {"v": COMPACT_SCHEMA, **payload}
+    data.pop("recommendation", None)
+    data["symptoms"] = [symptoms.get(name, 0.0) for name in SYMPTOM_NAMES]
+    features = payload.get("tongue_features")
+    if isinstance(features, dict):
+        data["tongue_features"] = sum(1 << i for i, name in enumerate(FEATURE_NAMES) if features.get(name))
+    if "recommendations" in payload:
+        data["recommendations"] = [rec["productId"] for rec in payload["recommendations"]]
+    return data
+
+
+def compress(body: bytes, accept_encoding: str | None) -> tuple[bytes, str | None]:
+    """Compress body for the client's Accept-Encoding; returns (body, Content-Encoding or None)."""
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = {value for value, _ in _weighted(accept_encoding)}
+    if brotli is not None and "br" in accepted:
+        return brotli.compress(body, quality=5), "br"
+    if "gzip" in accepted:
+        return gzip.compress(body, compresslevel=6, mtime=0), "gzip"
+    return body, None
+
+
+def encoded_response(payload, accept: str | None, accept_encoding: str | None) -> Response:
+    """Serialize payload in the negotiated format and compress it."""
+    media_type = negotiate(accept)
+    payload = jsonable_encoder(payload)
+    if media_type == MSGPACK:
+        body = msgpack.packb(compact(payload), use_single_float=True)
+    else:
+        body = json.dumps(compact(payload) if media_type == COMPACT_JSON else payload, separators=(",", ":")).encode()
+    body, encoding = compress(body, accept_encoding)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, headers=headers, media_type=media_type)
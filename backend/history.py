@@ -0,0 +1,145 @@
+"""
+Per-user analysis history: structured rows and incrementally updated trends.
+
+analysis_logs keeps each analysis's constitution, score and symptom vector in
+typed columns. The vector is a real[] in SYMPTOM_NAMES order, so history
+pages never parse the JSON result. Alongside it, analysis_user_stats holds
+one `UserStats` document per user. The log writer folds every new batch into
+that document (see analysis_log.py), so reading a user's trends is a single
+primary-key lookup however many scans they have.
+
+Pages use keyset pagination on (created_at, id). The cursor carries the last
+row's position, so page 50 costs the same index range scan as page 1.
+"""
+
+import base64
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+
+from backend.analysis_core import SYMPTOM_NAMES
+
+# Weight of the newest scan in the exponential moving averages
+EMA_ALPHA = 0.2
+# Scans kept for the recent-trend slope
+RECENT_SCANS = 20
+
+
+def symptom_vector(symptoms: dict | None) -> list[float] | None:
+    """Symptoms dict -> list in SYMPTOM_NAMES order (None if the result had none)."""
+    if not symptoms:
+        return None
+    return [float(symptoms.get(name, 0.0)) for name in SYMPTOM_NAMES]
+
+
+def symptom_dict(vector) -> dict | None:
+    if vector is None:
+        return None
+    return {name: round(value, 3) for name, value in zip(SYMPTOM_NAMES, vector)}
+
+
+def encode_cursor(created_at: datetime, row_id) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, str]:
+    """Raises ValueError for a malformed cursor."""
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(created_at), row_id
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def _slope(values: list[float]) -> float:
+    """Least-squares change per scan; positive means rising."""
+    n = len(values)
+    if n < 2:
+        return 0.0
+    mean_x, mean_y = (n - 1) / 2, sum(values) / n
+    numerator = sum((x - mean_x) * (y - mean_y) for x, y in enumerate(values))
+    denominator = sum((x - mean_x) ** 2 for x in range(n))
+    return numerator / denominator
+
+
+@dataclass(slots=True)
+class UserStats:
+    """Running aggregates for one user; `add` is O(symptoms), independent of history length."""
+
+    user_id: str
+    scans: int = 0
+    score_mean: float = 0.0
+    score_ema: float = 0.0
+    symptom_means: list[float] = field(default_factory=lambda: [0.0] * len(SYMPTOM_NAMES))
+    symptom_ema: list[float] = field(default_factory=lambda: [0.0] * len(SYMPTOM_NAMES))
+    constitutions: dict[str, int] = field(default_factory=dict)
+    # Oldest first: {"at", "constitution", "score", "symptoms"} for the last RECENT_SCANS scans
+    recent: list[dict] = field(default_factory=list)
+    first_at: str | None = None
+    last_at: str | None = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UserStats":
+        return cls(**data)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def add(self, created_at: datetime, constitution: str | None, score: int | None, symptoms: list[float] | None) -> None:
+        self.scans += 1
+        n = self.scans
+        if score is not None:
+            self.score_mean += (score - self.score_mean) / n
+            self.score_ema = score if n == 1 else self.score_ema + EMA_ALPHA * (score - self.score_ema)
+        if symptoms is not None:
+            for i, value in enumerate(symptoms):
+                self.symptom_means[i] += (value - self.symptom_means[i]) / n
+                self.symptom_ema[i] = value if n == 1 else self.symptom_ema[i] + EMA_ALPHA * (value - self.symptom_ema[i])
+        if constitution:
+            self.constitutions[constitution] = self.constitutions.get(constitution, 0) + 1
+        at = created_at.isoformat()
+        self.first_at = self.first_at or at
+        self.last_at = at
+        self.recent.append({"at": at, "constitution": constitution, "score": score, "symptoms": symptoms})
+        del self.recent[:-RECENT_SCANS]
+
+    def summary(self) -> dict:
+        """What GET /history/{user_id}/trends returns."""
+        scores = [scan["score"] for scan in self.recent if scan["score"] is not None]
+        vectors = [scan["symptoms"] for scan in self.recent if scan["symptoms"] is not None]
+        return {
+            "user_id": self.user_id,
+            "scans": self.scans,
+            "first_at": self.first_at,
+            "last_at": self.last_at,
+            "dominant_constitution": max(self.constitutions, key=self.constitutions.get, default=None),
+            "constitutions": self.constitutions,
+            "score": {
+                "mean": round(self.score_mean, 1),
+                "rolling": round(self.score_ema, 1),
+                "trend": round(_slope(scores), 3),
+            },
+            "symptoms": {
+                name: {
+                    "mean": round(self.symptom_means[i], 3),
+                    "rolling": round(self.symptom_ema[i], 3),
+                    "trend": round(_slope([vector[i] for vector in vectors]), 4),
+                }
+                for i, name in enumerate(SYMPTOM_NAMES)
+            },
+            "recent": [
+                {"at": scan["at"], "constitution": scan["constitution"], "score": scan["score"]}
+                for scan in self.recent
+            ],
+        }
+
+
+def fold(existing: dict[str, UserStats], rows) -> dict[str, UserStats]:
+    """Add AnalysisLogRows (in created_at order) to their users' stats; returns the stats that changed."""
+    changed = {}
+    for row in rows:
+        if row.user_id is None:
+            continue
+        stats = existing.get(row.user_id) or UserStats(row.user_id)
+        existing[row.user_id] = changed[row.user_id] = stats
+        stats.add(row.created_at, row.constitution, row.score, row.symptoms)
+    return changed
@@ -0,0 +1,300 @@
+"""
+Image acquisition over pooled keep-alive HTTP connections.
+
+Bodies are streamed and abandoned as soon as they exceed the byte limit or
+turn out not to be an image, so a huge or slow upload can't hold a worker
+for the full request timeout.
+
+Clients can also send the image itself (base64 in JSON or multipart), which
+skips the Storage round trip; see decode_base64_image / check_uploaded_image.
+
+Client-supplied image URLs must fall under IMAGE_URL_PREFIXES (by default the
+public analysis-images bucket, see ImageUrlPolicy), and redirects are not
+followed, so the service can't be pointed at internal addresses.
+"""
+
+import asyncio
+import binascii
+import os
+import time
+from dataclasses import dataclass
+from urllib.parse import urlsplit
+
+import httpx
+
+from backend.image_store import BUCKET
+
+# Hard cap on downloaded image size (phone photos are typically 2-8 MB)
+MAX_IMAGE_BYTES = int(os.environ.get("IMAGE_MAX_BYTES", str(15 * 1024 * 1024)))
+# Total time allowed for one download, including a slowly dripping body
+FETCH_DEADLINE = float(os.environ.get("IMAGE_FETCH_DEADLINE", "15"))
+# Cap on images sent in the request body; the scan page sends ~1024px JPEGs of 100-300 KB
+MAX_UPLOAD_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(5 * 1024 * 1024)))
+
+_TIMEOUT = httpx.Timeout(connect=5.0, read=10.0, write=10.0, pool=5.0)
+_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60)
+
+# Content types that may still hold an image; the body is sniffed to decide
+_SNIFF_TYPES = ("", "application/octet-stream", "binary/octet-stream")
+# Public Supabase URLs are ~150 characters
+MAX_URL_LENGTH = 2048
+
+
+class ImageFetchError(Exception):
+    """Base class for image download failures."""
+
+
+class ImageTooLargeError(ImageFetchError):
+    pass
+
+
+class NotAnImageError(ImageFetchError):
+    pass
+
+
+class ImageUrlNotAllowed(ValueError):
+    """The image URL is outside the allowed prefixes (a ValueError, so Pydantic validators can raise it)."""
+
+
+class ImageUrlPolicy:
+    """
+    Prefixes that client-supplied image URLs must start with.
+
+    Scheme and host must match exactly and the path must start with the
+    prefix's path. An empty policy allows any URL (local development).
+    """
+
+    def __init__(self, prefixes: list[str]):
+        self._prefixes = []
+        for prefix in prefixes:
+            parts = urlsplit(prefix)
+            self._prefixes.append((parts.scheme.lower(), parts.netloc.lower(), parts.path or "/"))
+
+    @classmethod
+    def from_env(cls) -> "ImageUrlPolicy":
+        """
+        IMAGE_URL_PREFIXES: comma-separated allowed prefixes. Defaults to the
+        public bucket under SUPABASE_URL; with neither set, URLs are unrestricted.
+        """
+        prefixes = os.environ.get("IMAGE_URL_PREFIXES")
+        if prefixes is None:
+            supabase = os.environ.get("SUPABASE_URL", "").rstrip("/")
+            prefixes = f"{supabase}/storage/v1/object/public/{BUCKET}/" if supabase else ""
+        return cls([prefix.strip() for prefix in prefixes.split(",") if prefix.strip()])
+
+    @property
+    def restricts(self) -> bool:
+        return bool(self._prefixes)
+
+    def check(self, url: str) -> str:
+        """Return the URL, or raise ImageUrlNotAllowed."""
+        if not self._prefixes:
+            return url
+        if len(url) > MAX_URL_LENGTH:
+            raise ImageUrlNotAllowed("image_url is too long")
+        try:
+            parts = urlsplit(url)
+        except ValueError:
+            raise ImageUrlNotAllowed("image_url is not a valid URL") from None
+        path = parts.path
+        # No userinfo (https://allowed@other/) and no escaping the prefix (../, encoded . and /)
+        if "@" in parts.netloc or "\\" in url or "/../" in f"{path}/" or "%2e" in path.lower() or "%2f" in path.lower():
+            raise ImageUrlNotAllowed("image_url is not allowed")
+        scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+        for allowed_scheme, allowed_netloc, allowed_path in self._prefixes:
+            if scheme == allowed_scheme and netloc == allowed_netloc and path.startswith(allowed_path):
+                return url
+        raise ImageUrlNotAllowed("image_url is not allowed: images must be in the analysis-images bucket")
+
+
+@dataclass
+class FetchedImage:
+    content: bytes
+    content_type: str
+    status: int
+    etag: str | None = None
+    last_modified: str | None = None
+
+    @property
+    def not_modified(self) -> bool:
+        """True when a conditional request matched and no body was sent."""
+        return self.status == 304
+
+
+def looks_like_image(head: bytes) -> bool:
+    """Check the leading bytes against common image signatures."""
+    return (
+        head.startswith(b"\xff\xd8\xff")  # JPEG
+        or head.startswith(b"\x89PNG\r\n\x1a\n")
+        or head.startswith((b"GIF87a", b"GIF89a"))
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+        or head[4:8] == b"ftyp"  # HEIC / AVIF
+    )
+
+
+def check_uploaded_image(data: bytes, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """Apply the download checks (size cap, image signature) to bytes sent by the client."""
+    if len(data) > max_bytes:
+        raise ImageTooLargeError(f"Image exceeds {max_bytes} bytes")
+    if not looks_like_image(data[:12]):
+        raise NotAnImageError("Uploaded data is not a recognised image format")
+    return data
+
+
+def decode_base64_image(data: str, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """
+    Decode a base64 image from a JSON body (bare base64 or a data: URL).
+
+    The size cap is checked on the encoded length first, so an oversized body
+    is rejected without being decoded. a2b_base64 reads the str directly and
+    allocates the decoded bytes once; nothing else is copied.
+    """
+    if data.startswith("data:"):
+        data = data.partition(",")[2]
+    if len(data) // 4 * 3 > max_bytes + 2:
+        raise ImageTooLargeError(f"Image exceeds {max_bytes} bytes")
+    try:
+        image_bytes = binascii.a2b_base64(data)
+    except (binascii.Error, ValueError) as e:
+        raise NotAnImageError(f"Invalid base64 image data: {e}") from e
+    return check_uploaded_image(image_bytes, max_bytes)
+
+
+def _request_headers(
+    byte_range: tuple[int, int | None] | None,
+    etag: str | None,
+    last_modified: str | None,
+) -> dict[str, str]:
+    headers = {"Accept": "image/*"}
+    if byte_range is not None:
+        start, end = byte_range
+        headers["Range"] = f"bytes={start}-{'' if end is None else end}"
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+def _check_response(response: httpx.Response, max_bytes: int) -> str:
+    """Validate status and headers before reading the body; return the content type."""
+    if response.status_code == 304:
+        return ""
+    response.raise_for_status()
+
+    content_type = response.headers.get("content-type", "").split(";")[0].strip().lower()
+    if not content_type.startswith("image/") and content_type not in _SNIFF_TYPES:
+        raise NotAnImageError(f"Unexpected content type: {content_type}")
+
+    length = response.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise ImageTooLargeError(f"Image is {length} bytes, limit is {max_bytes}")
+
+    return content_type
+
+
+class _BodyReader:
+    """Accumulates streamed chunks while enforcing the size limit and sniffing the first bytes."""
+
+    def __init__(self, content_type: str, max_bytes: int, partial: bool):
+        self.buffer = bytearray()
+        self.max_bytes = max_bytes
+        # Only the first bytes of a whole file carry the signature
+        self.sniff = content_type in _SNIFF_TYPES and not partial
+
+    def feed(self, chunk: bytes) -> None:
+        self.buffer += chunk
+        if len(self.buffer) > self.max_bytes:
+            raise ImageTooLargeError(f"Image exceeds {self.max_bytes} bytes")
+        if self.sniff and len(self.buffer) >= 12:
+            if not looks_like_image(bytes(self.buffer[:12])):
+                raise NotAnImageError("Response body is not a recognised image format")
+            self.sniff = False
+
+    def result(self, response: httpx.Response, content_type: str) -> FetchedImage:
+        if self.sniff and response.status_code != 304 and not looks_like_image(bytes(self.buffer[:12])):
+            raise NotAnImageError("Response body is not a recognised image format")
+        return FetchedImage(
+            content=bytes(self.buffer),
+            content_type=content_type,
+            status=response.status_code,
+            etag=response.headers.get("etag"),
+            last_modified=response.headers.get("last-modified"),
+        )
+
+
+class ImageFetcher:
+    """
+    Async image downloader backed by one shared httpx connection pool.
+
+    Create one per process (or per warm container) and reuse it for every
+    request so TLS connections to Storage stay open between scans.
+    """
+
+    def __init__(self, max_bytes: int = MAX_IMAGE_BYTES, deadline: float = FETCH_DEADLINE):
+        self.max_bytes = max_bytes
+        self.deadline = deadline
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            # A redirect could leave the allowed prefixes; it fails like any other non-2xx response
+            self._client = httpx.AsyncClient(timeout=_TIMEOUT, limits=_LIMITS, follow_redirects=False)
+        return self._client
+
+    async def fetch(
+        self,
+        url: str,
+        *,
+        byte_range: tuple[int, int | None] | None = None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> FetchedImage:
+        """
+        Stream an image into memory.
+
+        `byte_range` requests part of the file (start, inclusive end or None).
+        `etag` / `last_modified` make the request conditional; a 304 comes back
+        as a FetchedImage with empty content and `not_modified` set.
+        """
+        headers = _request_headers(byte_range, etag, last_modified)
+        try:
+            async with asyncio.timeout(self.deadline):
+                async with self.client.stream("GET", url, headers=headers) as response:
+                    content_type = _check_response(response, self.max_bytes)
+                    reader = _BodyReader(content_type, self.max_bytes, partial=response.status_code == 206)
+                    if response.status_code != 304:
+                        async for chunk in response.aiter_bytes():
+                            reader.feed(chunk)
+                    return reader.result(response, content_type)
+        except TimeoutError as e:
+            raise ImageFetchError(f"Image download exceeded {self.deadline}s") from e
+
+    async def fetch_bytes(self, url: str) -> bytes:
+        return (await self.fetch(url)).content
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+_sync_client: httpx.Client | None = None
+
+
+def fetch_image_bytes(image_url: str, max_bytes: int = MAX_IMAGE_BYTES, deadline: float = FETCH_DEADLINE) -> bytes:
+    """Blocking variant of ImageFetcher.fetch_bytes for synchronous handlers."""
+    global _sync_client
+    if _sync_client is None:
+        _sync_client = httpx.Client(timeout=_TIMEOUT, limits=_LIMITS, follow_redirects=False)
+
+    started = time.monotonic()
+    with _sync_client.stream("GET", image_url, headers={"Accept": "image/*"}) as response:
+        content_type = _check_response(response, max_bytes)
+        reader = _BodyReader(content_type, max_bytes, partial=False)
+        for chunk in response.iter_bytes():
+            reader.feed(chunk)
+            if time.monotonic() - started > deadline:
+                raise ImageFetchError(f"Image download exceeded {deadline}s")
+        return reader.result(response, content_type).content
@@ -0,0 +1,470 @@
+"""
+Content-addressed storage and retention for analysis images.
+
+Images live in the `analysis-images` bucket under their SHA-256 digest (the
+same `content_hash` the result cache keys on), so the same photo is stored
+once:
+
+    originals/<digest>.<ext>    the upload itself, deleted after the retention window
+    thumbs/<digest>.webp        256px thumbnail for history views, kept
+    inference/<digest>.jpg      1024px copy for re-analysis, kept
+
+The scan page uploads straight to originals/<digest>. Older uploads sit at
+the bucket root under `<timestamp>-<name>`; `ingest` moves them into the
+layout above and removes the duplicates. `derive` creates missing thumbnails
+and inference copies. `prune` deletes originals older than the retention
+window in paginated batches, but only once both derived copies exist.
+
+analysis_logs.image_url points at these objects, so both moves rewrite the
+rows first: ingest points them at originals/<digest>, prune at the kept
+thumbs/<digest>.webp. An object whose rows could not be rewritten is left in
+place. Failures are counted per object and the pass carries on.
+
+    python -m backend.image_store run
+    python -m backend.image_store prune --retention-days 14 --dry-run
+    python -m backend.image_store run --local ./bucket    # directory stand-in for the bucket
+
+The Supabase store needs SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY (which
+also rewrite analysis_logs through the REST API). With --local, rows are
+rewritten in ANALYSIS_LOG_DSN when it is a sqlite:/// file.
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+
+from backend.result_cache import content_hash
+
+BUCKET = os.environ.get("IMAGE_BUCKET", "analysis-images")
+RETENTION_DAYS = float(os.environ.get("IMAGE_RETENTION_DAYS", "30"))
+
+ORIGINALS, THUMBS, INFERENCE = "originals/", "thumbs/", "inference/"
+MANAGED_PREFIXES = (ORIGINALS, THUMBS, INFERENCE)
+
+THUMB_EDGE, THUMB_QUALITY = 256, 70
+INFERENCE_EDGE, INFERENCE_QUALITY = 1024, 85
+
+_EXTENSIONS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp", "HEIF": "heic", "GIF": "gif"}
+_CONTENT_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp", "heic": "image/heic", "gif": "image/gif"}
+_ORIGINAL_URL = re.compile(r"/originals/([0-9a-f]{64})\.\w+(?:\?|$)")
+
+
+def digest_from_url(url: str | None) -> str | None:
+    """The content digest in an originals/<digest>.<ext> URL, or None for other URLs."""
+    match = _ORIGINAL_URL.search(url or "")
+    return match.group(1) if match else None
+
+
+def thumb_name(digest: str) -> str:
+    return f"{THUMBS}{digest}.webp"
+
+
+def inference_name(digest: str) -> str:
+    return f"{INFERENCE}{digest}.jpg"
+
+
+@dataclass(slots=True)
+class StoredObject:
+    name: str
+    size: int
+    created_at: float
+    # Sub-folder entry (no data); listings return them because they take up list positions
+    folder: bool = False
+
+
+class ObjectStore(ABC):
+    """The few bucket operations retention needs."""
+
+    @abstractmethod
+    def list_page(self, prefix: str, limit: int, offset: int) -> list[StoredObject]:
+        """
+        Entries directly under `prefix` ("" for the root), oldest first.
+
+        Sub-folders are included with `folder` set and created_at 0, because
+        Supabase counts them toward `limit` and `offset`: a page shorter than
+        `limit` is then always the last one.
+        """
+
+    @abstractmethod
+    def get(self, name: str) -> bytes: ...
+
+    @abstractmethod
+    def put(self, name: str, data: bytes, content_type: str) -> bool:
+        """Store the object unless it already exists; returns True if it was written."""
+
+    @abstractmethod
+    def exists(self, name: str) -> bool: ...
+
+    @abstractmethod
+    def delete(self, names: list[str]) -> None:
+        """Remove several objects in one call."""
+
+
+class LocalStore(ObjectStore):
+    """A directory standing in for the bucket; created_at is the file's mtime."""
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def list_page(self, prefix: str, limit: int, offset: int) -> list[StoredObject]:
+        folder = self.root / prefix
+        if not folder.is_dir():
+            return []
+        objects = []
+        for path in folder.iterdir():
+            if path.name.startswith("."):
+                continue
+            if path.is_dir():
+                objects.append(StoredObject(prefix + path.name + "/", 0, 0.0, folder=True))
+            elif path.is_file():
+                stat = path.stat()
+                objects.append(StoredObject(prefix + path.name, stat.st_size, stat.st_mtime))
+        objects.sort(key=lambda obj: (obj.created_at, obj.name))
+        return objects[offset:offset + limit]
+
+    def get(self, name: str) -> bytes:
+        return (self.root / name).read_bytes()
+
+    def put(self, name: str, data: bytes, content_type: str) -> bool:
+        path = self.root / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(path, "xb") as f:
+                f.write(data)
+        except FileExistsError:
+            return False
+        return True
+
+    def exists(self, name: str) -> bool:
+        return (self.root / name).is_file()
+
+    def delete(self, names: list[str]) -> None:
+        for name in names:
+            (self.root / name).unlink(missing_ok=True)
+
+
+class SupabaseStore(ObjectStore):
+    """Supabase Storage REST API with the service-role key."""
+
+    def __init__(self, url: str, key: str, bucket: str = BUCKET):
+        import httpx
+
+        self.bucket = bucket
+        self._client = httpx.Client(
+            base_url=f"{url.rstrip('/')}/storage/v1",
+            headers={"Authorization": f"Bearer {key}", "apikey": key},
+            timeout=30,
+        )
+
+    def list_page(self, prefix: str, limit: int, offset: int) -> list[StoredObject]:
+        response = self._client.post(f"/object/list/{self.bucket}", json={
+            "prefix": prefix.rstrip("/"),
+            "limit": limit,
+            "offset": offset,
+            "sortBy": {"column": "created_at", "order": "asc"},
+        })
+        response.raise_for_status()
+        return [
+            StoredObject(prefix + item["name"] + "/", 0, 0.0, folder=True)
+            # Folders have no id or timestamps
+            if item.get("id") is None else
+            StoredObject(
+                prefix + item["name"],
+                (item.get("metadata") or {}).get("size", 0),
+                datetime.fromisoformat(item["created_at"].replace("Z", "+00:00")).timestamp(),
+            )
+            for item in response.json()
+        ]
+
+    def get(self, name: str) -> bytes:
+        response = self._client.get(f"/object/{self.bucket}/{name}")
+        response.raise_for_status()
+        return response.content
+
+    def put(self, name: str, data: bytes, content_type: str) -> bool:
+        response = self._client.post(
+            f"/object/{self.bucket}/{name}",
+            content=data,
+            headers={"Content-Type": content_type, "x-upsert": "false", "cache-control": "31536000"},
+        )
+        if response.status_code in (400, 409) and "exists" in response.text.lower():
+            return False
+        response.raise_for_status()
+        return True
+
+    def exists(self, name: str) -> bool:
+        return self._client.head(f"/object/{self.bucket}/{name}").status_code == 200
+
+    def delete(self, names: list[str]) -> None:
+        response = self._client.request("DELETE", f"/object/{self.bucket}", json={"prefixes": names})
+        response.raise_for_status()
+
+    def public_url(self, name: str) -> str:
+        """The object's URL in the public bucket, as the scan page stores it."""
+        return f"{self._client.base_url}object/public/{self.bucket}/{name}"
+
+
+class SupabaseReferences:
+    """Rewrites analysis_logs.image_url (public object URLs) through PostgREST with the service-role key."""
+
+    def __init__(self, url: str, key: str, bucket: str = BUCKET):
+        import httpx
+
+        self._prefix = f"{url.rstrip('/')}/storage/v1/object/public/{bucket}/"
+        self._client = httpx.Client(
+            base_url=f"{url.rstrip('/')}/rest/v1",
+            headers={"Authorization": f"Bearer {key}", "apikey": key},
+            timeout=30,
+        )
+
+    def rewrite(self, old: str, new: str) -> int:
+        """Point rows that reference object `old` at object `new`; returns the number of rows."""
+        response = self._client.patch(
+            "/analysis_logs",
+            params={"image_url": f"eq.{self._prefix}{old}"},
+            json={"image_url": f"{self._prefix}{new}"},
+            headers={"Prefer": "return=minimal, count=exact"},
+        )
+        response.raise_for_status()
+        return int(response.headers.get("content-range", "*/0").rsplit("/", 1)[-1] or 0)
+
+
+class SQLiteReferences:
+    """Local stand-in: rewrites rows of the SQLiteSink table whose image_url ends in /<object name>."""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path)
+
+    def rewrite(self, old: str, new: str) -> int:
+        with self._conn:
+            return self._conn.execute(
+                "update analysis_logs set image_url = substr(image_url, 1, length(image_url) - length(?)) || ? "
+                "where substr(image_url, -length(?)) = ?",
+                (old, new, "/" + old, "/" + old),
+            ).rowcount
+
+
+def _encode(img, edge: int, fmt: str, quality: int) -> bytes:
+    copy = img.copy()
+    copy.thumbnail((edge, edge))
+    buffer = BytesIO()
+    copy.save(buffer, format=fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def make_derivatives(data: bytes) -> tuple[bytes, bytes]:
+    """(thumbnail WEBP, inference JPEG), both upright and without EXIF metadata."""
+    from PIL import Image, ImageOps
+
+    with Image.open(BytesIO(data)) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    return _encode(img, THUMB_EDGE, "WEBP", THUMB_QUALITY), _encode(img, INFERENCE_EDGE, "JPEG", INFERENCE_QUALITY)
+
+
+def _extension(data: bytes) -> str:
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as img:
+        return _EXTENSIONS.get(img.format, "bin")
+
+
+class ImageRetention:
+    """
+    Ingest, derive and prune passes over an ObjectStore.
+
+    Each pass walks the bucket `batch_size` objects at a time and deletes in
+    one call per page. `min_age` keeps fresh root uploads alone, because a
+    queued analysis may still download them. With `dry_run`, nothing is
+    written or deleted.
+
+    `references` (SupabaseReferences / SQLiteReferences) rewrites the
+    analysis_logs rows of an object before it is deleted; None skips that.
+    """
+
+    def __init__(self, store: ObjectStore, retention_days: float = RETENTION_DAYS, batch_size: int = 100,
+                 min_age: float = 3600, dry_run: bool = False, references=None):
+        self.store = store
+        self.references = references
+        self.retention = retention_days * 86400
+        self.batch_size = batch_size
+        self.min_age = min_age
+        self.dry_run = dry_run
+
+    def _derive_one(self, digest: str, data: bytes | None, original: str) -> bool:
+        """Make sure both derived copies exist (or would, in a dry run); False if they could not be made."""
+        missing = [name for name in (thumb_name(digest), inference_name(digest)) if not self.store.exists(name)]
+        if not missing or self.dry_run:
+            return True
+        try:
+            thumb, inference = make_derivatives(data if data is not None else self.store.get(original))
+            self.store.put(thumb_name(digest), thumb, "image/webp")
+            self.store.put(inference_name(digest), inference, "image/jpeg")
+        except Exception as e:
+            print(f"Could not derive copies of {original}: {e}")
+            return False
+        return True
+
+    def _relink(self, old: str, new: str) -> int:
+        """Point analysis_logs rows at `new` before `old` goes away."""
+        if self.references is None or self.dry_run:
+            return 0
+        return self.references.rewrite(old, new)
+
+    def _delete(self, names: list[str]) -> list[str]:
+        """Delete in one call, falling back to one at a time; returns the names actually deleted."""
+        if not names or self.dry_run:
+            return names
+        try:
+            self.store.delete(names)
+            return names
+        except Exception as e:
+            print(f"Batch delete of {len(names)} objects failed, retrying one by one: {e}")
+        deleted = []
+        for name in names:
+            try:
+                self.store.delete([name])
+                deleted.append(name)
+            except Exception as e:
+                print(f"Could not delete {name}: {e}")
+        return deleted
+
+    def ingest(self) -> dict:
+        """Move root-level `<timestamp>-<name>` uploads to originals/<digest>, dropping duplicates."""
+        cutoff = time.time() - self.min_age
+        stats = {"moved": 0, "duplicates": 0, "relinked": 0, "failed": 0}
+        offset = 0
+        while True:
+            page = self.store.list_page("", self.batch_size, offset)
+            ready = [obj for obj in page
+                     if not obj.folder and obj.created_at < cutoff and not obj.name.startswith(MANAGED_PREFIXES)]
+            done = []
+            for obj in ready:
+                try:
+                    data = self.store.get(obj.name)
+                    digest, ext = content_hash(data), _extension(data)
+                    if self.dry_run:
+                        stats["moved"] += 1
+                        continue
+                    original = f"{ORIGINALS}{digest}.{ext}"
+                    created = self.store.put(original, data, _CONTENT_TYPES.get(ext, "application/octet-stream"))
+                    self._derive_one(digest, data, obj.name)
+                    stats["relinked"] += self._relink(obj.name, original)
+                except Exception as e:
+                    # Left in place (and its log rows unchanged); the next run tries again
+                    print(f"Skipping {obj.name}: {e}")
+                    stats["failed"] += 1
+                    continue
+                stats["moved" if created else "duplicates"] += 1
+                print(f"{obj.name} -> {original}{'' if created else ' (duplicate)'}")
+                done.append(obj.name)
+            deleted = self._delete(done)
+            stats["failed"] += len(done) - len(deleted)
+            # Deleted objects no longer take up list positions
+            offset += len(page) - (0 if self.dry_run else len(deleted))
+            if len(page) < self.batch_size or any(obj.created_at >= cutoff for obj in page):
+                return stats
+
+    def derive(self) -> dict:
+        """Create missing thumbnails and inference copies for every original."""
+        stats = {"checked": 0, "failed": 0}
+        offset = 0
+        while True:
+            page = self.store.list_page(ORIGINALS, self.batch_size, offset)
+            for obj in page:
+                if obj.folder:
+                    continue
+                stats["checked"] += 1
+                digest = Path(obj.name).stem
+                if not self._derive_one(digest, None, obj.name):
+                    stats["failed"] += 1
+            offset += len(page)
+            if len(page) < self.batch_size:
+                return stats
+
+    def prune(self) -> dict:
+        """Delete originals past the retention window, one batch per page."""
+        cutoff = time.time() - self.retention
+        stats = {"deleted": 0, "deleted_bytes": 0, "relinked": 0, "kept": 0}
+        offset = 0
+        while True:
+            page = self.store.list_page(ORIGINALS, self.batch_size, offset)
+            files = [obj for obj in page if not obj.folder]
+            expired = [obj for obj in files if obj.created_at < cutoff]
+            doomed = []
+            for obj in expired:
+                digest = Path(obj.name).stem
+                # Never delete the only copy: derived copies must exist first
+                if not self._derive_one(digest, None, obj.name):
+                    continue
+                try:
+                    stats["relinked"] += self._relink(obj.name, thumb_name(digest))
+                except Exception as e:
+                    print(f"Keeping {obj.name}, could not rewrite its analysis_logs rows: {e}")
+                    continue
+                doomed.append(obj)
+            deleted = set(self._delete([obj.name for obj in doomed]))
+            doomed = [obj for obj in doomed if obj.name in deleted]
+            stats["kept"] += len(expired) - len(doomed)
+            stats["deleted"] += len(doomed)
+            stats["deleted_bytes"] += sum(obj.size for obj in doomed)
+            offset += len(page) - (0 if self.dry_run else len(doomed))
+            if len(expired) < len(files) or len(page) < self.batch_size:
+                return stats
+
+    def run(self) -> dict:
+        return {"ingest": self.ingest(), "derive": self.derive(), "prune": self.prune()}
+
+
+def store_from_env() -> ObjectStore:
+    """IMAGE_STORE_DIR selects the local stand-in; otherwise SUPABASE_URL + SUPABASE_SERVICE_ROLE_KEY."""
+    local = os.environ.get("IMAGE_STORE_DIR")
+    if local:
+        return LocalStore(local)
+    url, key = os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+    if not url or not key:
+        raise SystemExit("Set SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY, or IMAGE_STORE_DIR / --local")
+    return SupabaseStore(url, key)
+
+
+def references_from_env(store: ObjectStore):
+    """Where analysis_logs rows for `store` are rewritten: Supabase for the bucket, SQLite for local runs."""
+    if isinstance(store, SupabaseStore):
+        return SupabaseReferences(os.environ["SUPABASE_URL"], os.environ["SUPABASE_SERVICE_ROLE_KEY"], store.bucket)
+    dsn = os.environ.get("ANALYSIS_LOG_DSN", "")
+    if dsn.startswith("sqlite:///"):
+        return SQLiteReferences(dsn[len("sqlite:///"):])
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deduplicate, derive and expire analysis images.")
+    parser.add_argument("command", choices=("ingest", "derive", "prune", "run"))
+    parser.add_argument("--local", help="Directory standing in for the bucket")
+    parser.add_argument("--retention-days", type=float, default=RETENTION_DAYS, help="Keep originals this long")
+    parser.add_argument("--batch-size", type=int, default=100, help="Objects listed and deleted per request")
+    parser.add_argument("--min-age", type=float, default=3600, help="Leave root uploads younger than this (seconds)")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+
+    store = LocalStore(args.local) if args.local else store_from_env()
+    references = references_from_env(store)
+    if references is None:
+        print("No analysis_logs to rewrite (set ANALYSIS_LOG_DSN=sqlite:///... for local runs)")
+    retention = ImageRetention(store, args.retention_days, args.batch_size, args.min_age, args.dry_run, references)
+    started = time.perf_counter()
+    result = retention.run() if args.command == "run" else {args.command: getattr(retention, args.command)()}
+    for name, stats in result.items():
+        print(f"{name}: " + ", ".join(f"{key}={value}" for key, value in stats.items()))
+    print(f"Finished in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
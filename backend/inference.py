@@ -0,0 +1,107 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class QueueFullError(Exception):
+    """Raised when the executor already has its maximum number of pending jobs."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class InferenceTimeoutError(Exception):
+    """Raised when a single inference job exceeds its time budget."""
+
+
+class InferenceExecutor:
+    """
+    Runs blocking model inference off the event loop on a bounded pool.
+
+    At most `max_workers` jobs run at once and at most `max_queue` more wait
+    for a worker. Anything beyond that is rejected immediately so callers can
+    answer with 503 instead of piling up requests.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = 4,
+        max_queue: int = 16,
+        timeout: float = 10.0,
+        retry_after: int = 2,
+        use_processes: bool = False,
+    ):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.use_processes = use_processes
+        self._pool: Executor | None = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "InferenceExecutor":
+        return cls(
+            max_workers=int(os.environ.get("INFERENCE_MAX_WORKERS", "4")),
+            max_queue=int(os.environ.get("INFERENCE_MAX_QUEUE", "16")),
+            timeout=float(os.environ.get("INFERENCE_TIMEOUT", "10")),
+            retry_after=int(os.environ.get("INFERENCE_RETRY_AFTER", "2")),
+            use_processes=os.environ.get("INFERENCE_EXECUTOR", "thread") == "process",
+        )
+
+    @property
+    def pending(self) -> int:
+        """Jobs currently running or waiting for a worker."""
+        return self._pending
+
+    def start(self) -> None:
+        if self._pool is not None:
+            return
+        if self.use_processes:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="inference")
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def _release(self, _future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn: Callable[..., Any], *args: Any, timeout: float | None = None) -> Any:
+        """
+        Run `fn(*args)` on the pool and await its result.
+
+        Raises QueueFullError when the pool is saturated and InferenceTimeoutError
+        when the job takes longer than `timeout` seconds. A timed-out job keeps its
+        slot until the worker actually finishes, so a hung model still counts
+        against the queue limit.
+        """
+        self.start()
+        budget = timeout if timeout is not None else self.timeout
+
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise QueueFullError(self.retry_after)
+            self._pending += 1
+
+        try:
+            future = self._pool.submit(fn, *args)
+        except Exception:
+            with self._lock:
+                self._pending -= 1
+            raise
+        future.add_done_callback(self._release)
+
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout=budget)
+        except asyncio.TimeoutError as e:
+            future.cancel()
+            raise InferenceTimeoutError(f"Inference exceeded {budget}s") from e
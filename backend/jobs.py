@@ -0,0 +1,425 @@
+"""
+Asynchronous analysis jobs.
+
+`POST /jobs` stores a queued job and returns its id immediately. Worker tasks
+take ids from the queue, run the analysis and keep the finished job for
+JOB_RESULT_TTL seconds. Clients can get the result in three ways: poll
+`GET /jobs/{id}`, follow `GET /jobs/{id}/events`, or pass a webhook_url that
+receives the finished job. Webhooks must be https and may not point at
+private or internal addresses (WEBHOOK_ALLOWED_HOSTS narrows them further).
+
+Submitting again with the same idempotency key returns the existing job
+instead of starting a new analysis.
+"""
+
+import asyncio
+import ipaddress
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
+
+from backend.inference import QueueFullError
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# How long finished jobs (and their idempotency keys) are kept, in seconds
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", "86400"))
+# How often expired jobs are removed even if nobody reads them, in seconds
+JOB_EVICT_INTERVAL = float(os.environ.get("JOB_EVICT_INTERVAL", "300"))
+# Comma-separated hosts webhooks may target ("example.com" also allows its
+# subdomains); unset allows any public host
+WEBHOOK_ALLOWED_HOSTS = [
+    host.strip().lower().lstrip(".") for host in os.environ.get("WEBHOOK_ALLOWED_HOSTS", "").split(",") if host.strip()
+]
+INTERNAL_SUFFIXES = (".localhost", ".local", ".internal", ".localdomain")
+
+
+def _iso(ts: float | None) -> str | None:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec="seconds") if ts else None
+
+
+def _public_ip(address: str) -> bool:
+    try:
+        return ipaddress.ip_address(address).is_global
+    except ValueError:
+        return False
+
+
+def check_webhook_url(url: str) -> str:
+    """
+    Reject webhook URLs the service must not call (raises ValueError).
+
+    Only https URLs without credentials, to hosts in WEBHOOK_ALLOWED_HOSTS
+    when it is set, and never to loopback, private, link-local (cloud metadata)
+    or other internal addresses. Host names are resolved again at delivery.
+    """
+    parts = urlsplit(url)
+    host = (parts.hostname or "").rstrip(".").lower()
+    if parts.scheme != "https" or not host or "@" in parts.netloc:
+        raise ValueError("webhook_url must be an https URL")
+    if WEBHOOK_ALLOWED_HOSTS and not any(host == h or host.endswith("." + h) for h in WEBHOOK_ALLOWED_HOSTS):
+        raise ValueError("webhook_url host is not allowed")
+    try:
+        ipaddress.ip_address(host)
+    except ValueError:
+        if host == "localhost" or host.endswith(INTERNAL_SUFFIXES) or "." not in host:
+            raise ValueError("webhook_url must not point at an internal host") from None
+    else:
+        if not _public_ip(host):
+            raise ValueError("webhook_url must not point at a private address")
+    return url
+
+
+async def _resolves_publicly(url: str) -> bool:
+    """Whether every address the webhook host resolves to is public."""
+    parts = urlsplit(url)
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(parts.hostname, parts.port or 443)
+    except OSError:
+        return False
+    return bool(infos) and all(_public_ip(info[4][0]) for info in infos)
+
+
+@dataclass(slots=True)
+class Job:
+    id: str
+    image_url: str
+    user_id: str | None = None
+    idempotency_key: str | None = None
+    webhook_url: str | None = None
+    status: str = QUEUED
+    result: dict | None = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    expires_at: float | None = None  # set once the job has finished
+
+    @classmethod
+    def new(cls, image_url: str, user_id: str | None = None, idempotency_key: str | None = None,
+            webhook_url: str | None = None) -> "Job":
+        return cls(uuid.uuid4().hex, image_url, user_id, idempotency_key, webhook_url)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Job":
+        return cls(**data)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def expired(self, now: float | None = None) -> bool:
+        return self.expires_at is not None and self.expires_at <= (now or time.time())
+
+    def finish(self, ttl: float, result: dict | None = None, error: str | None = None) -> None:
+        self.status = FAILED if error is not None else DONE
+        self.result = result
+        self.error = error
+        self.updated_at = time.time()
+        self.expires_at = self.updated_at + ttl
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+    def public(self) -> dict:
+        """What clients see; the webhook URL and idempotency key stay private."""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": _iso(self.created_at),
+            "updated_at": _iso(self.updated_at),
+            "expires_at": _iso(self.expires_at),
+        }
+
+
+class JobStore(ABC):
+    @abstractmethod
+    def create(self, job: Job) -> tuple[Job, bool]:
+        """Store a new job, or return the live job that already uses its idempotency key."""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Job | None: ...
+
+    @abstractmethod
+    def save(self, job: Job) -> None: ...
+
+    @abstractmethod
+    def unfinished(self) -> list[Job]:
+        """Jobs that were queued or running, e.g. before a restart."""
+
+    @abstractmethod
+    def evict_expired(self) -> int:
+        """Delete finished jobs past their TTL; returns how many were removed."""
+
+
+class MemoryJobStore(JobStore):
+    """Per-process store; jobs are lost on restart."""
+
+    def __init__(self):
+        self._jobs: dict[str, Job] = {}
+        self._keys: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _live(self, job_id: str | None) -> Job | None:
+        job = self._jobs.get(job_id)
+        if job is not None and job.expired():
+            del self._jobs[job.id]
+            self._keys.pop(job.idempotency_key, None)
+            return None
+        return job
+
+    def create(self, job: Job) -> tuple[Job, bool]:
+        with self._lock:
+            if job.idempotency_key:
+                existing = self._live(self._keys.get(job.idempotency_key))
+                if existing is not None:
+                    return existing, False
+                self._keys[job.idempotency_key] = job.id
+            self._jobs[job.id] = job
+            return job, True
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            return self._live(job_id)
+
+    def save(self, job: Job) -> None:
+        with self._lock:
+            self._jobs[job.id] = job
+
+    def unfinished(self) -> list[Job]:
+        with self._lock:
+            return [job for job in self._jobs.values() if not job.finished]
+
+    def evict_expired(self) -> int:
+        now = time.time()
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.expired(now)]
+            for job in expired:
+                del self._jobs[job.id]
+                self._keys.pop(job.idempotency_key, None)
+        return len(expired)
+
+
+class SQLiteJobStore(JobStore):
+    """Survives restarts; queued and running jobs are picked up again on start."""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute("pragma journal_mode=wal")
+            self._conn.execute(
+                """
+                create table if not exists analysis_jobs (
+                    id text primary key,
+                    idempotency_key text unique,
+                    status text not null,
+                    data text not null,
+                    expires_at real
+                )
+                """
+            )
+
+    def _write(self, job: Job) -> None:
+        self._conn.execute(
+            "insert or replace into analysis_jobs (id, idempotency_key, status, data, expires_at) "
+            "values (?, ?, ?, ?, ?)",
+            (job.id, job.idempotency_key, job.status, json.dumps(job.as_dict()), job.expires_at),
+        )
+
+    def _select(self, where: str, value: str) -> Job | None:
+        row = self._conn.execute(f"select data from analysis_jobs where {where} = ?", (value,)).fetchone()
+        if row is None:
+            return None
+        job = Job.from_dict(json.loads(row[0]))
+        if job.expired():
+            self._conn.execute("delete from analysis_jobs where id = ?", (job.id,))
+            return None
+        return job
+
+    def create(self, job: Job) -> tuple[Job, bool]:
+        with self._lock, self._conn:
+            if job.idempotency_key:
+                existing = self._select("idempotency_key", job.idempotency_key)
+                if existing is not None:
+                    return existing, False
+            self._write(job)
+            return job, True
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock, self._conn:
+            return self._select("id", job_id)
+
+    def save(self, job: Job) -> None:
+        with self._lock, self._conn:
+            self._write(job)
+
+    def unfinished(self) -> list[Job]:
+        with self._lock:
+            rows = self._conn.execute(
+                "select data from analysis_jobs where status in (?, ?)", (QUEUED, RUNNING)
+            ).fetchall()
+        return [Job.from_dict(json.loads(data)) for (data,) in rows]
+
+    def evict_expired(self) -> int:
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "delete from analysis_jobs where expires_at is not null and expires_at <= ?", (time.time(),)
+            ).rowcount
+
+
+async def deliver_webhook(client, url: str, payload: dict, attempts: int = 3) -> bool:
+    """POST the finished job to the client's webhook, retrying with backoff."""
+    # The host may have been re-pointed at an internal address since submission
+    # (redirects are not followed, so this is the only hop)
+    if not await _resolves_publicly(url):
+        print(f"Webhook delivery to {url} refused: host does not resolve to a public address")
+        return False
+    for attempt in range(attempts):
+        try:
+            response = await client.post(url, json=payload, timeout=10)
+            if response.status_code < 500:
+                return response.is_success
+        except Exception as e:
+            print(f"Webhook delivery to {url} failed: {e}")
+        if attempt + 1 < attempts:
+            await asyncio.sleep(2 ** attempt)
+    return False
+
+
+class JobQueue:
+    """
+    Runs jobs from `store` on `workers` background tasks.
+
+    `handler(job)` returns the result dict; any exception marks the job failed.
+    """
+
+    def __init__(self, store: JobStore, handler: Callable[[Job], Awaitable[dict]],
+                 workers: int = 4, max_queue: int = 1000, ttl: float = JOB_RESULT_TTL,
+                 evict_interval: float = JOB_EVICT_INTERVAL):
+        self.store = store
+        self.handler = handler
+        self.workers = workers
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self._queue: asyncio.Queue[str] = asyncio.Queue(maxsize=max_queue)
+        self._tasks: list[asyncio.Task] = []
+        self._changed: dict[str, asyncio.Event] = {}
+        self._deliveries: set[asyncio.Task] = set()
+        self._client = None
+
+    async def start(self) -> None:
+        import httpx
+
+        self._client = httpx.AsyncClient()
+        unfinished = self.store.unfinished()
+        for job in unfinished:
+            job.status = QUEUED
+            self.store.save(job)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        # More jobs than max_queue may be waiting; feed them in as workers make room
+        self._tasks.append(asyncio.create_task(self._restore([job.id for job in unfinished])))
+        self._tasks.append(asyncio.create_task(self._evict()))
+
+    async def stop(self) -> None:
+        """Stop the workers; unfinished jobs stay queued in a persistent store."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def submit(self, image_url: str, user_id: str | None = None, idempotency_key: str | None = None,
+               webhook_url: str | None = None) -> tuple[Job, bool]:
+        """Queue a job; returns (job, created). Raises QueueFullError when the queue is full."""
+        if self._queue.full():
+            raise QueueFullError(retry_after=5)
+        job, created = self.store.create(Job.new(image_url, user_id, idempotency_key, webhook_url))
+        if created:
+            self._queue.put_nowait(job.id)
+        return job, created
+
+    def changed(self, job_id: str) -> asyncio.Event:
+        """Event that is set the next time the job's status changes."""
+        return self._changed.setdefault(job_id, asyncio.Event())
+
+    def _notify(self, job: Job) -> None:
+        self.store.save(job)
+        event = self._changed.pop(job.id, None)
+        if event is not None:
+            event.set()
+
+    async def _restore(self, job_ids: list[str]) -> None:
+        for job_id in job_ids:
+            await self._queue.put(job_id)
+
+    async def _evict(self) -> None:
+        """Drop expired jobs and stale change events, whether or not anyone reads them."""
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            try:
+                evicted = self.store.evict_expired()
+            except Exception as e:
+                print(f"Job eviction failed: {e}")
+                continue
+            for job_id in list(self._changed):
+                job = self.store.get(job_id)
+                if job is None or job.finished:
+                    self._changed.pop(job_id).set()
+            if evicted:
+                print(f"Evicted {evicted} expired job(s)")
+
+    async def _worker(self) -> None:
+        while True:
+            job = self.store.get(await self._queue.get())
+            if job is None or job.finished:
+                continue
+
+            job.status = RUNNING
+            job.updated_at = time.time()
+            self._notify(job)
+            try:
+                job.finish(self.ttl, result=await self.handler(job))
+            except Exception as e:
+                print(f"Job {job.id} failed: {e}")
+                job.finish(self.ttl, error=str(e) or type(e).__name__)
+            self._notify(job)
+
+            if job.webhook_url:
+                # Deliver in the background so a slow webhook doesn't hold up the worker
+                task = asyncio.create_task(deliver_webhook(self._client, job.webhook_url, job.public()))
+                self._deliveries.add(task)
+                task.add_done_callback(self._deliveries.discard)
+
+
+def job_queue_from_env(handler: Callable[[Job], Awaitable[dict]]) -> JobQueue:
+    """
+    JOB_STORE=memory (default) or sqlite (file at JOB_STORE_PATH); JOB_WORKERS
+    and JOB_MAX_QUEUE size the queue, JOB_RESULT_TTL sets result retention and
+    JOB_EVICT_INTERVAL how often expired jobs are swept.
+    """
+    if os.environ.get("JOB_STORE", "memory").lower() == "sqlite":
+        store = SQLiteJobStore(os.environ.get("JOB_STORE_PATH", "analysis_jobs.sqlite3"))
+    else:
+        store = MemoryJobStore()
+    return JobQueue(
+        store,
+        handler,
+        workers=int(os.environ.get("JOB_WORKERS", "4")),
+        max_queue=int(os.environ.get("JOB_MAX_QUEUE", "1000")),
+    )
@@ -1,10 +1,66 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from fastapi.middleware.cors import CORSMiddleware
-import random
+import asyncio
 import time
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, Query, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel, field_validator, model_validator
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+
+from backend.analysis_core import run_ai_model
+from backend.analysis_log import AnalysisLogRow, log_writer_from_env, valid_user_id
+from backend.auth import current_user, optional_user
+from backend.encoding import COMPRESS_MIN_BYTES, encoded_response
+from backend.image_fetch import (
+    MAX_UPLOAD_BYTES,
+    ImageTooLargeError,
+    ImageUrlNotAllowed,
+    ImageUrlPolicy,
+    NotAnImageError,
+    check_uploaded_image,
+    decode_base64_image,
+)
+from backend.jobs import Job, check_webhook_url, job_queue_from_env
+from backend.inference import InferenceExecutor, InferenceTimeoutError, QueueFullError
+from backend.metrics import Instrumentation, render_metrics
+from backend.recommendations import catalog_from_env
+from backend.image_store import digest_from_url
+from backend.result_cache import cache_from_env, cache_key, cache_key_for_digest
+from backend.sse import SSE_HEADERS, format_sse
+
+# Model inference runs on a bounded pool so the event loop stays free.
+# Tune with INFERENCE_MAX_WORKERS / INFERENCE_MAX_QUEUE / INFERENCE_TIMEOUT.
+executor = InferenceExecutor.from_env()
+# image_url must be in the analysis-images bucket (IMAGE_URL_PREFIXES); the model is
+# handed the URL, so the service never requests addresses chosen by the client
+image_urls = ImageUrlPolicy.from_env()
+# Batched background writes to analysis_logs (set ANALYSIS_LOG_DSN to enable)
+log_writer = log_writer_from_env()
+# Stage timings and counters, exposed at /metrics
+metrics = Instrumentation("backend")
+# Product recommendations, loaded from CATALOG_DSN at startup and refreshed in the background
+catalog = catalog_from_env()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    executor.start()
+    if log_writer is not None:
+        await log_writer.start()
+    await catalog.start()
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+    await catalog.stop()
+    executor.shutdown()
+    if log_writer is not None:
+        await log_writer.stop()
+
+app = FastAPI(lifespan=lifespan)
 
-app = FastAPI()
+# Results are cached by image content so re-submitted photos skip the model.
+# Bump CACHE_VERSION whenever run_ai_model changes.
+result_cache = cache_from_env()
+CACHE_VERSION = "mock-v2"
 
 # Configure CORS to allow requests from the frontend
 app.add_middleware(
@@ -14,140 +70,381 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Analysis responses negotiate their own format and compression (backend/encoding.py);
+# everything else is gzipped here when large enough
+app.add_middleware(GZipMiddleware, minimum_size=COMPRESS_MIN_BYTES)
 
 class AnalysisRequest(BaseModel):
+    # Either a URL to download, or the image itself as base64. When both are
+    # sent, the URL is only recorded (e.g. where the client will persist it).
+    # The analysis is logged under the caller's session (optional_user); a
+    # user_id in the body is ignored.
+    image_url: str | None = None
+    image_base64: str | None = None
+
+    @field_validator("image_url")
+    @classmethod
+    def _allowed_image_url(cls, value):
+        return image_urls.check(value) if value is not None else None
+
+    @model_validator(mode="after")
+    def _has_image(self):
+        if self.image_url is None and self.image_base64 is None:
+            raise ValueError("Provide image_url or image_base64")
+        return self
+
+class JobRequest(BaseModel):
     image_url: str
+    webhook_url: str | None = None
+
+    @field_validator("image_url")
+    @classmethod
+    def _allowed_image_url(cls, value):
+        return image_urls.check(value)
+
+    @field_validator("webhook_url")
+    @classmethod
+    def _public_webhook(cls, value):
+        return check_webhook_url(value) if value is not None else None
 
 class AnalysisResult(BaseModel):
     score: int
     constitution: str
     issues: list[str]
-    recommendation: dict
+    recommendation: dict | None
+    recommendations: list[dict] = []
     tongue_features: dict[str, bool]
     symptoms: dict[str, float]
+    cached: bool = False
+    # Random id for GET /results/{result_id}; None when the analysis isn't logged
+    result_id: str | None = None
+
+@contextmanager
+def upload_errors():
+    """Map rejected uploads to 413 (over UPLOAD_MAX_BYTES) and 415 (not an image)."""
+    try:
+        yield
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except NotAnImageError as e:
+        raise HTTPException(status_code=415, detail=str(e))
 
-# ---------------------------------------------------------
-# [USER ACTION REQUIRED LATER]
-# Replace this function with your actual Model Inference code
-# ---------------------------------------------------------
-def run_ai_model(image_url: str) -> dict:
-    # Simulate processing time
-    time.sleep(1.5)
-    
-    # Mock Logic: Randomly determine result to simulate AI
-    constitutions = ["Damp Heat", "Yang Deficiency", "Yin Deficiency", "Qi Stagnation", "Balanced"]
-    detected_constitution = random.choice(constitutions)
-    
-    # Generate random features based on constitution
-    features = {
-        "teeth_marks": random.choice([True, False]),
-        "pale_white": random.choice([True, False]),
-        "red": random.choice([True, False]),
-        "cracked": random.choice([True, False]),
-        "peeling": random.choice([True, False]),
-    }
-
-    # Generate random symptom probabilities (0.1 to 0.9)
-    symptoms = {
-        "obesity": round(random.uniform(0.1, 0.9), 2),
-        "high_sugar": round(random.uniform(0.1, 0.7), 2),
-        "indigestion": round(random.uniform(0.2, 0.8), 2),
-        "fatigue": round(random.uniform(0.2, 0.9), 2),
-        "insomnia": round(random.uniform(0.1, 0.8), 2),
-        "acid_reflux": round(random.uniform(0.1, 0.6), 2),
-        "dry_mouth": round(random.uniform(0.2, 0.8), 2),
-        "constipation": round(random.uniform(0.1, 0.7), 2),
-        "irritability": round(random.uniform(0.2, 0.9), 2),
-    }
-
-    # Refine probabilities based on constitution
-    if detected_constitution == "Damp Heat":
-        symptoms["acne"] = 0.8
-        symptoms["irritability"] = 0.85
-        features["red"] = True
-        features["peeling"] = True
-    elif detected_constitution == "Yang Deficiency":
-        symptoms["fatigue"] = 0.9
-        symptoms["obesity"] = 0.75
-        features["pale_white"] = True
-        features["teeth_marks"] = True
-    
-    # Logic map to simple rules
-    results = {
-        "Damp Heat": {
-            "score": 65,
-            "issues": ["Thick yellow coating", "Red body", "Sticky sensation"],
-            "recommendation": {
-                "productId": "drink-1", 
-                "name": "Bamboo Detox Elixir",
-                "desc": "Cooling herbs to clear heat and dampness."
-            }
-        },
-        "Yang Deficiency": {
-            "score": 55,
-            "issues": ["Pale tongue", "Tooth marks", "White coating"],
-            "recommendation": {
-                "productId": "drink-3",
-                "name": "Golden Ginger Vigor",
-                "desc": "Warming ingredients to boost internal fire."
-            }
-        },
-        "Yin Deficiency": {
-            "score": 60,
-            "issues": ["Red tongue", "No coating", "Cracks"],
-            "recommendation": {
-                "productId": "drink-1",
-                "name": "Moonlight Chamomile", # Reusing for demo
-                "desc": "Nourishing fluids to soothe the body."
-            }
-        },
-        "Qi Stagnation": {
-            "score": 70,
-            "issues": ["Purple spots", "Tense tongue body"],
-            "recommendation": {
-                "productId": "drink-2",
-                "name": "Lavender Dream",
-                "desc": "Flowing energy herbs to release tension."
-            }
-        },
-        "Balanced": {
-            "score": 92,
-            "issues": ["Light red body", "Thin white coating"],
-            "recommendation": {
-                "productId": "drink-2",
-                "name": "Daily Harmony Blend",
-                "desc": "Maintenance for your excellent health."
-            }
-        }
-    }
-    
-    base_result = results[detected_constitution]
-    base_result["constitution"] = detected_constitution
-    base_result["tongue_features"] = features
-    base_result["symptoms"] = symptoms
-    
-    return base_result
+def uploaded_image(request: AnalysisRequest) -> bytes | None:
+    """Decode an image sent in the body; None means the image is fetched from image_url."""
+    if request.image_base64 is None:
+        return None
+    with upload_errors():
+        image_bytes = decode_base64_image(request.image_base64)
+    # Release the encoded copy; only the decoded bytes are needed from here on
+    request.image_base64 = None
+    return image_bytes
 
-@app.post("/analyze", response_model=AnalysisResult)
-async def analyze_tongue(request: AnalysisRequest):
-    print(f"Received analysis request for: {request.image_url}")
-    
+async def lookup_cached_result(image_url: str | None, image_bytes: bytes | None = None) -> tuple[str | None, dict | None]:
+    """
+    Return the cache key and any cached result for an uploaded image or a content-addressed URL.
+
+    Images are never downloaded here: the model is given the URL, so the
+    bytes would only serve the lookup. A URL without a digest
+    (originals/<digest>.jpg) has no key and is not cached.
+    """
+    if result_cache is None:
+        return None, None
+    if image_bytes is None:
+        digest = digest_from_url(image_url)
+        if digest is None:
+            return None, None
+        key = cache_key_for_digest(digest, CACHE_VERSION)
+        result = result_cache.get(key)
+        metrics.cache_lookup(result is not None)
+        return key, result
+    key = cache_key(image_bytes, CACHE_VERSION)
+    result = result_cache.get(key)
+    metrics.cache_lookup(result is not None)
+    return key, result
+
+async def run_model(image_url: str | None) -> dict:
+    """Run the model on the inference pool, timed as the "model" stage."""
+    with metrics.stage("model"):
+        return await executor.run(run_ai_model, image_url)
+
+def with_recommendations(result: dict) -> dict:
+    """Attach current in-stock recommendations; cached results never carry stale stock."""
+    with metrics.stage("recommendation"):
+        return {**result, **catalog.index.recommend(result["constitution"], result["symptoms"])}
+
+def log_analysis(request: AnalysisRequest, user_id: str | None, result: dict, started: float) -> str | None:
+    """Queue the analysis for analysis_logs without waiting on the database; returns its result_id."""
+    if log_writer is None:
+        return None
+    row = AnalysisLogRow(
+        user_id=user_id,
+        image_url=request.image_url,
+        result=result,
+        latency_ms=(time.perf_counter() - started) * 1000,
+        model_version=CACHE_VERSION,
+    )
+    return row.id if log_writer.record(row) else None
+
+async def analyze_image(request: AnalysisRequest, user_id: str | None, image_bytes: bytes | None = None) -> AnalysisResult:
+    """
+    Cache lookup, model call and logging shared by /analyze, /analyze/upload and background jobs.
+
+    user_id is the caller's verified session user (None for anonymous callers).
+    """
+    started = time.perf_counter()
+    key, result = await lookup_cached_result(request.image_url, image_bytes)
+    cached = result is not None
+
+    if not cached:
+        # Call the AI model function on the inference pool
+        result = await run_model(request.image_url)
+        if key is not None:
+            result_cache.set(key, result)
+
+    result = with_recommendations(result)
+    result_id = log_analysis(request, user_id, result, started)
+
+    return AnalysisResult(
+        score=result["score"],
+        constitution=result["constitution"],
+        issues=result["issues"],
+        recommendation=result["recommendation"],
+        recommendations=result["recommendations"],
+        tongue_features=result["tongue_features"],
+        symptoms=result["symptoms"],
+        cached=cached,
+        result_id=result_id,
+    )
+
+async def run_job(job: Job) -> dict:
+    """Job handler: waits for a free inference slot instead of failing with 503."""
+    # job.user_id was taken from the submitter's session
+    request = AnalysisRequest(image_url=job.image_url)
+    for attempt in range(3):
+        try:
+            return (await analyze_image(request, job.user_id)).model_dump()
+        except QueueFullError as e:
+            if attempt == 2:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+# Background analysis jobs (POST /jobs); JOB_STORE=sqlite keeps them across restarts
+job_queue = job_queue_from_env(run_job)
+
+async def respond(request: AnalysisRequest, user_id: str | None, image_bytes: bytes | None) -> AnalysisResult:
+    """Run analyze_image and map failures to HTTP errors."""
     try:
-        # Call the AI model function
-        result = run_ai_model(request.image_url)
-        
-        return AnalysisResult(
-            score=result["score"],
-            constitution=result["constitution"],
-            issues=result["issues"],
-            recommendation=result["recommendation"],
-            tongue_features=result["tongue_features"],
-            symptoms=result["symptoms"]
+        return await analyze_image(request, user_id, image_bytes)
+    except QueueFullError as e:
+        print("Inference queue full, rejecting request")
+        raise HTTPException(
+            status_code=503,
+            detail="Analysis service is busy, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)},
         )
+    except InferenceTimeoutError as e:
+        print(f"Analysis timed out: {e}")
+        raise HTTPException(status_code=504, detail="Analysis timed out")
     except Exception as e:
         print(f"Error analyzing image: {e}")
         raise HTTPException(status_code=500, detail="Analysis failed")
 
+@app.post("/analyze", response_model=AnalysisResult)
+@metrics.request("analyze")
+async def analyze_tongue(
+    request: AnalysisRequest,
+    user_id: str | None = Depends(optional_user),
+    accept: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None),
+):
+    print(f"Received analysis request for: {request.image_url or 'uploaded image'}")
+    result = await respond(request, user_id, uploaded_image(request))
+    return encoded_response(result.model_dump(), accept, accept_encoding)
+
+@app.post("/analyze/upload", response_model=AnalysisResult)
+@metrics.request("upload")
+async def analyze_upload(
+    image: UploadFile = File(...),
+    image_url: str | None = Form(default=None),
+    user_id: str | None = Depends(optional_user),
+    accept: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None),
+):
+    """Same as /analyze, with the image sent as multipart/form-data instead of a URL."""
+    # Read one byte past the cap so an oversized file is rejected without reading all of it
+    image_bytes = await image.read(MAX_UPLOAD_BYTES + 1)
+    with upload_errors():
+        check_uploaded_image(image_bytes)
+    if image_url is not None:
+        try:
+            image_urls.check(image_url)
+        except ImageUrlNotAllowed as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    # model_construct skips the image_url-or-base64 check; the image is already here
+    request = AnalysisRequest.model_construct(image_url=image_url, image_base64=None)
+    result = await respond(request, user_id, image_bytes)
+    return encoded_response(result.model_dump(), accept, accept_encoding)
+
+@app.post("/analyze/stream")
+async def analyze_tongue_stream(request: AnalysisRequest, http_request: Request,
+                                user_id: str | None = Depends(optional_user)):
+    """Same as /analyze, but reports each stage as a Server-Sent Event."""
+    print(f"Received streaming analysis request for: {request.image_url or 'uploaded image'}")
+    started = time.perf_counter()
+    image_bytes = uploaded_image(request)
+
+    async def events():
+        async with metrics.request("stream"), aclosing(stream_events()) as frames:
+            async for frame in frames:
+                yield frame
+
+    async def stream_events():
+        try:
+            key, result = await lookup_cached_result(request.image_url, image_bytes)
+            cached = result is not None
+            yield format_sse("fetched", {"cached": cached})
+
+            if not cached:
+                # Don't spend a model slot on a client that already left
+                if await http_request.is_disconnected():
+                    print("Client disconnected before inference, dropping request")
+                    return
+                yield format_sse("model_started", {})
+                result = await run_model(request.image_url)
+                if key is not None:
+                    result_cache.set(key, result)
+
+            result = with_recommendations(result)
+            result_id = log_analysis(request, user_id, result, started)
+            yield format_sse("result", AnalysisResult(**result, cached=cached, result_id=result_id).model_dump())
+        except QueueFullError as e:
+            yield format_sse("error", {"error": "Analysis service is busy, please retry shortly", "retry_after": e.retry_after})
+        except InferenceTimeoutError:
+            yield format_sse("error", {"error": "Analysis timed out"})
+        except Exception as e:
+            print(f"Error analyzing image: {e}")
+            yield format_sse("error", {"error": "Analysis failed"})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.get("/results/{result_id}", response_model=AnalysisResult)
+async def get_result(
+    result_id: str,
+    accept: str | None = Header(default=None),
+    accept_encoding: str | None = Header(default=None),
+):
+    """
+    A previous analysis by the result_id it returned, with current recommendations.
+
+    Results are read from analysis_logs, so any worker can serve them once the
+    log batch is written (within ANALYSIS_LOG_FLUSH_INTERVAL).
+    """
+    result = await log_writer.result(result_id) if log_writer is not None else None
+    if result is None:
+        raise HTTPException(status_code=404, detail="Result not found")
+    result = AnalysisResult(**with_recommendations(result), cached=True, result_id=result_id)
+    return encoded_response(result.model_dump(), accept, accept_encoding)
+
+@app.get("/catalog")
+def get_catalog(if_none_match: str | None = Header(default=None)):
+    """Products and reason text that compact responses refer to by id."""
+    data = catalog.index.catalog
+    etag = f'"{data["version"]}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=300"}
+    if if_none_match == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(data, headers=headers)
+
+@app.post("/jobs", status_code=202)
+def submit_job(request: JobRequest, response: Response, idempotency_key: str | None = Header(default=None),
+               user_id: str | None = Depends(optional_user)):
+    """
+    Queue an analysis and return its job id right away.
+
+    Poll GET /jobs/{job_id}, follow GET /jobs/{job_id}/events, or pass
+    webhook_url to receive the finished job. Re-submitting with the same
+    Idempotency-Key header returns the existing job (200 instead of 202).
+    """
+    try:
+        job, created = job_queue.submit(request.image_url, user_id, idempotency_key, request.webhook_url)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=503,
+            detail="Job queue is full, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    if not created:
+        response.status_code = 200
+    return job.public()
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = job_queue.store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return job.public()
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    """Server-Sent Events: one event per status change, ending with done or failed."""
+    if job_queue.store.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+
+    async def events():
+        last_status = None
+        while True:
+            # Register for the next change before reading, so no update is missed
+            changed = job_queue.changed(job_id)
+            job = job_queue.store.get(job_id)
+            if job is None:
+                yield format_sse("error", {"error": "Job not found or expired"})
+                return
+            if job.status != last_status:
+                last_status = job.status
+                yield format_sse(job.status, job.public())
+            if job.finished:
+                return
+            try:
+                await asyncio.wait_for(changed.wait(), 15)
+            except asyncio.TimeoutError:
+                # Comment frame keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
+def own_user_id(user_id: str, caller: str = Depends(current_user)) -> str:
+    """The path's user_id, if it belongs to the caller's Supabase session (403 otherwise)."""
+    user_id = valid_user_id(user_id)
+    if user_id is None or user_id != valid_user_id(caller):
+        raise HTTPException(status_code=403, detail="You can only read your own analysis history")
+    return user_id
+
+@app.get("/history/{user_id}")
+async def analysis_history(user_id: str = Depends(own_user_id), limit: int = Query(20, ge=1, le=100),
+                           cursor: str | None = None):
+    """A user's analyses, newest first; pass next_cursor back to get the following page."""
+    if log_writer is None:
+        raise HTTPException(status_code=503, detail="Analysis history is not configured")
+    try:
+        items, next_cursor = await log_writer.sink.history(user_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"items": items, "next_cursor": next_cursor}
+
+@app.get("/history/{user_id}/trends")
+async def analysis_trends(user_id: str = Depends(own_user_id)):
+    if log_writer is None:
+        raise HTTPException(status_code=503, detail="Analysis history is not configured")
+    stats = await log_writer.sink.stats(user_id)
+    if stats is None:
+        raise HTTPException(status_code=404, detail="No analyses recorded for this user")
+    return stats.summary()
+
+@app.get("/metrics")
+def prometheus_metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/")
 def read_root():
     return {"status": "AI Service Running"}
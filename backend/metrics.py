@@ -0,0 +1,188 @@
+"""
+Prometheus metrics and optional OpenTelemetry spans shared by all Python services.
+
+Every service creates one `Instrumentation(service)` and wraps each stage of an
+analysis in `metrics.stage("download")`, `metrics.stage("model")` and so on.
+Label children are resolved once up front, so recording a stage costs two
+perf_counter() calls and one histogram observation.
+
+Set METRICS_OTEL=1 to also emit an OpenTelemetry span per stage. This needs
+opentelemetry-api plus whatever SDK/exporter the deployment configures. Without
+them, or with the flag unset, spans are skipped entirely.
+"""
+
+import inspect
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+STAGES = ("download", "decode", "preprocess", "precheck", "model", "parse", "recommendation")
+
+# 1ms .. 30s: image decode sits at the low end, Gemini calls at the high end
+_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_SECONDS = Histogram(
+    "analysis_stage_seconds", "Time spent in each analysis stage", ["service", "stage"], buckets=_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "analysis_request_seconds", "End-to-end analysis latency", ["service", "endpoint"], buckets=_BUCKETS
+)
+REQUESTS = Counter("analysis_requests_total", "Analysis requests by outcome", ["service", "endpoint", "outcome"])
+IN_FLIGHT = Gauge("analysis_in_flight", "Analyses currently being processed", ["service", "endpoint"])
+CACHE_LOOKUPS = Counter("analysis_cache_lookups_total", "Result cache lookups", ["service", "result"])
+FALLBACKS = Counter("analysis_mock_fallbacks_total", "Results served from the mock model", ["service", "reason"])
+ERRORS = Counter("analysis_errors_total", "Errors by stage", ["service", "stage"])
+PARSE_RESULTS = Counter("analysis_parse_total", "Model output parse outcomes", ["service", "outcome"])
+REJECTED = Counter("analysis_rejected_images_total", "Images rejected before the model call", ["service", "reason"])
+DEGRADED = Counter(
+    "analysis_degraded_total", "Results served by a fallback tier instead of the model", ["service", "cause", "tier"]
+)
+CIRCUIT_STATE = Gauge("analysis_circuit_state", "Circuit breaker state: 0 closed, 1 half-open, 2 open", ["service", "circuit"])
+CIRCUIT_TRANSITIONS = Counter(
+    "analysis_circuit_transitions_total", "Circuit breaker state changes", ["service", "circuit", "state"]
+)
+_CIRCUIT_LEVELS = {"closed": 0, "half_open": 1, "open": 2}
+MODEL_ROUTES = Counter(
+    "analysis_model_routes_total", "Model backend chosen per analysis, and why", ["service", "model", "reason"]
+)
+SHADOW_RUNS = Counter(
+    "analysis_shadow_runs_total", "Shadow model runs by agreement with the served result", ["service", "model", "outcome"]
+)
+UPSTREAM_EVENTS = Counter(
+    "analysis_upstream_events_total", "Model call retries, rate limiting and coalesced requests", ["service", "event"]
+)
+
+
+def _tracer():
+    if os.environ.get("METRICS_OTEL", "0") != "1":
+        return None
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        print("METRICS_OTEL=1 but opentelemetry-api is not installed; spans disabled")
+        return None
+    return trace.get_tracer("nourish-select")
+
+
+class Instrumentation:
+    """Metrics bound to one service label."""
+
+    def __init__(self, service: str):
+        self.service = service
+        self.tracer = _tracer()
+        self._stages = {name: STAGE_SECONDS.labels(service, name) for name in STAGES}
+        self._cache = {result: CACHE_LOOKUPS.labels(service, result) for result in ("hit", "miss")}
+
+    def _span(self, name: str):
+        if self.tracer is None:
+            return nullcontext()
+        return self.tracer.start_as_current_span(name, attributes={"service": self.service})
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage; exceptions are counted against it and re-raised."""
+        started = time.perf_counter()
+        try:
+            with self._span(f"analysis.{name}"):
+                yield
+        except Exception:
+            ERRORS.labels(self.service, name).inc()
+            raise
+        finally:
+            self._stages[name].observe(time.perf_counter() - started)
+
+    def observe(self, name: str, seconds: float) -> None:
+        """Record a stage that was timed elsewhere (e.g. decode inside preprocessing)."""
+        self._stages[name].observe(seconds)
+
+    def request(self, endpoint: str) -> "RequestTracker":
+        """Track in-flight count, latency and outcome of a whole request (see RequestTracker)."""
+        return RequestTracker(self, endpoint)
+
+    def cache_lookup(self, hit: bool) -> None:
+        self._cache["hit" if hit else "miss"].inc()
+
+    def fallback(self, reason: str) -> None:
+        FALLBACKS.labels(self.service, reason).inc()
+
+    def error(self, stage: str) -> None:
+        ERRORS.labels(self.service, stage).inc()
+
+    def parse_result(self, outcome: str) -> None:
+        PARSE_RESULTS.labels(self.service, outcome).inc()
+
+    def rejected(self, reason: str) -> None:
+        REJECTED.labels(self.service, reason).inc()
+
+    def upstream_event(self, event: str) -> None:
+        UPSTREAM_EVENTS.labels(self.service, event).inc()
+
+    def degraded(self, cause: str, tier: str) -> None:
+        DEGRADED.labels(self.service, cause, tier).inc()
+
+    def routed(self, model: str, reason: str) -> None:
+        MODEL_ROUTES.labels(self.service, model, reason).inc()
+
+    def shadow(self, model: str, outcome: str) -> None:
+        SHADOW_RUNS.labels(self.service, model, outcome).inc()
+
+    def circuit_state(self, circuit: str, state: str) -> None:
+        """Record a breaker transition to "closed", "half_open" or "open"."""
+        CIRCUIT_STATE.labels(self.service, circuit).set(_CIRCUIT_LEVELS[state])
+        CIRCUIT_TRANSITIONS.labels(self.service, circuit, state).inc()
+
+
+class RequestTracker:
+    """
+    Usable as `with`, `async with`, or as a decorator on sync or async handlers.
+
+    A request counts as "error" if an exception escapes, including
+    HTTPException responses.
+    """
+
+    def __init__(self, metrics: Instrumentation, endpoint: str):
+        self.metrics = metrics
+        self.endpoint = endpoint
+        self._in_flight = IN_FLIGHT.labels(metrics.service, endpoint)
+
+    def __enter__(self):
+        self._span = self.metrics._span(f"analysis.request.{self.endpoint}")
+        self._span.__enter__()
+        self._in_flight.inc()
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._in_flight.dec()
+        service = self.metrics.service
+        REQUEST_SECONDS.labels(service, self.endpoint).observe(time.perf_counter() - self._started)
+        REQUESTS.labels(service, self.endpoint, "ok" if exc_type is None else "error").inc()
+        return self._span.__exit__(exc_type, exc, tb)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return self.__exit__(exc_type, exc, tb)
+
+    def __call__(self, func):
+        # A fresh tracker per call; this instance only carries the labels
+        if inspect.iscoroutinefunction(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                async with RequestTracker(self.metrics, self.endpoint):
+                    return await func(*args, **kwargs)
+        else:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with RequestTracker(self.metrics, self.endpoint):
+                    return func(*args, **kwargs)
+        return wrapper
+
+
+def render_metrics() -> tuple[bytes, str]:
+    """Prometheus text exposition of everything recorded in this process."""
+    return generate_latest(), CONTENT_TYPE_LATEST
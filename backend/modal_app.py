@@ -1,9 +1,21 @@
-import modal
-from fastapi import HTTPException
-from pydantic import BaseModel
-import random
+import asyncio
 import time
 
+import modal
+from fastapi import Depends, Header, HTTPException
+from fastapi.responses import JSONResponse, Response
+from pydantic import BaseModel, field_validator, model_validator
+
+from backend.analysis_core import run_ai_model
+from backend.analysis_log import AnalysisLogRow, log_writer_from_env
+from backend.auth import optional_user
+from backend.encoding import encoded_response
+from backend.image_fetch import ImageTooLargeError, ImageUrlPolicy, NotAnImageError, decode_base64_image
+from backend.metrics import Instrumentation, render_metrics
+from backend.recommendations import catalog_from_env
+from backend.image_store import digest_from_url
+from backend.result_cache import cache_from_env, cache_key, cache_key_for_digest
+
 # Define the Modal app
 app = modal.App("nourish-select-api")
 
@@ -11,133 +23,188 @@ app = modal.App("nourish-select-api")
 image = modal.Image.debian_slim(python_version="3.11").pip_install([
     "fastapi",
     "pydantic",
-])
+    "httpx",
+    "prometheus-client",
+    "asyncpg",
+    "brotli",
+    "msgpack",
+]).add_local_python_source("backend")
+
+# image_url must be in the analysis-images bucket (IMAGE_URL_PREFIXES); it is never downloaded here
+image_urls = ImageUrlPolicy.from_env()
+
+# Per-container result cache keyed on image content
+result_cache = cache_from_env()
+CACHE_VERSION = "mock-v2"
+
+# Per-container stage timings and counters
+metrics = Instrumentation("modal_app")
+
+# Per-container recommendation index (CATALOG_DSN), loaded when the container starts
+catalog = catalog_from_env()
+
+# Batched writes to analysis_logs (ANALYSIS_LOG_DSN), which also serve results by result_id
+log_writer = log_writer_from_env()
 
 class AnalysisRequest(BaseModel):
-    image_url: str
+    # A URL to download, or the image itself as base64 (image_url is then only recorded).
+    # Analyses are logged under the bearer token's user (optional_user), never a body field.
+    image_url: str | None = None
+    image_base64: str | None = None
+
+    @field_validator("image_url")
+    @classmethod
+    def _allowed_image_url(cls, value):
+        return image_urls.check(value) if value is not None else None
+
+    @model_validator(mode="after")
+    def _has_image(self):
+        if self.image_url is None and self.image_base64 is None:
+            raise ValueError("Provide image_url or image_base64")
+        return self
 
 class AnalysisResult(BaseModel):
     score: int
     constitution: str
     issues: list[str]
-    recommendation: dict
+    recommendation: dict | None
+    recommendations: list[dict] = []
     tongue_features: dict
     symptoms: dict
+    cached: bool = False
+    result_id: str | None = None
 
-def run_ai_model(image_url: str) -> dict:
+def uploaded_image(request: AnalysisRequest) -> bytes | None:
+    """Decode an image sent in the body (413 over UPLOAD_MAX_BYTES, 415 if not an image)."""
+    if request.image_base64 is None:
+        return None
+    try:
+        image_bytes = decode_base64_image(request.image_base64)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except NotAnImageError as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    request.image_base64 = None
+    return image_bytes
+
+def lookup_cached_result(image_url: str | None, image_bytes: bytes | None = None) -> tuple[str | None, dict | None]:
     """
-    Mock AI model function.
-    TODO: Replace with your actual AI model inference code.
+    Cache key and any cached result for an uploaded image or a content-addressed URL.
+
+    URLs are not downloaded (the model is handed the URL); one without a
+    digest (originals/<digest>.jpg) is not cached.
     """
-    time.sleep(1.0)  # Simulated processing time
-    
-    constitutions = ["Damp Heat", "Yang Deficiency", "Yin Deficiency", "Qi Stagnation", "Balanced"]
-    detected_constitution = random.choice(constitutions)
-    
-    features = {
-        "teeth_marks": random.choice([True, False]),
-        "pale_white": random.choice([True, False]),
-        "red": random.choice([True, False]),
-        "cracked": random.choice([True, False]),
-        "peeling": random.choice([True, False]),
-    }
-
-    symptoms = {
-        "obesity": round(random.uniform(0.1, 0.9), 2),
-        "high_sugar": round(random.uniform(0.1, 0.7), 2),
-        "indigestion": round(random.uniform(0.2, 0.8), 2),
-        "fatigue": round(random.uniform(0.2, 0.9), 2),
-        "insomnia": round(random.uniform(0.1, 0.8), 2),
-        "acid_reflux": round(random.uniform(0.1, 0.6), 2),
-        "dry_mouth": round(random.uniform(0.2, 0.8), 2),
-        "constipation": round(random.uniform(0.1, 0.7), 2),
-        "irritability": round(random.uniform(0.2, 0.9), 2),
-    }
-
-    if detected_constitution == "Damp Heat":
-        symptoms["irritability"] = 0.85
-        features["red"] = True
-    elif detected_constitution == "Yang Deficiency":
-        symptoms["fatigue"] = 0.9
-        features["pale_white"] = True
-        features["teeth_marks"] = True
-    
-    results = {
-        "Damp Heat": {
-            "score": 65,
-            "issues": ["Thick yellow coating", "Red body", "Sticky sensation"],
-            "recommendation": {
-                "productId": "drink-1", 
-                "name": "Bamboo Detox Elixir",
-                "desc": "Cooling herbs to clear heat and dampness."
-            }
-        },
-        "Yang Deficiency": {
-            "score": 55,
-            "issues": ["Pale tongue", "Tooth marks", "White coating"],
-            "recommendation": {
-                "productId": "drink-3",
-                "name": "Golden Ginger Vigor",
-                "desc": "Warming ingredients to boost internal fire."
-            }
-        },
-        "Yin Deficiency": {
-            "score": 60,
-            "issues": ["Red tongue", "No coating", "Cracks"],
-            "recommendation": {
-                "productId": "drink-1",
-                "name": "Moonlight Chamomile",
-                "desc": "Nourishing fluids to soothe the body."
-            }
-        },
-        "Qi Stagnation": {
-            "score": 70,
-            "issues": ["Purple spots", "Tense tongue body"],
-            "recommendation": {
-                "productId": "drink-2",
-                "name": "Lavender Dream",
-                "desc": "Flowing energy herbs to release tension."
-            }
-        },
-        "Balanced": {
-            "score": 92,
-            "issues": ["Light red body", "Thin white coating"],
-            "recommendation": {
-                "productId": "drink-2",
-                "name": "Daily Harmony Blend",
-                "desc": "Maintenance for your excellent health."
-            }
-        }
-    }
-    
-    base_result = results[detected_constitution]
-    base_result["constitution"] = detected_constitution
-    base_result["tongue_features"] = features
-    base_result["symptoms"] = symptoms
-    
-    return base_result
-
-# Create the FastAPI web endpoint
-@app.function(image=image)
-@modal.fastapi_endpoint(method="POST")
-def analyze(request: AnalysisRequest) -> AnalysisResult:
-    """Analyze tongue image and return health assessment."""
-    print(f"Received analysis request for: {request.image_url}")
-    
-    try:
-        result = run_ai_model(request.image_url)
-        
-        return AnalysisResult(
-            score=result["score"],
-            constitution=result["constitution"],
-            issues=result["issues"],
-            recommendation=result["recommendation"],
-            tongue_features=result["tongue_features"],
-            symptoms=result["symptoms"]
-        )
-    except Exception as e:
-        print(f"Error analyzing image: {e}")
-        raise HTTPException(status_code=500, detail="Analysis failed")
+    if result_cache is None:
+        return None, None
+    if image_bytes is None:
+        digest = digest_from_url(image_url)
+        if digest is None:
+            return None, None
+        key = cache_key_for_digest(digest, CACHE_VERSION)
+        result = result_cache.get(key)
+        metrics.cache_lookup(result is not None)
+        return key, result
+    key = cache_key(image_bytes, CACHE_VERSION)
+    result = result_cache.get(key)
+    metrics.cache_lookup(result is not None)
+    return key, result
+
+# The analyze and metrics endpoints share one container class, so /metrics
+# reports the container that served the analyses. Labels keep the original URLs.
+@app.cls(image=image)
+class AnalysisService:
+    @modal.enter()
+    async def start_catalog(self):
+        await catalog.start()
+        if log_writer is not None:
+            await log_writer.start()
+
+    @modal.exit()
+    async def stop_catalog(self):
+        await catalog.stop()
+        if log_writer is not None:
+            await log_writer.stop()
+
+    @modal.fastapi_endpoint(method="POST", label="nourish-select-api-analyze")
+    @metrics.request("analyze")
+    async def analyze(
+        self,
+        request: AnalysisRequest,
+        user_id: str | None = Depends(optional_user),
+        accept: str | None = Header(default=None),
+        accept_encoding: str | None = Header(default=None),
+    ):
+        """Analyze tongue image and return health assessment."""
+        print(f"Received analysis request for: {request.image_url or 'uploaded image'}")
+        started = time.perf_counter()
+        image_bytes = uploaded_image(request)
+
+        try:
+            # The cache lookup and the mock model block; keep them off the event loop the log writer runs on
+            key, result = await asyncio.to_thread(lookup_cached_result, request.image_url, image_bytes)
+            cached = result is not None
+
+            if not cached:
+                with metrics.stage("model"):
+                    result = await asyncio.to_thread(run_ai_model, request.image_url, delay=1.0)
+                if key is not None:
+                    result_cache.set(key, result)
+
+            with metrics.stage("recommendation"):
+                result = {**result, **catalog.index.recommend(result["constitution"], result["symptoms"])}
+
+            result_id = None
+            if log_writer is not None:
+                row = AnalysisLogRow(
+                    user_id=user_id,
+                    image_url=request.image_url,
+                    result=result,
+                    latency_ms=(time.perf_counter() - started) * 1000,
+                    model_version=CACHE_VERSION,
+                )
+                result_id = row.id if log_writer.record(row) else None
+
+            result = AnalysisResult(
+                score=result["score"],
+                constitution=result["constitution"],
+                issues=result["issues"],
+                recommendation=result["recommendation"],
+                recommendations=result["recommendations"],
+                tongue_features=result["tongue_features"],
+                symptoms=result["symptoms"],
+                cached=cached,
+                result_id=result_id,
+            )
+        except Exception as e:
+            print(f"Error analyzing image: {e}")
+            raise HTTPException(status_code=500, detail="Analysis failed")
+        return encoded_response(result.model_dump(), accept, accept_encoding)
+
+    @modal.fastapi_endpoint(method="GET", label="nourish-select-api-result")
+    async def result(
+        self,
+        result_id: str,
+        accept: str | None = Header(default=None),
+        accept_encoding: str | None = Header(default=None),
+    ):
+        """A previous analysis by its result_id (GET ?result_id=...), read from analysis_logs."""
+        result = await log_writer.result(result_id) if log_writer is not None else None
+        if result is None:
+            raise HTTPException(status_code=404, detail="Result not found")
+        result = {**result, **catalog.index.recommend(result["constitution"], result["symptoms"])}
+        result = AnalysisResult(**result, cached=True, result_id=result_id)
+        return encoded_response(result.model_dump(), accept, accept_encoding)
+
+    @modal.fastapi_endpoint(method="GET", label="nourish-select-api-catalog")
+    def product_catalog(self):
+        """Products and reason text that compact responses refer to by id."""
+        return JSONResponse(catalog.index.catalog, headers={"Cache-Control": "public, max-age=300"})
+
+    @modal.fastapi_endpoint(method="GET", label="nourish-select-api-metrics", requires_proxy_auth=True)
+    def export_metrics(self):
+        """Prometheus metrics for this container (needs Modal-Key / Modal-Secret headers)."""
+        body, content_type = render_metrics()
+        return Response(content=body, media_type=content_type)
 
 @app.function(image=image)
 @modal.fastapi_endpoint(method="GET")
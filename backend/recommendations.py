@@ -0,0 +1,423 @@
+"""
+In-memory product recommendation index built from the products/categories tables.
+
+Every (constitution, dominant symptom) pair maps to a precomputed, ranked
+tuple of in-stock products, so a request's recommendation is a dict lookup
+rather than a database query. Products rank by how many of their `features`
+match the constitution's benefits (weighted double) and the dominant
+symptom's benefits.
+
+`CatalogRefresher` loads the catalog when the service starts and keeps it
+current. Postgres sends a NOTIFY on `catalog_changed` whenever products or
+categories change (see initial_schema.sql). Each notification, and each
+CATALOG_REFRESH_INTERVAL tick, re-reads only the rows whose updated_at
+moved and drops deleted ids. The index is then rebuilt off to the side and
+swapped in with a single assignment, so readers never see a partial index.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+from dataclasses import dataclass
+
+from backend.analysis_core import CONSTITUTIONS, DEFAULT_CONSTITUTION, SYMPTOM_NAMES, get_profile
+
+# Product `features` each constitution benefits from
+CONSTITUTION_BENEFITS = {
+    "Qi Deficiency": ("Increase Vigor", "Boost Appetite"),
+    "Yang Deficiency": ("Increase Vigor", "Cure Swelling"),
+    "Yin Deficiency": ("Improves Sleep", "Deep Relaxation"),
+    "Damp Heat": ("Detox", "Mental Clarity"),
+    "Qi Stagnation": ("Less Anxiety", "Mental Clarity"),
+    "Blood Stasis": ("Pressure Points", "Pain Relief"),
+    "Phlegm Dampness": ("Detox", "Cure Swelling"),
+    "Balanced": ("Deep Relaxation", "Soft Skin"),
+}
+
+# Product `features` that address a symptom once it dominates the profile
+SYMPTOM_BENEFITS = {
+    "obesity": ("Detox", "Cure Swelling"),
+    "high_sugar": ("Detox",),
+    "indigestion": ("Boost Appetite",),
+    "fatigue": ("Increase Vigor",),
+    "insomnia": ("Improves Sleep", "Deep Relaxation"),
+    "acid_reflux": ("Detox",),
+    "dry_mouth": ("Improves Sleep",),
+    "constipation": ("Detox",),
+    "irritability": ("Less Anxiety", "Mental Clarity"),
+}
+
+# A symptom only shapes the ranking at or above this probability
+DOMINANT_SYMPTOM = 0.6
+
+RECOMMENDATION_LIMIT = int(os.environ.get("RECOMMENDATION_LIMIT", "3"))
+
+
+@dataclass(frozen=True, slots=True)
+class Product:
+    id: str
+    slug: str
+    name: str
+    description: str | None
+    category: str | None
+    price: float
+    image_url: str | None
+    features: tuple[str, ...]
+    stock_count: int
+
+    def as_dict(self, reason: str) -> dict:
+        return {
+            "productId": self.id,
+            "slug": self.slug,
+            "name": self.name,
+            "desc": self.description,
+            "reason": reason,
+            "category": self.category,
+            "price": self.price,
+            "imageUrl": self.image_url,
+            "features": list(self.features),
+        }
+
+
+# Seed rows from initial_schema.sql, used when no catalog database is configured
+SEED_PRODUCTS = (
+    Product("dream-weave", "dream-weave", "Dream Weave Elixir", "Enhances deep sleep and REM cycles.", "drinks",
+            29.99, "/placeholder-drink-1.jpg", ("Improves Sleep", "Deep Relaxation"), 100),
+    Product("calm-flow", "calm-flow", "Calm Flow Tonic", "Reduces anxiety and centers your Chi.", "drinks",
+            34.99, "/placeholder-drink-2.jpg", ("Less Anxiety", "Mental Clarity"), 100),
+    Product("vitality-spark", "vitality-spark", "Vitality Spark", "Increases vigor and daily energy.", "drinks",
+            24.99, "/placeholder-drink-3.jpg", ("Increase Vigor", "Boost Appetite"), 100),
+    Product("bamboo-detox", "bamboo-detox", "Bamboo Detox Pad", "Cures swollen feet with bamboo vinegar.", "foot-masks",
+            19.99, "/placeholder-mask-1.jpg", ("Cure Swelling", "Detox"), 100),
+    Product("silk-exfoliator", "silk-exfoliator", "Silk Exfoliator", "Gentle exfoliation for renewed skin.", "foot-masks",
+            22.99, "/placeholder-mask-2.jpg", ("Exfoliating Scrub", "Soft Skin"), 100),
+    Product("acupressure-relief", "acupressure-relief", "Acupressure Relief",
+            "Stimulates pressure points for whole-body healing.", "foot-masks",
+            29.99, "/placeholder-mask-3.jpg", ("Pressure Points", "Pain Relief"), 100),
+)
+
+
+def dominant_symptom(symptoms: dict) -> str | None:
+    """The strongest symptom if it reaches DOMINANT_SYMPTOM, else None."""
+    name, value = max(symptoms.items(), key=lambda item: item[1], default=(None, 0.0))
+    return name if name in SYMPTOM_BENEFITS and value >= DOMINANT_SYMPTOM else None
+
+
+def _rank(products, constitution: str, symptom: str | None, limit: int) -> tuple[Product, ...]:
+    wanted = {benefit.lower() for benefit in CONSTITUTION_BENEFITS.get(constitution, ())}
+    extra = {benefit.lower() for benefit in SYMPTOM_BENEFITS.get(symptom, ())}
+    scored = []
+    for product in products:
+        if product.stock_count <= 0:
+            continue
+        features = {feature.lower() for feature in product.features}
+        score = 2 * len(features & wanted) + len(features & extra)
+        if score:
+            scored.append((-score, -product.stock_count, product.name, product))
+    scored.sort(key=lambda entry: entry[:3])
+    return tuple(entry[-1] for entry in scored[:limit])
+
+
+class RecommendationIndex:
+    """Ranked in-stock products per (constitution, dominant symptom)."""
+
+    def __init__(self, products=(), limit: int = RECOMMENDATION_LIMIT):
+        self.limit = limit
+        self.products: dict[str, Product] = {}
+        self._index: dict[tuple[str, str | None], tuple[Product, ...]] = {}
+        self.load(products)
+
+    def load(self, products) -> None:
+        """Replace the whole catalog."""
+        self.products = {product.id: product for product in products}
+        self._rebuild()
+
+    def apply(self, changed=(), deleted=()) -> None:
+        """Upsert changed products and drop deleted ids, then rebuild."""
+        products = dict(self.products)
+        for product_id in deleted:
+            products.pop(product_id, None)
+        for product in changed:
+            products[product.id] = product
+        self.products = products
+        self._rebuild()
+
+    def _rebuild(self) -> None:
+        products = tuple(self.products.values())
+        self.catalog = self._catalog(products)
+        self._index = {
+            (constitution, symptom): _rank(products, constitution, symptom, self.limit)
+            for constitution in CONSTITUTIONS
+            for symptom in (None, *SYMPTOM_NAMES)
+        }
+
+    @staticmethod
+    def _catalog(products) -> dict:
+        """
+        What the catalog endpoints serve: compact responses list recommended
+        products by id, and clients resolve the ids and reason text here.
+        """
+        data = {
+            "products": {
+                product.id: {key: value for key, value in product.as_dict(None).items() if key != "reason"}
+                for product in products
+            },
+            "reasons": {constitution: get_profile(constitution).recommendation.desc for constitution in CONSTITUTIONS},
+        }
+        body = json.dumps(data, sort_keys=True, separators=(",", ":")).encode()
+        return {"version": hashlib.blake2b(body, digest_size=8).hexdigest(), **data}
+
+    def lookup(self, constitution: str, symptoms: dict) -> tuple[Product, ...]:
+        if constitution not in CONSTITUTION_BENEFITS:
+            constitution = DEFAULT_CONSTITUTION
+        return self._index.get((constitution, dominant_symptom(symptoms)), ())
+
+    def recommend(self, constitution: str, symptoms: dict) -> dict:
+        """
+        The `recommendation` (best match, or None if nothing suitable is in
+        stock) and ranked `recommendations` fields of an analysis result.
+        """
+        reason = get_profile(constitution).recommendation.desc
+        ranked = [product.as_dict(reason) for product in self.lookup(constitution, symptoms)]
+        return {"recommendation": ranked[0] if ranked else None, "recommendations": ranked}
+
+
+class SeedCatalog:
+    """The seed products; nothing to refresh."""
+
+    async def open(self) -> None:
+        pass
+
+    async def products(self, since=None) -> tuple[list[Product], object]:
+        return (list(SEED_PRODUCTS) if since is None else []), 0
+
+    async def ids(self) -> set[str]:
+        return {product.id for product in SEED_PRODUCTS}
+
+    async def listen(self, callback) -> bool:
+        return False
+
+    async def close(self) -> None:
+        pass
+
+
+class PostgresCatalog:
+    """Reads products through a one-connection asyncpg pool and LISTENs for catalog_changed."""
+
+    SELECT = (
+        "select p.id::text, p.slug, p.name, p.description, c.slug, p.price, p.image_url, "
+        "coalesce(p.features, '{}'), coalesce(p.stock_count, 0), p.updated_at "
+        "from public.products p left join public.categories c on c.id = p.category_id"
+    )
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._pool = None
+        self._listener = None
+
+    async def open(self) -> None:
+        import asyncpg
+
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=1)
+
+    async def products(self, since=None) -> tuple[list[Product], object]:
+        if since is None:
+            rows = await self._pool.fetch(self.SELECT)
+        else:
+            rows = await self._pool.fetch(self.SELECT + " where p.updated_at >= $1", since)
+        products = [
+            Product(r[0], r[1], r[2], r[3], r[4], float(r[5]), r[6], tuple(r[7]), r[8]) for r in rows
+        ]
+        return products, max((r[9] for r in rows), default=since)
+
+    async def ids(self) -> set[str]:
+        return {r[0] for r in await self._pool.fetch("select id::text from public.products")}
+
+    async def listen(self, callback) -> bool:
+        # A dedicated connection: LISTEN only delivers while the connection stays open
+        import asyncpg
+
+        self._listener = await asyncpg.connect(self.dsn)
+        await self._listener.add_listener("catalog_changed", lambda conn, pid, channel, payload: callback(payload))
+        return True
+
+    async def close(self) -> None:
+        if self._listener is not None:
+            await self._listener.close()
+            self._listener = None
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+class SQLiteCatalog:
+    """Local stand-in with the same tables; features are stored as a JSON array."""
+
+    SELECT = (
+        "select p.id, p.slug, p.name, p.description, c.slug, p.price, p.image_url, "
+        "p.features, p.stock_count, p.updated_at "
+        "from products p left join categories c on c.id = p.category_id"
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: sqlite3.Connection | None = None
+
+    async def open(self) -> None:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.executescript(
+            """
+            create table if not exists categories (
+                id text primary key,
+                slug text unique not null,
+                name text not null
+            );
+            create table if not exists products (
+                id text primary key,
+                category_id text references categories(id),
+                name text not null,
+                slug text unique not null,
+                description text,
+                price real not null,
+                image_url text,
+                features text,
+                stock_count integer default 0,
+                updated_at real not null default ((julianday('now') - 2440587.5) * 86400.0)
+            );
+            create trigger if not exists products_touch after update on products begin
+                update products set updated_at = (julianday('now') - 2440587.5) * 86400.0 where id = new.id;
+            end;
+            """
+        )
+
+    def _fetch(self, since) -> list[tuple]:
+        if since is None:
+            return self._conn.execute(self.SELECT).fetchall()
+        return self._conn.execute(self.SELECT + " where p.updated_at >= ?", (since,)).fetchall()
+
+    async def products(self, since=None) -> tuple[list[Product], object]:
+        rows = await asyncio.to_thread(self._fetch, since)
+        products = [
+            Product(r[0], r[1], r[2], r[3], r[4], float(r[5]), r[6], tuple(json.loads(r[7] or "[]")), r[8] or 0)
+            for r in rows
+        ]
+        return products, max((r[9] for r in rows), default=since)
+
+    async def ids(self) -> set[str]:
+        return {r[0] for r in self._conn.execute("select id from products")}
+
+    async def listen(self, callback) -> bool:
+        return False
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class CatalogRefresher:
+    """
+    Loads the catalog into `index` on start, then refreshes it in the background.
+
+    If the database can't be reached or the first load fails, the index keeps
+    its current (seed) products; connecting and the full load are retried on
+    every tick until they succeed.
+
+    A refresh runs on every change notification (coalesced while one is
+    already pending) and at least every `interval` seconds. It fetches only
+    rows updated since the newest updated_at seen so far. A "*" payload
+    (category changes) forces a full reload.
+    """
+
+    def __init__(self, index: RecommendationIndex, source, interval: float = 300):
+        self.index = index
+        self.source = source
+        self.interval = interval
+        self._since = None
+        self._full = False
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._connected = False
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        try:
+            await self._connect()
+            await self.refresh(full=True)
+        except Exception as e:
+            # Serve whatever the index already holds and retry on the next tick
+            print(f"Catalog load failed, retrying in {self.interval}s: {e}")
+            self._full = True
+        self._task = asyncio.create_task(self._run())
+
+    async def _connect(self) -> None:
+        await self.source.open()
+        self._connected = True
+        try:
+            await self.source.listen(self._notified)
+        except Exception as e:
+            print(f"Catalog change notifications unavailable, refreshing every {self.interval}s: {e}")
+
+    def _notified(self, payload: str) -> None:
+        if payload == "*":
+            self._full = True
+        self._wake.set()
+
+    async def refresh(self, full: bool = False) -> None:
+        if full:
+            products, self._since = await self.source.products()
+            self.index.load(products)
+            return
+        changed, self._since = await self.source.products(self._since)
+        deleted = self.index.products.keys() - await self.source.ids()
+        if changed or deleted:
+            self.index.apply(changed, deleted)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            full, self._full = self._full, False
+            try:
+                if not self._connected:
+                    await self._connect()
+                await self.refresh(full=full)
+            except Exception as e:
+                # Keep serving the last good index; a failed full load is retried as one
+                self._full = self._full or full
+                print(f"Catalog refresh failed: {e}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.source.close()
+
+
+def catalog_from_env() -> CatalogRefresher:
+    """
+    Build the index and its refresher from CATALOG_DSN.
+
+    postgres://... or postgresql://... reads the Supabase products/categories
+    tables; sqlite:///path reads a local SQLite file; unset uses the seed
+    products. CATALOG_REFRESH_INTERVAL sets the fallback polling interval.
+    """
+    dsn = os.environ.get("CATALOG_DSN")
+    if not dsn:
+        source = SeedCatalog()
+    elif dsn.startswith("sqlite:///"):
+        source = SQLiteCatalog(dsn[len("sqlite:///"):])
+    else:
+        source = PostgresCatalog(dsn)
+    return CatalogRefresher(
+        RecommendationIndex(SEED_PRODUCTS),
+        source,
+        interval=float(os.environ.get("CATALOG_REFRESH_INTERVAL", "300")),
+    )
@@ -0,0 +1,214 @@
+"""
+Content-addressed cache for tongue analysis results.
+
+Results are keyed on a hash of the image bytes plus an analysis version
+string (model name + prompt hash), so re-submitting the same photo returns
+the stored result without another model call, while changing the prompt or
+model naturally invalidates old entries.
+
+Backends implement `CacheBackend`. `MemoryCache` and `SQLiteCache` ship here;
+a Redis backend only needs the same `get`/`set`/`delete`/`clear` methods
+(e.g. SETEX with the TTL and an `allkeys-lru` maxmemory policy).
+
+Expired entries are kept for a further `stale_ttl` seconds. Normal lookups
+ignore them, but `get(key, allow_stale=True)` still returns them, so a stale
+answer can be served when the model is unavailable.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+
+def content_hash(image_bytes: bytes) -> str:
+    """
+    SHA-256 of the image bytes. Stored images are named after it
+    (originals/<digest>.jpg, see image_store.py), and the scan page computes
+    the same digest with crypto.subtle before uploading.
+    """
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def cache_key_for_digest(digest: str, version: str) -> str:
+    """Cache key from a content digest, so a content-addressed URL can be looked up without downloading it."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(version.encode())
+    h.update(b"\0")
+    h.update(digest.encode())
+    return h.hexdigest()
+
+
+def cache_key(image_bytes: bytes, version: str) -> str:
+    """Hash the image bytes together with the analysis version."""
+    return cache_key_for_digest(content_hash(image_bytes), version)
+
+
+def version_tag(model: str, prompt: str) -> str:
+    """Build a version string that changes whenever the model or prompt does."""
+    return f"{model}:{hashlib.sha256(prompt.encode()).hexdigest()[:12]}"
+
+
+class CacheBackend(ABC):
+    """Minimal interface every result cache backend implements."""
+
+    @abstractmethod
+    def get(self, key: str, allow_stale: bool = False) -> dict | None:
+        """Return the stored result, or None if missing or expired (unless allow_stale)."""
+
+    @abstractmethod
+    def set(self, key: str, value: dict) -> None:
+        """Store a result, evicting the least recently used entries if needed."""
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    def clear(self) -> None:
+        ...
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 86400, stale_ttl: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._data: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, allow_stale: bool = False) -> dict | None:
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at + self.stale_ttl < now:
+                del self._data[key]
+                return None
+            if expires_at < now and not allow_stale:
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: dict) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache(CacheBackend):
+    """On-disk cache in a single SQLite file, shared by all workers on the host."""
+
+    def __init__(self, path: str, max_entries: int = 100_000, ttl: float = 7 * 86400, stale_ttl: float = 0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            create table if not exists analysis_cache (
+                key text primary key,
+                value text not null,
+                expires_at real not null,
+                accessed_at real not null
+            )
+            """
+        )
+        self._conn.execute(
+            "create index if not exists analysis_cache_accessed on analysis_cache (accessed_at)"
+        )
+
+    def get(self, key: str, allow_stale: bool = False) -> dict | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "select value, expires_at from analysis_cache where key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] + self.stale_ttl < now:
+                self._conn.execute("delete from analysis_cache where key = ?", (key,))
+                return None
+            if row[1] < now and not allow_stale:
+                return None
+            self._conn.execute(
+                "update analysis_cache set accessed_at = ? where key = ?", (now, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key: str, value: dict) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "insert or replace into analysis_cache (key, value, expires_at, accessed_at) "
+                "values (?, ?, ?, ?)",
+                (key, json.dumps(value), now + self.ttl, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("delete from analysis_cache where expires_at < ?", (now - self.stale_ttl,))
+        (count,) = self._conn.execute("select count(*) from analysis_cache").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "delete from analysis_cache where key in "
+                "(select key from analysis_cache order by accessed_at limit ?)",
+                (overflow,),
+            )
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("delete from analysis_cache where key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("delete from analysis_cache")
+
+
+def cache_from_env() -> CacheBackend | None:
+    """
+    Build the configured cache backend.
+
+    RESULT_CACHE: "memory" (default), "sqlite" or "off"
+    RESULT_CACHE_PATH: SQLite file path (sqlite backend only)
+    RESULT_CACHE_SIZE: maximum number of entries
+    RESULT_CACHE_TTL: entry lifetime in seconds
+    RESULT_CACHE_STALE_TTL: how long expired entries stay available as a fallback
+    """
+    kind = os.environ.get("RESULT_CACHE", "memory").lower()
+    size = int(os.environ.get("RESULT_CACHE_SIZE", "1024"))
+    ttl = float(os.environ.get("RESULT_CACHE_TTL", "86400"))
+    stale_ttl = float(os.environ.get("RESULT_CACHE_STALE_TTL", "604800"))
+
+    if kind == "off":
+        return None
+    if kind == "sqlite":
+        path = os.environ.get("RESULT_CACHE_PATH", "analysis_cache.sqlite3")
+        return SQLiteCache(path, max_entries=size, ttl=ttl, stale_ttl=stale_ttl)
+    return MemoryCache(max_entries=size, ttl=ttl, stale_ttl=stale_ttl)
@@ -0,0 +1,161 @@
+"""
+Cold vs warm request latency for the tongue analyzer.
+
+local mode (default) runs offline. Each cold sample is a fresh Python process
+that imports the analyzer's heavy dependencies, warms them up the way
+TongueAnalyzer.preload() does, and then serves a first request on a
+synthetic photo. The warm samples are the requests that follow in the same
+process. No network or Gemini key is needed; the model call is the mock result.
+
+remote mode times a deployed /analyze_tongue endpoint. Cold samples wait
+--idle seconds before each request, so deploy with TONGUE_MIN_CONTAINERS=0
+and an --idle longer than TONGUE_SCALEDOWN_WINDOW. Warm samples are sent back to back.
+
+    python benchmarks/bench_cold_start.py --runs 10 --warm 20
+    python benchmarks/bench_cold_start.py --url https://<user>--tongue-analyzer-analyze-tongue.modal.run \\
+        --token $API_TOKEN --image-url https://example.com/tongue.jpg --runs 3 --idle 90
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def report(label, samples_ms):
+    if not samples_ms:
+        print(f"{label:<8} no samples")
+        return
+    print(
+        f"{label:<8} n={len(samples_ms):<4} p50={percentile(samples_ms, 50):8.1f} ms  "
+        f"p99={percentile(samples_ms, 99):8.1f} ms  max={max(samples_ms):8.1f} ms"
+    )
+
+
+def child(warm_requests, edge):
+    """One simulated container: import, preload, then serve requests."""
+    started = time.perf_counter()
+    from io import BytesIO
+
+    import google.generativeai  # noqa: F401
+    import numpy as np
+    from PIL import Image
+
+    from backend.analysis_core import mock_analysis
+    from backend.image_fetch import looks_like_image
+    from modal_ai.preprocess import preprocess_image
+
+    imported = time.perf_counter()
+
+    # Same warm-up as TongueAnalyzer.preload()
+    buffer = BytesIO()
+    Image.new("RGB", (64, 64), (200, 80, 80)).save(buffer, format="JPEG")
+    preprocess_image(buffer.getvalue())
+    preloaded = time.perf_counter()
+
+    rng = np.random.default_rng(0)
+    photo = BytesIO()
+    Image.fromarray(rng.integers(0, 255, size=(edge * 3 // 4, edge, 3), dtype=np.uint8)).save(photo, format="JPEG")
+    photo = photo.getvalue()
+
+    def request():
+        request_started = time.perf_counter()
+        assert looks_like_image(photo[:16])
+        preprocess_image(photo)
+        mock_analysis()
+        return (time.perf_counter() - request_started) * 1000
+
+    first = request()
+    warm = [request() for _ in range(warm_requests)]
+    print(json.dumps({
+        "import_ms": (imported - started) * 1000,
+        "preload_ms": (preloaded - imported) * 1000,
+        "first_ms": first,
+        "cold_ms": (preloaded - started) * 1000 + first,
+        "warm_ms": warm,
+    }))
+
+
+def run_local(args):
+    env = {**os.environ, "PYTHONPATH": str(ROOT), "PYTHONWARNINGS": "ignore"}
+    cold, warm, imports, preloads = [], [], [], []
+    for _ in range(args.runs):
+        out = subprocess.run(
+            [sys.executable, __file__, "--child", "--warm", str(args.warm), "--edge", str(args.edge)],
+            env=env, check=True, capture_output=True, text=True,
+        )
+        sample = json.loads(out.stdout.strip().splitlines()[-1])
+        cold.append(sample["cold_ms"])
+        imports.append(sample["import_ms"])
+        preloads.append(sample["preload_ms"])
+        warm.extend(sample["warm_ms"])
+
+    print(f"local: {args.runs} fresh processes, {args.warm} warm requests each, {args.edge}px photo")
+    report("import", imports)
+    report("preload", preloads)
+    report("cold", cold)
+    report("warm", warm)
+
+
+def run_remote(args):
+    import httpx
+
+    headers = {"Authorization": f"Bearer {args.token}"}
+    payload = {"image_url": args.image_url}
+
+    def timed(client):
+        started = time.perf_counter()
+        response = client.post(args.url, json=payload, headers=headers)
+        response.raise_for_status()
+        return (time.perf_counter() - started) * 1000
+
+    cold, warm = [], []
+    with httpx.Client(timeout=120) as client:
+        for i in range(args.runs):
+            print(f"waiting {args.idle}s for the container to scale down ({i + 1}/{args.runs})...")
+            time.sleep(args.idle)
+            cold.append(timed(client))
+        warm = [timed(client) for _ in range(args.warm)]
+
+    print(f"remote: {args.url}")
+    report("cold", cold)
+    report("warm", warm)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="Cold samples")
+    parser.add_argument("--warm", type=int, default=20, help="Warm requests (per process in local mode)")
+    parser.add_argument("--edge", type=int, default=3000, help="Synthetic photo width (local mode)")
+    parser.add_argument("--url", help="Deployed analyze_tongue endpoint (enables remote mode)")
+    parser.add_argument("--token", default=os.environ.get("API_TOKEN", ""))
+    parser.add_argument("--image-url", help="Image to analyze in remote mode")
+    parser.add_argument("--idle", type=float, default=90, help="Seconds to wait before each cold request")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.path.insert(0, str(ROOT))
+        child(args.warm, args.edge)
+    elif args.url:
+        if not args.image_url:
+            parser.error("--image-url is required with --url")
+        run_remote(args)
+    else:
+        run_local(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Cost of rejecting invalid requests at the analyze_tongue endpoint.
+
+Each case builds a request in memory and awaits the endpoint method directly,
+the way Modal's FastAPI wrapper calls it, so the timings are the handler's
+own work: header auth, body parsing and the image_url allowlist check. The
+analyzer behind the endpoint is a tripwire. Any rejected request that
+reached the analysis pipeline would fail the run, so every number
+below is a request that never touched the TongueAnalyzer pool.
+
+The gate rows time RequestGate.authenticate / check_image_url alone.
+
+    python benchmarks/bench_rejection.py --iterations 20000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import warnings
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+TOKEN = "bench-token-" + "x" * 40
+BUCKET_PREFIX = "https://project.supabase.co/storage/v1/object/public/analysis-images/"
+GOOD_URL = BUCKET_PREFIX + "originals/" + "a" * 64 + ".jpg"
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def report(label, samples_us):
+    print(
+        f"{label:<26} n={len(samples_us):<6} p50={percentile(samples_us, 50):7.1f} us  "
+        f"p99={percentile(samples_us, 99):7.1f} us  max={max(samples_us):8.1f} us"
+    )
+
+
+class Tripwire:
+    """Stands in for the analyzer: fails loudly if a request gets past validation."""
+
+    def __init__(self):
+        self.reached = 0
+
+    async def _analyze_one(self, *args):
+        self.reached += 1
+        return {"success": True, "data": {}}
+
+
+async def run(iterations: int) -> None:
+    os.environ["API_TOKEN"] = TOKEN
+    os.environ["IMAGE_URL_PREFIXES"] = BUCKET_PREFIX
+    warnings.filterwarnings("ignore")
+
+    import modal_ai.main as service
+    from benchmarks.load_test import asgi_request
+    from modal_ai.validation import RequestRejected
+
+    endpoint = service.TongueAnalyzer._get_user_cls().analyze_tongue._get_raw_f()
+    gate = service.request_gate()
+    analyzer = Tripwire()
+
+    def body(**fields) -> bytes:
+        return json.dumps(fields).encode()
+
+    auth = {"authorization": f"Bearer {TOKEN}", "content-type": "application/json"}
+    cases = {
+        "missing token": ({}, body(image_url=GOOD_URL), 401),
+        "wrong token": ({"authorization": "Bearer " + "y" * 52}, body(image_url=GOOD_URL), 401),
+        "other host": (auth, body(image_url="https://example.com/tongue.jpg"), 400),
+        "path escape": (auth, body(image_url=BUCKET_PREFIX + "../private/x.jpg"), 400),
+        "missing image": (auth, body(user_id="u1"), 400),
+        "malformed json": (auth, b'{"image_url": ', 400),
+    }
+
+    print("endpoint (request -> response)")
+    for label, (headers, payload, status) in cases.items():
+        samples = []
+        for _ in range(iterations):
+            request = asgi_request(payload, headers)
+            started = time.perf_counter()
+            response = await endpoint(analyzer, request)
+            samples.append((time.perf_counter() - started) * 1e6)
+            assert response.status_code == status, (label, response.status_code, response.body)
+        report(label, samples)
+    assert analyzer.reached == 0, "a rejected request reached the analyzer"
+
+    samples = []
+    for _ in range(iterations):
+        request = asgi_request(body(image_url=GOOD_URL), auth)
+        started = time.perf_counter()
+        await endpoint(analyzer, request)
+        samples.append((time.perf_counter() - started) * 1e6)
+    report("accepted (to analysis)", samples)
+
+    print("gate only")
+    for label, check in (
+        ("authenticate (wrong)", lambda: gate.authenticate("Bearer " + "y" * 52)),
+        ("authenticate (ok)", lambda: gate.authenticate(f"Bearer {TOKEN}")),
+        ("check_image_url (other)", lambda: gate.check_image_url("https://example.com/tongue.jpg")),
+        ("check_image_url (ok)", lambda: gate.check_image_url(GOOD_URL)),
+    ):
+        samples = []
+        for _ in range(iterations):
+            started = time.perf_counter()
+            try:
+                check()
+            except RequestRejected:
+                pass
+            samples.append((time.perf_counter() - started) * 1e6)
+        report(label, samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=5000, help="Requests per case")
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations))
+
+
+if __name__ == "__main__":
+    main()
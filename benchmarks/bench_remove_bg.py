@@ -0,0 +1,89 @@
+"""
+Compare remove_bg.make_transparent against the old per-pixel loop.
+
+Only the pixel transform is timed; PNG decode/encode cost is the same for both.
+
+    python benchmarks/bench_remove_bg.py                 # synthetic 1024x1024 logo
+    python benchmarks/bench_remove_bg.py public/logo.png --repeat 5
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from remove_bg import make_transparent  # noqa: E402
+
+
+def make_transparent_loop(img):
+    """The original implementation: one Python tuple per pixel."""
+    img = img.convert("RGBA")
+    datas = img.getdata()
+
+    newData = []
+    for item in datas:
+        if item[0] < 50 and item[1] < 50 and item[2] < 50:
+            newData.append((0, 0, 0, 0))
+        else:
+            newData.append(item)
+
+    img.putdata(newData)
+    return img
+
+
+def synthetic_logo(path, size):
+    """Neon pink and green shapes with a noisy near-black background."""
+    rng = np.random.default_rng(0)
+    rgba = np.zeros((size, size, 4), dtype=np.uint8)
+    rgba[..., :3] = rng.integers(0, 40, size=(size, size, 3))
+    rgba[..., 3] = 255
+    q = size // 4
+    rgba[q : 2 * q, q : 3 * q, :3] = (255, 20, 147)
+    rgba[2 * q : 3 * q, q : 3 * q, :3] = (0, 255, 0)
+    Image.fromarray(rgba, "RGBA").save(path)
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("image", nargs="?", help="Image to process (default: synthetic logo)")
+    parser.add_argument("--size", type=int, default=1024, help="Synthetic image edge length")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        source = Path(args.image) if args.image else tmp / "synthetic.png"
+        if not args.image:
+            synthetic_logo(source, args.size)
+
+        img = Image.open(source)
+        img.load()
+
+        loop_s = best_of(lambda: make_transparent_loop(img), args.repeat)
+        numpy_s = best_of(lambda: make_transparent(img), args.repeat)
+
+        identical = np.array_equal(np.asarray(make_transparent_loop(img)), np.asarray(make_transparent(img)))
+        width, height = img.size
+
+    print(f"image: {width}x{height} ({width * height / 1e6:.1f} MP)")
+    print(f"per-pixel loop: {loop_s * 1000:9.1f} ms")
+    print(f"numpy mask:     {numpy_s * 1000:9.1f} ms  ({loop_s / numpy_s:.1f}x faster)")
+    print(f"identical output: {identical}")
+
+
+if __name__ == "__main__":
+    main()
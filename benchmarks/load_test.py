@@ -0,0 +1,432 @@
+"""
+Offline load test for the analysis endpoints.
+
+The harness generates a corpus of synthetic tongue photos and serves them from
+a local HTTP server. It then drives one of two targets:
+
+  backend  backend/main.py under uvicorn on a local port; run_ai_model sleeps
+           for the injected model latency
+  modal    TongueAnalyzer's analyze_tongue endpoint, run in-process with the
+           Gemini client replaced by a stub that sleeps for the injected
+           latency and returns valid JSON
+
+Load is either closed-loop (--concurrency workers send --requests in total)
+or open-loop (Poisson arrivals at --rate per second for --duration seconds).
+The report covers throughput, p50/p95/p99 latency and error rate. --output
+saves it as JSON, and --compare prints the change against an earlier run.
+
+    python benchmarks/load_test.py backend --concurrency 16 --requests 200
+    python benchmarks/load_test.py modal --rate 20 --duration 30 --model-latency-ms 1200
+    python benchmarks/load_test.py modal --output after.json --compare before.json
+
+Nothing leaves the machine: no Gemini key, Modal account or Supabase is needed.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+# ---------------------------------------------------------------------------
+# Synthetic corpus and local image server
+# ---------------------------------------------------------------------------
+
+def synthetic_tongue(rng: np.random.Generator, width: int) -> bytes:
+    """A phone-style JPEG: noisy skin-toned background with a red/pink tongue."""
+    height = width * 4 // 3
+    base = np.array([rng.integers(150, 220), rng.integers(110, 170), rng.integers(90, 140)])
+    pixels = np.clip(base + rng.normal(0, 12, size=(height, width, 3)), 0, 255).astype(np.uint8)
+    img = Image.fromarray(pixels, "RGB")
+
+    draw = ImageDraw.Draw(img)
+    tongue = (int(rng.integers(170, 230)), int(rng.integers(50, 100)), int(rng.integers(60, 110)))
+    cx, cy = width // 2, int(height * rng.uniform(0.5, 0.65))
+    rx, ry = int(width * rng.uniform(0.22, 0.32)), int(height * rng.uniform(0.2, 0.3))
+    draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=tongue)
+    if rng.random() < 0.5:
+        # Whitish coating in the middle of the tongue
+        draw.ellipse((cx - rx // 2, cy - ry // 2, cx + rx // 2, cy + ry // 3), fill=(225, 210, 205))
+    img = img.filter(ImageFilter.GaussianBlur(2))
+
+    out = BytesIO()
+    img.save(out, format="JPEG", quality=90)
+    return out.getvalue()
+
+
+def build_corpus(size: int, min_edge: int, max_edge: int, seed: int) -> list[bytes]:
+    rng = np.random.default_rng(seed)
+    return [synthetic_tongue(rng, int(rng.integers(min_edge, max_edge + 1))) for _ in range(size)]
+
+
+class ImageServer:
+    """Serves the corpus at /img/<index>.jpg from a background thread."""
+
+    def __init__(self, corpus: list[bytes]):
+        images = corpus
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                try:
+                    body = images[int(self.path.rsplit("/", 1)[-1].split(".")[0])]
+                except (ValueError, IndexError):
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "image/jpeg")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self.urls = [f"http://127.0.0.1:{self._server.server_port}/img/{i}.jpg" for i in range(len(corpus))]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# ---------------------------------------------------------------------------
+# Model stubs
+# ---------------------------------------------------------------------------
+
+class ModelLatency:
+    """Normally distributed model latency, clipped at zero."""
+
+    def __init__(self, mean_ms: float, jitter_ms: float, seed: int):
+        self.mean = mean_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self._rng = random.Random(seed)
+
+    def sample(self) -> float:
+        return max(0.0, self._rng.gauss(self.mean, self.jitter))
+
+
+class StubResponse:
+    def __init__(self, text: str):
+        self.text = text
+        self._chunks = [text[i:i + 32] for i in range(0, len(text), 32)]
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for chunk in self._chunks:
+            yield StubResponse(chunk)
+
+
+class StubGemini:
+    """
+    Stands in for genai.GenerativeModel: sleeps, then returns a valid analysis.
+
+    A micro-batched request (several images in one call) gets a JSON array with
+    one analysis per image, as the real model is asked for.
+    """
+
+    def __init__(self, latency: ModelLatency):
+        self.latency = latency
+        self.calls = 0
+
+    async def generate_content_async(self, contents, stream: bool = False, **kwargs):
+        from backend.analysis_core import mock_analysis
+
+        self.calls += 1
+        await asyncio.sleep(self.latency.sample())
+        results = []
+        for _ in range(max(1, sum(isinstance(part, dict) for part in contents))):
+            result = mock_analysis()
+            result.pop("recommendation")
+            results.append(result)
+        return StubResponse(json.dumps(results if len(results) > 1 else results[0]))
+
+
+# ---------------------------------------------------------------------------
+# Targets: each yields an async send(image_url) that raises on failure
+# ---------------------------------------------------------------------------
+
+def asgi_request(body: bytes, headers: dict):
+    """A starlette Request for calling an endpoint method directly, without a server."""
+    from starlette.requests import Request
+
+    scope = {
+        "type": "http",
+        "method": "POST",
+        "path": "/",
+        "query_string": b"",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in headers.items()],
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    return Request(scope, receive)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@asynccontextmanager
+async def backend_target(latency: ModelLatency):
+    import httpx
+    import uvicorn
+
+    import backend.main as service
+    from backend.analysis_core import run_ai_model
+
+    service.run_ai_model = lambda image_url: run_ai_model(image_url, delay=latency.sample())
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(service.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    limits = httpx.Limits(max_connections=1000, max_keepalive_connections=1000)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120, limits=limits) as client:
+        async def send(image_url: str) -> None:
+            response = await client.post("/analyze", json={"image_url": image_url})
+            if response.status_code != 200:
+                raise RuntimeError(f"HTTP {response.status_code}")
+
+        try:
+            yield send
+        finally:
+            server.should_exit = True
+            await asyncio.to_thread(thread.join)
+
+
+@asynccontextmanager
+async def modal_target(latency: ModelLatency):
+    os.environ.pop("GEMINI_API_KEY", None)
+    os.environ["API_TOKEN"] = token = "load-test"
+    # The corpus is served from 127.0.0.1, so don't restrict image_url to the Supabase bucket
+    os.environ.pop("IMAGE_URL_PREFIXES", None)
+    os.environ.pop("SUPABASE_URL", None)
+
+    import modal_ai.main as service
+
+    # Run the plain Python class behind the Modal Cls in this process
+    cls = service.TongueAnalyzer._get_user_cls()
+
+    def raw(name):
+        return getattr(cls, name)._get_raw_f()
+
+    analyzer = cls()
+    raw("preload")(analyzer)
+    raw("load_model")(analyzer)
+    await raw("start_log_writer")(analyzer)
+    await raw("start_catalog")(analyzer)
+    # Route every request to the stub, behind the same upstream guard a Gemini model gets
+    backend = analyzer._backend(service.MODEL_NAME, None, "load-test")
+    backend.model = StubGemini(latency)
+    analyzer.router.backends = [backend]
+    endpoint = raw("analyze_tongue")
+    headers = {"authorization": f"Bearer {token}", "content-type": "application/json"}
+
+    async def send(image_url: str) -> None:
+        response = await endpoint(analyzer, asgi_request(json.dumps({"image_url": image_url}).encode(), headers))
+        result = json.loads(response.body)
+        if response.status_code != 200 or not result.get("success"):
+            raise RuntimeError(result.get("error", "unknown error"))
+
+    try:
+        yield send
+    finally:
+        await raw("stop_catalog")(analyzer)
+        await raw("stop_log_writer")(analyzer)
+        await analyzer.fetcher.aclose()
+
+
+TARGETS = {"backend": backend_target, "modal": modal_target}
+
+
+# ---------------------------------------------------------------------------
+# Load generation and reporting
+# ---------------------------------------------------------------------------
+
+async def timed(send, image_url: str, samples: list) -> None:
+    started = time.perf_counter()
+    try:
+        await send(image_url)
+        error = None
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"[:120]
+    samples.append((time.perf_counter() - started, error))
+
+
+async def closed_loop(send, urls: list[str], concurrency: int, total: int) -> list:
+    samples = []
+    remaining = iter(range(total))
+
+    async def worker():
+        for i in remaining:
+            await timed(send, urls[i % len(urls)], samples)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples
+
+
+async def open_loop(send, urls: list[str], rate: float, duration: float, seed: int) -> list:
+    samples = []
+    tasks = []
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    i = 0
+    while loop.time() < deadline:
+        tasks.append(asyncio.create_task(timed(send, urls[i % len(urls)], samples)))
+        i += 1
+        await asyncio.sleep(rng.expovariate(rate))
+    await asyncio.gather(*tasks)
+    return samples
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    latencies = [latency * 1000 for latency, error in samples if error is None]
+    errors = Counter(error for _, error in samples if error is not None)
+    summary = {
+        "requests": len(samples),
+        "errors": sum(errors.values()),
+        "error_rate": round(sum(errors.values()) / len(samples), 4) if samples else 0.0,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "top_errors": dict(errors.most_common(5)),
+    }
+    if latencies:
+        summary.update({
+            "mean_ms": round(sum(latencies) / len(latencies), 1),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "p99_ms": round(percentile(latencies, 99), 1),
+            "max_ms": round(max(latencies), 1),
+        })
+    return summary
+
+
+def git_commit() -> str | None:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def print_summary(report: dict) -> None:
+    s = report["summary"]
+    print(f"target: {report['target']} ({report['mode']})  commit: {report['commit']}")
+    print(f"requests: {s['requests']}  errors: {s['errors']} ({s['error_rate']:.2%})  "
+          f"throughput: {s['throughput_rps']} req/s over {s['elapsed_s']}s")
+    if "p50_ms" in s:
+        print(f"latency ms  p50={s['p50_ms']}  p95={s['p95_ms']}  p99={s['p99_ms']}  max={s['max_ms']}")
+    for error, count in s["top_errors"].items():
+        print(f"  {count} x {error}")
+
+
+def print_comparison(report: dict, baseline: dict) -> None:
+    print(f"vs {baseline['commit']} ({baseline['timestamp']}):")
+    for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "error_rate"):
+        old, new = baseline["summary"].get(key), report["summary"].get(key)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old:+.1%}" if old else "n/a"
+        print(f"  {key:<15} {old:>10} -> {new:<10} {change}")
+
+
+async def run(args) -> dict:
+    corpus = build_corpus(args.corpus, args.min_edge, args.max_edge, args.seed)
+    latency = ModelLatency(args.model_latency_ms, args.model_jitter_ms, args.seed)
+
+    with ImageServer(corpus) as images:
+        async with TARGETS[args.target](latency) as send:
+            if args.warmup:
+                await closed_loop(send, images.urls, min(args.warmup, args.concurrency), args.warmup)
+
+            started = time.perf_counter()
+            if args.rate:
+                samples = await open_loop(send, images.urls, args.rate, args.duration, args.seed)
+            else:
+                samples = await closed_loop(send, images.urls, args.concurrency, args.requests)
+            elapsed = time.perf_counter() - started
+
+    return {
+        "target": args.target,
+        "mode": f"open-loop {args.rate}/s" if args.rate else f"closed-loop x{args.concurrency}",
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "summary": summarize(samples, elapsed),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("target", choices=sorted(TARGETS))
+    parser.add_argument("--concurrency", type=int, default=8, help="Closed-loop workers")
+    parser.add_argument("--requests", type=int, default=100, help="Closed-loop total requests")
+    parser.add_argument("--rate", type=float, help="Open-loop arrivals per second (overrides closed-loop)")
+    parser.add_argument("--duration", type=float, default=10, help="Open-loop duration in seconds")
+    parser.add_argument("--warmup", type=int, default=5, help="Requests sent before measuring")
+    parser.add_argument("--model-latency-ms", type=float, default=800, help="Mean injected model latency")
+    parser.add_argument("--model-jitter-ms", type=float, default=200, help="Std-dev of injected model latency")
+    parser.add_argument("--corpus", type=int, default=24, help="Number of synthetic images")
+    parser.add_argument("--min-edge", type=int, default=800)
+    parser.add_argument("--max-edge", type=int, default=3000)
+    parser.add_argument("--cache", action="store_true", help="Keep the result cache on (off by default)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="Write the report as JSON")
+    parser.add_argument("--compare", type=Path, help="Earlier JSON report to compare against")
+    args = parser.parse_args()
+
+    # Services read their settings at import time
+    if not args.cache:
+        os.environ["RESULT_CACHE"] = "off"
+    os.environ.pop("ANALYSIS_LOG_DSN", None)
+
+    report = asyncio.run(run(args))
+    print_summary(report)
+    if args.compare:
+        print_comparison(report, json.loads(args.compare.read_text()))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
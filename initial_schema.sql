@@ -62,6 +62,45 @@ create table public.products (
 alter table public.products enable row level security;
 create policy "Products are viewable by everyone." on products for select using (true);
 
+-- Catalog change tracking for the recommendation index (see backend/recommendations.py):
+-- updated_at lets services re-read only changed rows, and catalog_changed
+-- notifications tell them to do so right away.
+alter table public.products add column if not exists updated_at timestamp with time zone default now() not null;
+create index if not exists products_updated_at on public.products (updated_at);
+
+create or replace function public.touch_updated_at()
+returns trigger as $$
+begin
+  new.updated_at := now();
+  return new;
+end;
+$$ language plpgsql;
+
+create trigger products_touch_updated_at
+  before update on public.products
+  for each row execute procedure public.touch_updated_at();
+
+-- Payload is the product id, or '*' when a category changes (services reload everything)
+create or replace function public.notify_catalog_changed()
+returns trigger as $$
+begin
+  if tg_table_name = 'products' then
+    perform pg_notify('catalog_changed', coalesce(new.id, old.id)::text);
+  else
+    perform pg_notify('catalog_changed', '*');
+  end if;
+  return null;
+end;
+$$ language plpgsql;
+
+create trigger products_notify_catalog_changed
+  after insert or update or delete on public.products
+  for each row execute procedure public.notify_catalog_changed();
+
+create trigger categories_notify_catalog_changed
+  after insert or update or delete on public.categories
+  for each statement execute procedure public.notify_catalog_changed();
+
 
 -- CART
 create table public.carts (
@@ -123,10 +162,77 @@ create table public.analysis_logs (
   created_at timestamp with time zone default timezone('utc'::text, now()) not null
 );
 
+-- Structured results written by the AI services (batched, see backend/analysis_log.py)
+alter table public.analysis_logs add column if not exists result jsonb;
+alter table public.analysis_logs add column if not exists latency_ms integer;
+alter table public.analysis_logs add column if not exists model_version text;
+create index if not exists analysis_logs_user_created on public.analysis_logs (user_id, created_at desc);
+
+-- History columns (see backend/history.py): symptoms is a vector in SYMPTOM_NAMES order
+alter table public.analysis_logs add column if not exists constitution text;
+alter table public.analysis_logs add column if not exists score smallint;
+alter table public.analysis_logs add column if not exists symptoms real[];
+create index if not exists analysis_logs_user_page on public.analysis_logs (user_id, created_at desc, id desc);
+
+update public.analysis_logs set
+  constitution = result->>'constitution',
+  score = (result->>'score')::smallint,
+  symptoms = array[
+    (result->'symptoms'->>'obesity')::real,
+    (result->'symptoms'->>'high_sugar')::real,
+    (result->'symptoms'->>'indigestion')::real,
+    (result->'symptoms'->>'fatigue')::real,
+    (result->'symptoms'->>'insomnia')::real,
+    (result->'symptoms'->>'acid_reflux')::real,
+    (result->'symptoms'->>'dry_mouth')::real,
+    (result->'symptoms'->>'constipation')::real,
+    (result->'symptoms'->>'irritability')::real
+  ]
+where result is not null and constitution is null;
+
 alter table public.analysis_logs enable row level security;
 create policy "Users can view own analysis" on analysis_logs for select using (auth.uid() = user_id);
 create policy "Users can create own analysis" on analysis_logs for insert with check (auth.uid() = user_id);
 
+-- Per-user trend aggregates, updated with every batch of analysis_logs inserts
+create table if not exists public.analysis_user_stats (
+  user_id uuid references auth.users(id) on delete cascade primary key,
+  stats jsonb,
+  updated_at timestamp with time zone default now() not null
+);
+
+alter table public.analysis_user_stats enable row level security;
+create policy "Users can view own stats" on analysis_user_stats for select using (auth.uid() = user_id);
+
+-- Bulk re-analysis of stored images under a new prompt/model version (see modal_ai/reanalysis.py).
+-- One row per (version, image digest); symptoms is a vector in SYMPTOM_NAMES order.
+create table if not exists public.analysis_reanalysis (
+  version text not null,
+  digest text not null,
+  model_version text,
+  constitution text,
+  score smallint,
+  symptoms real[],
+  result jsonb,
+  error text,
+  created_at timestamp with time zone default now() not null,
+  primary key (version, digest)
+);
+
+-- Progress of each run (listing offset or last retried digest) for resuming
+create table if not exists public.reanalysis_runs (
+  run_id text primary key,
+  version text not null,
+  cursor text,
+  stats jsonb not null,
+  done boolean default false not null,
+  updated_at timestamp with time zone default now() not null
+);
+
+-- Service role only
+alter table public.analysis_reanalysis enable row level security;
+alter table public.reanalysis_runs enable row level security;
+
 
 -- SEED DATA
 -- Categories
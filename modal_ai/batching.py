@@ -0,0 +1,74 @@
+# 微批处理: 把短时间内并发到达的单个请求合并成一批处理
+#
+# TongueAnalyzer 用它合并同一个 Gemini 模型的调用: 一批图片放进一次 generate_content，
+# 共用一次限流令牌、一个并发位和一次往返 (见 main.py 中的 _generate_batch)。
+
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+class MicroBatcher:
+    """
+    收集并发的单个请求，凑满 max_batch_size 或等待 max_wait_ms 后一起交给 handler。
+
+    handler 接收一个 item 列表，返回等长的结果列表 (顺序一一对应)。
+    结果为 Exception 实例时，只有对应的调用方会收到该异常；handler 抛出异常时整批都收到。
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[list], Awaitable[list]],
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10,
+    ):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, item: Any) -> Any:
+        """提交单个 item，等待它所在批次完成后返回对应结果"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait_ms / 1000, self._flush)
+
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._pending:
+            batch = self._pending[: self.max_batch_size]
+            self._pending = self._pending[self.max_batch_size :]
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]) -> None:
+        items = [item for item, _ in batch]
+        try:
+            results = await self.handler(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"Batch handler returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,235 @@
+# 本地舌象特征预分类: 在调用 Gemini 之前，用 NumPy 在 CPU 上计算颜色和纹理统计
+#
+# 用途:
+#   1. 拒绝无法使用的图片 (过暗 / 过曝 / 模糊 / 画面中没有舌头)，直接返回可操作的提示，不浪费一次模型调用
+#   2. 把测量值作为参考附加到提示词中，模型不必从头估计颜色和舌苔
+#   3. 本地模式 (TONGUE_LOCAL_ONLY=1): 不调用任何网络服务，直接由这些特征得到结果，用于高负载降级
+#
+# 所有统计都在缩小到 FEATURE_EDGE 的图片上向量化计算，1024px 输入单张耗时约 15-20 毫秒。
+# 阈值是经验值，没有经过临床数据校准；本地模式的结果只作为降级使用。
+
+import os
+from dataclasses import asdict, dataclass
+
+import numpy as np
+from PIL import Image
+
+from backend.analysis_core import SYMPTOM_RANGES, build_result, get_profile
+
+# 计算特征时图片的最长边 (像素)
+FEATURE_EDGE = 256
+# 是否拒绝无法使用的图片
+PRECHECK_ENABLED = os.environ.get("PRECHECK", "1") == "1"
+# 清晰度下限: FEATURE_EDGE 尺寸下最强边缘的拉普拉斯响应 (0-255)。
+# 清晰照片通常在 20 以上，高斯模糊半径 2px (FEATURE_EDGE 尺寸下) 约降到 5
+MIN_SHARPNESS = float(os.environ.get("PRECHECK_MIN_SHARPNESS", "6"))
+# 舌头区域至少占画面的比例
+MIN_TONGUE_FRACTION = float(os.environ.get("PRECHECK_MIN_TONGUE", "0.02"))
+# 平均亮度范围 (0-255)
+MIN_BRIGHTNESS = 35
+MAX_BRIGHTNESS = 235
+
+# 本地模式结果的版本号 (写入 analysis_logs，不进入结果缓存)
+LOCAL_VERSION = "local-v1"
+
+
+class UnusableImageError(Exception):
+    """图片无法用于舌诊；message 是给用户看的重拍提示"""
+
+    def __init__(self, message: str, reason: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+@dataclass
+class TongueStats:
+    """舌头区域的颜色和纹理统计，比例类数值均在 0-1 之间"""
+    brightness: float       # 全图平均亮度 (0-255)
+    sharpness: float        # 全图灰度拉普拉斯响应的 99.5 分位 (只看最强的边缘，不受大片平滑背景影响)
+    tongue_fraction: float  # 舌体像素占全图比例
+    redness: float          # 舌体平均红色程度 (R 高出 G/B 的幅度)
+    pallor: float           # 舌体中淡白像素的比例
+    purple: float           # 舌体偏紫 (B 高于 G) 的程度
+    coating: float          # 舌苔 (白/黄、低饱和度) 覆盖舌面的比例
+    yellow_coating: float   # 舌苔中偏黄的比例
+    coating_patchiness: float  # 舌苔的破碎程度，成片剥落时升高 (剥苔)
+    crack_density: float    # 舌体内部强边缘 (裂纹) 的密度
+    edge_roughness: float   # 舌体轮廓相对平滑椭圆的粗糙程度 (齿痕)
+
+    def as_dict(self) -> dict:
+        return {name: round(float(value), 3) for name, value in asdict(self).items()}
+
+
+def _small_rgb(img: Image.Image) -> np.ndarray:
+    small = img.copy()
+    small.thumbnail((FEATURE_EDGE, FEATURE_EDGE), Image.Resampling.BILINEAR)
+    return np.asarray(small.convert("RGB"), dtype=np.float32) / 255.0
+
+
+def _laplacian(gray: np.ndarray) -> np.ndarray:
+    return (
+        gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:] - 4 * gray[1:-1, 1:-1]
+    )
+
+
+def _majority(mask: np.ndarray) -> np.ndarray:
+    """3x3 多数滤波: 去掉噪声造成的零散像素，填平小孔"""
+    padded = np.pad(mask, 1).astype(np.uint8)
+    h, w = mask.shape
+    count = sum(padded[i:i + h, j:j + w] for i in range(3) for j in range(3))
+    return count >= 5
+
+
+def _inner(mask: np.ndarray) -> np.ndarray:
+    """上下左右四个邻居都在 mask 内的像素 (结果比输入每边小 1 像素)"""
+    return mask[1:-1, 1:-1] & mask[:-2, 1:-1] & mask[2:, 1:-1] & mask[1:-1, :-2] & mask[1:-1, 2:]
+
+
+def extract_features(img: Image.Image) -> TongueStats:
+    """计算舌象统计 (img 为预处理后的 RGB 图片)"""
+    rgb = _small_rgb(img)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    gray = 0.299 * r + 0.587 * g + 0.114 * b
+    lap = _laplacian(gray)
+    sharpness = float(np.percentile(np.abs(lap), 99.5) * 255)
+
+    value = rgb.max(axis=2)
+    saturation = (value - rgb.min(axis=2)) / np.maximum(value, 1e-6)
+
+    # 舌体: 红色 (G 远低于 R)，或偏粉 (B 与 G 接近或更高，包含淡白舌) 的像素。
+    # 皮肤的 G 接近 R 且偏黄 (B 明显低于 G)，两个条件都不满足
+    red = g < 0.62 * r
+    pink = (r - g > 0.1) & (b > g - 0.06)
+    body = _majority((r > 0.4) & (red | pink))
+    # 舌苔: 明亮、低饱和度的白苔，或 R/G 接近、B 明显偏低的黄苔
+    white = (value > 0.6) & (saturation < 0.22)
+    yellow = (r > 0.5) & (g > 0.45) & (np.abs(r - g) < 0.12) & (b < g - 0.12)
+    coat = _majority(white | yellow) & ~body
+
+    body_px = int(body.sum())
+    total = body.size
+    tongue_fraction = body_px / total
+
+    if body_px == 0:
+        return TongueStats(
+            brightness=float(gray.mean() * 255),
+            sharpness=sharpness,
+            tongue_fraction=0.0,
+            redness=0.0, pallor=0.0, purple=0.0, coating=0.0, yellow_coating=0.0,
+            coating_patchiness=0.0, crack_density=0.0, edge_roughness=0.0,
+        )
+
+    # 只统计舌体外接矩形内的舌苔，避免把背景中的白色物体算进去
+    rows = np.flatnonzero(body.any(axis=1))
+    cols = np.flatnonzero(body.any(axis=0))
+    top, bottom, left, right = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    region_body = body[top:bottom, left:right]
+    region_coat = coat[top:bottom, left:right]
+    coat_px = int(region_coat.sum())
+    surface = body_px + coat_px
+
+    # 舌苔破碎程度: 舌苔边界像素数 / 同面积圆的周长。一整块约为 1，分成 k 块约为 sqrt(k)
+    coat_edge = coat_px - int(_inner(np.pad(region_coat, 1)).sum())
+
+    # 裂纹: 舌体内部拉普拉斯响应强的暗线。去掉舌体边缘两圈像素，
+    # 避免与舌苔、嘴唇交界处的过渡像素被当成裂纹
+    inner = _inner(body)
+    core = _inner(np.pad(inner, 1))
+    core_px = max(int(core.sum()), 1)
+    cracks = core & (lap > 0.12)
+
+    # 轮廓粗糙度: 舌面 (舌体 + 舌苔) 左右外缘逐行的周长 / 外接矩形内切椭圆周长 (Ramanujan 近似)。
+    # 只看每行最外侧的像素，舌面内部的反光或空洞不影响结果；齿痕表现为两侧边缘的反复凹凸
+    surface_mask = region_body | region_coat
+    filled = surface_mask.any(axis=1)
+    lefts = surface_mask[filled].argmax(axis=1)
+    rights = surface_mask.shape[1] - surface_mask[filled, ::-1].argmax(axis=1)
+    boundary = np.abs(np.diff(lefts)).sum() + np.abs(np.diff(rights)).sum() + 2 * len(lefts)
+    a, c = (right - left) / 2, (bottom - top) / 2
+    ellipse = np.pi * (3 * (a + c) - np.sqrt((3 * a + c) * (a + 3 * c)))
+
+    # 每个舌体像素 R 高出 G/B 的幅度: 淡白舌约 0.2，淡红舌约 0.4，红舌 0.55 以上
+    body_g, body_b = g[body], b[body]
+    excess = r[body] - np.maximum(body_g, body_b)
+    return TongueStats(
+        brightness=float(gray.mean() * 255),
+        sharpness=sharpness,
+        tongue_fraction=tongue_fraction,
+        redness=float(np.clip(excess.mean() / 0.6, 0, 1)),
+        pallor=float(((excess < 0.28) & (value[body] > 0.7)).mean()),
+        purple=float(np.clip((body_b - body_g).mean() / 0.2, 0, 1)),
+        coating=coat_px / surface,
+        yellow_coating=float((region_coat & yellow[top:bottom, left:right]).sum() / coat_px) if coat_px else 0.0,
+        coating_patchiness=float(coat_edge / (2 * np.sqrt(np.pi * coat_px))) if coat_px else 0.0,
+        crack_density=int(cracks.sum()) / core_px,
+        edge_roughness=float(boundary / ellipse) if ellipse > 0 else 0.0,
+    )
+
+
+def check_usable(stats: TongueStats) -> None:
+    """图片无法用于舌诊时抛出 UnusableImageError (PRECHECK=0 时不检查)"""
+    if not PRECHECK_ENABLED:
+        return
+    if stats.brightness < MIN_BRIGHTNESS:
+        raise UnusableImageError("Photo is too dark. Please retake it in brighter, natural light.", "too_dark")
+    if stats.brightness > MAX_BRIGHTNESS:
+        raise UnusableImageError("Photo is overexposed. Please avoid direct flash or strong backlight.", "overexposed")
+    if stats.sharpness < MIN_SHARPNESS:
+        raise UnusableImageError("Photo is too blurry. Hold the camera steady and retake it.", "blurry")
+    if stats.tongue_fraction < MIN_TONGUE_FRACTION:
+        raise UnusableImageError(
+            "No tongue found in the photo. Stick your tongue out and center it in the frame.", "no_tongue"
+        )
+
+
+def tongue_features(stats: TongueStats) -> dict:
+    """把统计值映射为 tongue_features (与 backend.analysis_core.FEATURE_NAMES 一致)"""
+    return {
+        "teeth_marks": stats.edge_roughness > 1.3,
+        "pale_white": stats.pallor > 0.5,
+        "red": stats.redness > 0.8,
+        "cracked": stats.crack_density > 0.02,
+        "peeling": 0.1 < stats.coating < 0.7 and stats.coating_patchiness > 1.8,
+    }
+
+
+def prompt_hint(stats: TongueStats) -> str:
+    """附加在提示词后的本地测量值，供模型参考 (最终判断仍以图片为准)"""
+    features = tongue_features(stats)
+    return (
+        "Pre-computed measurements of the tongue region (0-1 scales, for reference; trust the image if they disagree): "
+        f"redness {stats.redness:.2f}, pallor {stats.pallor:.2f}, purple tint {stats.purple:.2f}, "
+        f"coating coverage {stats.coating:.2f} (yellow share {stats.yellow_coating:.2f}, fragmentation {stats.coating_patchiness:.1f}), "
+        f"crack density {stats.crack_density:.3f}, edge roughness {stats.edge_roughness:.2f}. "
+        f"Heuristic tongue_features: {', '.join(name for name, on in features.items() if on) or 'none'}."
+    )
+
+
+def _constitution(stats: TongueStats, features: dict) -> str:
+    """按中医舌诊的常见对应关系，从特征推断体质 (规则按优先级排列)"""
+    if stats.purple > 0.5:
+        return "Blood Stasis"
+    if features["red"] and stats.coating > 0.3 and stats.yellow_coating > 0.5:
+        return "Damp Heat"
+    if features["red"] and (features["cracked"] or stats.coating < 0.1):
+        return "Yin Deficiency"
+    if stats.coating > 0.45:
+        return "Phlegm Dampness"
+    if features["pale_white"]:
+        return "Yang Deficiency" if stats.coating > 0.25 else "Qi Deficiency"
+    if features["teeth_marks"]:
+        return "Qi Deficiency"
+    return "Balanced"
+
+
+def local_analysis(stats: TongueStats) -> dict:
+    """
+    本地模式: 不调用 Gemini，直接由统计值得到完整结果
+
+    症状概率取各症状范围的中点，再套用体质的典型症状，与 mock_analysis 的结构相同但结果是确定的。
+    """
+    features = tongue_features(stats)
+    constitution = _constitution(stats, features)
+    symptoms = {name: round((low + high) / 2, 2) for name, low, high in SYMPTOM_RANGES}
+    symptoms.update(get_profile(constitution).symptom_overrides)
+    return build_result(constitution, features, symptoms)
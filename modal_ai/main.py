@@ -3,11 +3,28 @@
 # 本地测试: modal serve modal_ai/main.py
 
 import modal
-import os
+import asyncio
+import functools
 import json
-import re
+import os
+import time
+from contextlib import aclosing
+from io import BytesIO
 from typing import Optional
 
+from backend.analysis_core import mock_analysis
+from backend.analysis_log import AnalysisLogRow, log_writer_from_env
+from backend.jobs import JOB_RESULT_TTL, RUNNING, Job, deliver_webhook
+from backend.recommendations import catalog_from_env
+from backend.image_store import SupabaseStore, digest_from_url, store_from_env
+from backend.result_cache import cache_from_env, cache_key, cache_key_for_digest, version_tag
+from backend.sse import SSE_HEADERS, format_sse
+from modal_ai.batching import MicroBatcher
+from modal_ai.parsing import PartialJSONParser, parse_json_array
+from modal_ai.reanalysis import PAGE_SIZE as REANALYSIS_PAGE_SIZE, results_from_dsn, run_reanalysis
+from modal_ai.routing import GEMINI, LOCAL, MOCK, MODEL_COSTS, LiveStats, ModelBackend, ModelRouter, agreement, parse_route
+from modal_ai.upstream import CircuitBreaker, CircuitOpenError, Coalescer, UpstreamBusyError, UpstreamGuard
+
 # =============================================================================
 # 1. 定义 Modal App 和 Image (环境)
 # =============================================================================
@@ -18,9 +35,39 @@ app = modal.App("tongue-analyzer")
 image = modal.Image.debian_slim(python_version="3.11").pip_install(
     "google-generativeai",
     "Pillow",
+    "numpy",
     "requests",
+    "httpx",
     "fastapi",
-)
+    "pydantic",
+    "asyncpg",
+    "prometheus-client",
+    "brotli",
+    "msgpack",
+).add_local_python_source("backend", "modal_ai")
+
+# 重量级依赖只在容器内导入 (本地部署机器不需要安装)。
+# 开启内存快照后，这些导入连同 preload() 的预热结果一起保存进快照，冷启动时直接恢复。
+with image.imports():
+    import google.generativeai as genai
+    import httpx
+    from PIL import Image
+    from fastapi import Request
+    from fastapi.responses import JSONResponse, Response, StreamingResponse
+    from backend.encoding import encoded_response
+    from backend.image_fetch import ImageFetcher, ImageFetchError, decode_base64_image
+    from backend.metrics import Instrumentation, render_metrics
+    from modal_ai.features import (
+        LOCAL_VERSION,
+        UnusableImageError,
+        check_usable,
+        extract_features,
+        local_analysis,
+        prompt_hint,
+    )
+    from modal_ai.preprocess import preprocess_image
+    from modal_ai.schema import RESPONSE_SCHEMA, validate_analysis
+    from modal_ai.validation import AnalyzeBody, BatchBody, JobBody, RequestGate, RequestRejected, parse_body, request_user
 
 # =============================================================================
 # 2. 分析提示词 (TCM Tongue Diagnosis Prompt)
@@ -58,6 +105,100 @@ Analyze the tongue color, shape, coating, moisture, and any special features. Ba
 If the image doesn't show a tongue clearly, still provide reasonable estimates based on what you can see.
 IMPORTANT: Return ONLY the JSON object, no other text."""
 
+# 模型输出未通过校验时的修复提示词 (只发送文本，不再发送图片)
+REPAIR_PROMPT = """Your previous answer to a TCM tongue analysis request could not be used.
+
+Validation error:
+{error}
+
+Previous answer:
+{output}
+
+Return the corrected analysis as ONLY a valid JSON object with exactly these keys:
+constitution, score, tongue_features, symptoms, issues. Keep your original assessment; only fix the format."""
+
+# 多张图片合并为一次 Gemini 调用时放在最前面的提示词 (每张图片前有 "Image N:" 标签，
+# 后面跟着该图片自己的特征参考)；要求的对象格式与 ANALYSIS_PROMPT 相同，所以共用缓存版本
+BATCH_PROMPT = ANALYSIS_PROMPT.replace("{", "{{").replace("}", "}}").replace(
+    "Analyze this tongue image and provide a structured assessment. Return ONLY a valid JSON object with the following structure",
+    "Analyze each tongue image and provide a structured assessment. Each assessment is a JSON object with the following structure",
+).replace(
+    "IMPORTANT: Return ONLY the JSON object, no other text.",
+    """You will receive {count} tongue images, each introduced by a label "Image N:".
+Analyze each image independently.
+IMPORTANT: Return ONLY a JSON array with exactly {count} objects in the structure above, one per image, in the same order as the images, no other text.""",
+)
+
+# 把本地特征统计 (modal_ai/features.py) 作为参考附加到提示词中
+FEATURE_HINTS = os.environ.get("GEMINI_FEATURE_HINTS", "1") == "1"
+# 本地模式: 只用本地特征统计得出结果，不调用 Gemini (高负载时的降级开关)
+LOCAL_ONLY = os.environ.get("TONGUE_LOCAL_ONLY", "0") == "1"
+
+# 模型路由 (modal_ai/routing.py): 按优先顺序的后端 "名称[:每次调用的相对成本]"，逗号分隔；
+# 可以是任意 Gemini 模型名、local (本地特征统计，不调用网络) 或 mock
+MODEL_ROUTE = parse_route(os.environ.get("MODEL_ROUTE", "gemini-2.0-flash-exp"))
+# 首选 Gemini 模型 + 提示词哈希 作为缓存版本，修改任一项都会使旧缓存失效
+MODEL_NAME = next((name for name, _ in MODEL_ROUTE if name not in (LOCAL, MOCK)), "gemini-2.0-flash-exp")
+PROMPT_TAG = ANALYSIS_PROMPT + ("\n[feature-hints-v1]" if FEATURE_HINTS else "")
+CACHE_VERSION = version_tag(MODEL_NAME, PROMPT_TAG)
+# 模拟结果在 analysis_logs 中使用的版本号
+MOCK_VERSION = "mock"
+# 路由依据: 最近 MODEL_STATS_WINDOW 秒内 p95 延迟超过 MODEL_LATENCY_SLO 秒 (0 = 不按延迟切换)
+# 或错误率超过 MODEL_MAX_ERROR_RATE 的模型暂时跳过；MODEL_COST_BUDGET 为每个容器每小时的成本上限 (0 = 不限)
+MODEL_LATENCY_SLO = float(os.environ.get("MODEL_LATENCY_SLO", "0"))
+MODEL_MAX_ERROR_RATE = float(os.environ.get("MODEL_MAX_ERROR_RATE", "0.5"))
+MODEL_STATS_WINDOW = float(os.environ.get("MODEL_STATS_WINDOW", "60"))
+MODEL_COST_BUDGET = float(os.environ.get("MODEL_COST_BUDGET", "0"))
+# 影子路由: 按 SHADOW_RATE 的比例在后台用 SHADOW_MODEL 再分析一次，一致程度写入 analysis_logs 供离线对比
+SHADOW_MODEL = os.environ.get("SHADOW_MODEL", "")
+SHADOW_RATE = float(os.environ.get("SHADOW_RATE", "0"))
+SHADOW_DEADLINE = float(os.environ.get("SHADOW_DEADLINE", "30"))
+
+# 使用 Gemini 结构化输出 (JSON mode + response_schema)
+STRUCTURED_OUTPUT = os.environ.get("GEMINI_STRUCTURED_OUTPUT", "1") == "1"
+# 输出未通过校验时修复重试的超时 (秒)，只重试一次
+REPAIR_TIMEOUT = float(os.environ.get("PARSE_REPAIR_TIMEOUT", "20"))
+
+# Gemini 调用保护 (每个容器、每个模型): 每秒请求数 / 突发上限 / 同时进行的调用数 / 重试次数
+GEMINI_RPS = float(os.environ.get("GEMINI_RPS", "10"))
+GEMINI_BURST = int(os.environ.get("GEMINI_BURST", "20"))
+GEMINI_MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", "16"))
+GEMINI_MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", "3"))
+# 单次分析中排队、调用和重试的总时间预算 (秒)，需小于类的 timeout
+MODEL_DEADLINE = float(os.environ.get("MODEL_DEADLINE", "60"))
+
+# 熔断器 (每个容器): 最近 BREAKER_WINDOW 秒内至少 BREAKER_MIN_CALLS 次调用，
+# 且失败率或慢调用 (≥ BREAKER_SLOW_SECONDS) 比例达到阈值时打开，BREAKER_COOLDOWN 秒后放行一次探测
+BREAKER_WINDOW = float(os.environ.get("BREAKER_WINDOW", "60"))
+BREAKER_MIN_CALLS = int(os.environ.get("BREAKER_MIN_CALLS", "10"))
+BREAKER_ERROR_RATE = float(os.environ.get("BREAKER_ERROR_RATE", "0.5"))
+BREAKER_SLOW_SECONDS = float(os.environ.get("BREAKER_SLOW_SECONDS", "20"))
+BREAKER_SLOW_RATE = float(os.environ.get("BREAKER_SLOW_RATE", "0.5"))
+BREAKER_COOLDOWN = float(os.environ.get("BREAKER_COOLDOWN", "30"))
+# 模型不可用时，没有 (过期) 缓存结果的请求是否用本地特征统计给出结果；设为 0 时直接返回 "稍后重试"
+DEGRADE_TO_LOCAL = os.environ.get("DEGRADE_TO_LOCAL", "1") == "1"
+
+# 微批处理 (modal_ai/batching.py): 同一容器内并发的非流式 Gemini 调用最多等待 BATCH_MAX_WAIT_MS 毫秒，
+# 每 BATCH_MAX_SIZE 张图片合并为一次多图 generate_content (0 = 不合并)；
+# BATCH_MAX_SIZE 同时也是 /analyze_batch 每个容器同时处理的图片数
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "10"))
+# /analyze_batch 单次请求最多图片数
+BATCH_MAX_URLS = int(os.environ.get("BATCH_MAX_URLS", "100"))
+
+# 预热与冷启动配置 (在执行 modal deploy 的机器上读取)
+# 常驻热容器数 (0 = 空闲时全部缩容)
+MIN_CONTAINERS = int(os.environ.get("TONGUE_MIN_CONTAINERS", "1"))
+# 最后一个请求结束后容器继续保留的秒数
+SCALEDOWN_WINDOW = int(os.environ.get("TONGUE_SCALEDOWN_WINDOW", "300"))
+# 单个容器同时处理的请求数 (请求大部分时间在等待 Gemini 返回)
+MAX_INPUTS = int(os.environ.get("TONGUE_MAX_INPUTS", str(BATCH_MAX_SIZE * 4)))
+# 是否使用内存快照加速冷启动
+MEMORY_SNAPSHOT = os.environ.get("TONGUE_MEMORY_SNAPSHOT", "1") == "1"
+
+# 异步任务记录: "job:<id>" → Job.as_dict()，"key:<Idempotency-Key>" → job id
+jobs = modal.Dict.from_name("tongue-analyzer-jobs", create_if_missing=True)
+
 # =============================================================================
 # 3. 定义 TongueAnalyzer 类
 # =============================================================================
@@ -66,230 +207,1027 @@ IMPORTANT: Return ONLY the JSON object, no other text."""
     image=image,
     secrets=[modal.Secret.from_name("tongue-analyzer-secrets")],
     timeout=120,
+    min_containers=MIN_CONTAINERS,
+    scaledown_window=SCALEDOWN_WINDOW,
+    enable_memory_snapshot=MEMORY_SNAPSHOT,
 )
+@modal.concurrent(max_inputs=MAX_INPUTS)
 class TongueAnalyzer:
     """舌象分析器类 - 使用 Google Gemini Vision API"""
     
-    @modal.enter()
-    def load_model(self):
-        """容器启动时初始化 Gemini 客户端"""
-        import google.generativeai as genai
+    @modal.enter(snap=True)
+    def preload(self):
+        """
+        预热: 用一张小图走一遍预处理，让 PIL 编解码器和 NumPy 完成初始化
         
+        开启内存快照时只在生成快照时执行一次，之后的冷启动直接从快照恢复。
+        """
+        started = time.perf_counter()
+        buffer = BytesIO()
+        Image.new("RGB", (64, 64), (200, 80, 80)).save(buffer, format="JPEG")
+        preprocess_image(buffer.getvalue())
+        print(f"🔥 Preloaded dependencies in {(time.perf_counter() - started) * 1000:.0f}ms")
+    
+    @modal.enter(snap=False)
+    def load_model(self):
+        """容器启动 (或从快照恢复) 后初始化 Gemini 客户端等带网络连接的对象"""
         print("🔄 Initializing Google Gemini Vision...")
         
+        # 结果缓存 (RESULT_CACHE=memory/sqlite/off)
+        self.cache = cache_from_env()
+        # 图片下载共用一个 keep-alive 连接池，容器保持热启动时复用连接
+        self.fetcher = ImageFetcher()
+        # 各阶段耗时、缓存命中、降级次数等 Prometheus 指标
+        self.metrics = Instrumentation("modal_ai")
+        # 相同图片的请求合并
+        self.coalescer = Coalescer()
+        # 后台运行中的影子分析
+        self._shadow_tasks = set()
+        # 每个 Gemini 后端一个微批处理器 (第一次调用时创建)
+        self._batchers = {}
+        
+        # 认证 token 和图片地址白名单只在启动时读取一次
+        gate = request_gate()
+        if not gate.restricts_urls:
+            print("⚠️ IMAGE_URL_PREFIXES / SUPABASE_URL not set, image_url is not restricted")
+        
         api_key = os.environ.get("GEMINI_API_KEY")
-        if not api_key:
+        if api_key:
+            genai.configure(api_key=api_key)
+        else:
             print("⚠️ GEMINI_API_KEY not set, falling back to mock mode")
-            self.model = None
-            return
         
-        genai.configure(api_key=api_key)
+        # 模型注册表: 路由中的后端 + 影子模型，没有 API Key 时 Gemini 模型不可用
+        backends = {}
+        for name, cost in MODEL_ROUTE + ([(SHADOW_MODEL, None)] if SHADOW_MODEL else []):
+            if name not in backends:
+                backend = self._backend(name, cost, api_key)
+                if backend is not None:
+                    backends[name] = backend
+        route = [backends[name] for name, _ in MODEL_ROUTE if name in backends]
+        if not route:
+            route = [ModelBackend(MOCK, MOCK, MOCK_VERSION)]
+        self.router = ModelRouter(
+            route,
+            latency_slo=MODEL_LATENCY_SLO,
+            max_error_rate=MODEL_MAX_ERROR_RATE,
+            budget=MODEL_COST_BUDGET,
+            shadow=backends.get(SHADOW_MODEL),
+            shadow_rate=SHADOW_RATE,
+            on_route=self.metrics.routed,
+        )
+        print(f"✅ Model route: {' → '.join(b.name for b in route)}" + (f" (shadow: {SHADOW_MODEL})" if SHADOW_MODEL else ""))
+    
+    def _backend(self, name: str, cost: Optional[float], api_key: Optional[str]) -> Optional[ModelBackend]:
+        """注册表中的一个后端；Gemini 模型各有一份限流 / 并发 / 重试 / 熔断 (UpstreamGuard)"""
+        stats = LiveStats(MODEL_STATS_WINDOW)
+        if name == LOCAL:
+            return ModelBackend(LOCAL, LOCAL, LOCAL_VERSION, stats=stats)
+        if name == MOCK:
+            return ModelBackend(MOCK, MOCK, MOCK_VERSION, stats=stats)
+        if not api_key:
+            return None
         
-        # 使用 Gemini 2.0 Flash (最新快速模型)
-        self.model = genai.GenerativeModel("gemini-2.0-flash-exp")
-        print("✅ Gemini 2.0 Flash initialized successfully")
+        # 结构化输出模式下只返回符合 RESPONSE_SCHEMA 的 JSON
+        generation_config = None
+        if STRUCTURED_OUTPUT:
+            generation_config = genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=RESPONSE_SCHEMA,
+            )
+        upstream = UpstreamGuard(
+            rate=GEMINI_RPS,
+            burst=GEMINI_BURST,
+            max_concurrency=GEMINI_MAX_CONCURRENCY,
+            max_retries=GEMINI_MAX_RETRIES,
+            on_event=self.metrics.upstream_event,
+            breaker=CircuitBreaker(
+                window=BREAKER_WINDOW,
+                min_calls=BREAKER_MIN_CALLS,
+                error_rate=BREAKER_ERROR_RATE,
+                slow_call=BREAKER_SLOW_SECONDS,
+                slow_rate=BREAKER_SLOW_RATE,
+                cooldown=BREAKER_COOLDOWN,
+                on_transition=lambda state: self._circuit_changed(name, state),
+            ),
+        )
+        return ModelBackend(
+            name,
+            GEMINI,
+            version_tag(name, PROMPT_TAG),
+            cost=cost if cost is not None else MODEL_COSTS.get(name, 1.0),
+            model=genai.GenerativeModel(name, generation_config=generation_config),
+            upstream=upstream,
+            stats=stats,
+        )
+    
+    def _circuit_changed(self, model: str, state: str) -> None:
+        print(f"⚡ {model} circuit breaker → {state}")
+        self.metrics.circuit_state(model, state)
+    
+    @modal.enter()
+    async def start_log_writer(self):
+        """启动 analysis_logs 后台批量写入 (ANALYSIS_LOG_DSN 未设置时不记录)"""
+        self.log_writer = log_writer_from_env()
+        if self.log_writer is not None:
+            await self.log_writer.start()
+    
+    @modal.exit()
+    async def stop_log_writer(self):
+        """容器退出前把队列中剩余的记录全部写入数据库"""
+        if self.log_writer is not None:
+            await self.log_writer.stop()
+    
+    @modal.enter()
+    async def start_catalog(self):
+        """从 products/categories 表 (CATALOG_DSN) 加载推荐索引，之后在后台增量刷新"""
+        self.catalog = catalog_from_env()
+        await self.catalog.start()
+    
+    @modal.exit()
+    async def stop_catalog(self):
+        await self.catalog.stop()
     
     @modal.method()
-    def analyze(self, image_url: str) -> dict:
+    async def analyze(self, image_url: str, user_id: Optional[str] = None) -> dict:
         """
         分析舌象图片
         
         Args:
             image_url: 图片的 URL 地址
+            user_id: 用户 ID (可选，写入 analysis_logs)
             
         Returns:
             分析结果字典
         """
-        import requests
-        from PIL import Image
-        from io import BytesIO
-        import random
+        return await self._analyze(image_url, user_id)
+    
+    @modal.method()
+    async def analyze_batch(self, image_urls: list[str], user_ids: Optional[list] = None) -> list[dict]:
+        """
+        批量分析多张图片 (一次容器调用，最多 BATCH_MAX_SIZE 张并发处理)
         
-        print(f"📸 Fetching image from: {image_url[:80]}...")
+        Args:
+            image_urls: 图片 URL 列表
+            user_ids: 与 image_urls 一一对应的用户 ID 列表 (可选)
+            
+        Returns:
+            与 image_urls 顺序一致的结果列表，每项为
+            {"success": True, "data": ...} 或 {"success": False, "error": ...}
+            单张图片失败不影响同批次的其他图片
+        """
+        return await self._analyze_many(image_urls, user_ids)
+    
+    async def _analyze_many(self, image_urls: list[str], user_ids: Optional[list] = None) -> list[dict]:
+        """并发分析多张图片 (最多 BATCH_MAX_SIZE 张同时进行)"""
+        semaphore = asyncio.Semaphore(BATCH_MAX_SIZE)
         
+        user_ids = user_ids or [None] * len(image_urls)
+        
+        async def run_one(image_url: str, user_id: Optional[str]) -> dict:
+            async with semaphore:
+                return await self._analyze_one(image_url, user_id)
+        
+        return await asyncio.gather(*(run_one(url, uid) for url, uid in zip(image_urls, user_ids)))
+    
+    async def _analyze_one(self, image_url: Optional[str], user_id: Optional[str], image_bytes: Optional[bytes] = None) -> dict:
+        """单张图片分析，结果包装成 {"success": ..., "data" / "error": ...}"""
+        return await self._outcome(self._analyze(image_url, user_id, image_bytes))
+    
+    async def _outcome(self, analysis) -> dict:
+        """等待一次分析，把结果或错误包装成 {"success": ..., "data" / "error": ...}"""
         try:
-            # 下载图片
-            response = requests.get(image_url, timeout=30)
-            response.raise_for_status()
-            img = Image.open(BytesIO(response.content)).convert("RGB")
-            
-            # 如果没有 Gemini API Key，使用模拟模式
-            if self.model is None:
-                print("⚠️ Using mock analysis (no API key)")
-                return self._mock_analyze()
-            
-            # 使用 Gemini Vision 分析
-            print("🧠 Analyzing with Gemini Vision...")
-            
-            response = self.model.generate_content([ANALYSIS_PROMPT, img])
-            
-            # 解析 JSON 响应
-            result_text = response.text.strip()
-            
-            # 清理可能的 markdown 代码块
-            if result_text.startswith("```"):
-                result_text = re.sub(r'^```json?\s*', '', result_text)
-                result_text = re.sub(r'\s*```$', '', result_text)
+            return {"success": True, "data": await analysis}
+        except UpstreamBusyError as e:
+            # Gemini 限流或暂时不可用: 告诉客户端多久后重试
+            return {"success": False, "error": str(e), "retry_after": e.retry_after}
+        except UnusableImageError as e:
+            # 图片无法使用: 返回重拍提示
+            return {"success": False, "error": str(e), "reason": e.reason}
+        except Exception as e:
+            return {"success": False, "error": f"Analysis failed: {str(e)}"}
+    
+    @modal.method()
+    async def reanalyze(self, image_url: str) -> dict:
+        """
+        重新分析一张历史图片 (modal_ai/reanalysis.py 通过 .map() 批量调用)
+        
+        与 analyze 相同的缓存、模型路由和降级，但不写 analysis_logs、不附加推荐
+        
+        Returns:
+            {"success": True, "data": 结果, "version": 实际给出结果的模型版本}
+            或 {"success": False, "error": ...}
+        """
+        async with self.metrics.request("reanalyze"):
+            outcome = await self._outcome(self._rescore(image_url))
+        if outcome["success"]:
+            outcome["data"], outcome["version"] = outcome["data"]
+        return outcome
+    
+    async def _rescore(self, image_url: str) -> tuple[dict, str]:
+        with self.metrics.stage("download"):
+            image_bytes = await self.fetcher.fetch_bytes(image_url)
+        key = cache_key(image_bytes, CACHE_VERSION)
+        if self.cache is not None:
+            # 只有首选模型给出的条目算命中: 记成 CACHE_VERSION 的重新评分必须真的来自当前模型
+            cached = self._cached(key)
+            self.metrics.cache_lookup(cached is not None)
+            if cached is not None:
+                return {**cached, "cached": True}, CACHE_VERSION
+        deadline = asyncio.get_running_loop().time() + MODEL_DEADLINE
+        async for event, data in self._infer(image_bytes, key, False, deadline):
+            if event == "result":
+                return data
+    
+    @modal.method()
+    async def analyze_stream(self, image_url: str, user_id: Optional[str] = None):
+        """
+        流式分析舌象图片，每完成一个阶段产出一个事件
+        
+        事件依次为: fetched → preprocessed → model_started → field (逐个字段) → result
+        命中缓存时 fetched 之后直接产出 result
+        
+        Yields:
+            {"event": 事件名, "data": 事件数据}
+        """
+        async with self.metrics.request("stream"):
+            async with aclosing(self._pipeline(image_url, user_id, stream=True)) as events:
+                async for event, data in events:
+                    yield {"event": event, "data": data}
+    
+    @modal.method()
+    async def run_job(self, job_id: str) -> None:
+        """
+        执行一个异步任务 (由 submit_job 通过 .spawn() 提交)
+        
+        结果写回 jobs 字典，保留 JOB_RESULT_TTL 秒；提供了 webhook_url 时把完成的任务 POST 过去
+        """
+        data = await jobs.get.aio(f"job:{job_id}")
+        if data is None:
+            return
+        job = Job.from_dict(data)
+        if job.finished:
+            return
+        
+        job.status = RUNNING
+        job.updated_at = time.time()
+        await jobs.put.aio(f"job:{job.id}", job.as_dict())
+        
+        try:
+            job.finish(JOB_RESULT_TTL, result=await self._analyze(job.image_url, job.user_id))
+        except Exception as e:
+            print(f"❌ Job {job.id} failed: {e}")
+            job.finish(JOB_RESULT_TTL, error=str(e) or type(e).__name__)
+        await jobs.put.aio(f"job:{job.id}", job.as_dict())
+        
+        if job.webhook_url:
+            async with httpx.AsyncClient() as client:
+                await deliver_webhook(client, job.webhook_url, job.public())
+    
+    # -------------------------------------------------------------------------
+    # Web 端点: 直接由本类的热容器处理，不再经过一层函数容器转发
+    # URL 与之前的独立函数端点保持一致 (label)，前端的 MODAL_API_URL 无需修改
+    # -------------------------------------------------------------------------
+    
+    @modal.fastapi_endpoint(method="POST", docs=True, label="tongue-analyzer-analyze-tongue")
+    async def analyze_tongue(self, http_request: "Request"):
+        """
+        Web API 端点 - 接收图片分析请求
+        
+        请求格式:
+        POST /analyze_tongue
+        Headers:
+            Authorization: Bearer <YOUR_API_TOKEN>
+            X-User-Token: <可选，用户的 Supabase access token，结果记录到该用户的历史>
+            Content-Type: application/json
+        Body:
+            {
+                "image_url": "https://example.com/image.jpg"
+            }
+        
+        也可以直接上传图片，省去 Storage 上传再下载的往返:
+            {
+                "image_base64": "<base64 编码的图片，最大 UPLOAD_MAX_BYTES>",
+                "image_url": "<可选，客户端随后持久化的地址，只记录在 analysis_logs>"
+            }
+        
+        响应按 Accept 返回 JSON / 紧凑 JSON / MessagePack，并按 Accept-Encoding 压缩 (backend/encoding.py)
+        
+        认证失败返回 401，请求体无效或 image_url 不在允许的 bucket 中返回 400 (modal_ai/validation.py)
+        """
+        # 认证和请求校验: 不通过时立即返回，不下载图片也不调用模型
+        try:
+            body, user_id = await _accept(http_request, AnalyzeBody)
+        except RequestRejected as e:
+            return _rejected(e)
+        
+        image_url = body.image_url
+        
+        try:
+            image_bytes = _uploaded_image(body)
+        except ImageFetchError as e:
+            return {"success": False, "error": str(e)}
+        
+        # 缓存命中和相同图片 (coalescer) 直接返回；只有真正的 Gemini 调用在 _generate 中凑批
+        result = await self._analyze_one(image_url, user_id, image_bytes)
+        
+        return encoded_response(result, http_request.headers.get("accept"), http_request.headers.get("accept-encoding"))
+    
+    @modal.fastapi_endpoint(method="GET", label="tongue-analyzer-result")
+    async def result(self, result_id: str, http_request: "Request"):
+        """
+        按分析响应中的 result_id 取回结果 (附带当前的推荐产品)
+        
+        result_id 是写入 analysis_logs 时随机生成的 ID，与图片内容无关、不可推算，持有它即可查询 (不需要 API token)；
+        结果从 analysis_logs 读取，任何容器都能返回 (记录在 ANALYSIS_LOG_FLUSH_INTERVAL 内写入)。未知 ID 返回 404。
+        前端跳转结果页时只传这个 ID，不再把整个结果放进 URL。
+        """
+        stored = await self.log_writer.result(result_id) if self.log_writer is not None else None
+        if stored is None:
+            return JSONResponse({"success": False, "error": "Result not found"}, status_code=404)
+        
+        result = {"success": True, "data": {**self._recommend({**stored, "cached": True}), "result_id": result_id}}
+        return encoded_response(result, http_request.headers.get("accept"), http_request.headers.get("accept-encoding"))
+    
+    @modal.fastapi_endpoint(method="GET", label="tongue-analyzer-catalog")
+    def product_catalog(self):
+        """紧凑响应中按 ID 引用的产品信息和推荐理由"""
+        return JSONResponse(self.catalog.index.catalog, headers={"Cache-Control": "public, max-age=300"})
+    
+    @modal.fastapi_endpoint(method="POST", docs=True, label="tongue-analyzer-analyze-tongue-stream")
+    async def analyze_tongue_stream(self, http_request: "Request"):
+        """
+        流式分析端点 - 以 Server-Sent Events 逐阶段返回进度
+        
+        请求格式与 /analyze_tongue 相同，响应为 text/event-stream:
+            event: fetched / preprocessed / model_started / field / result / error
+            data: <JSON>
+        
+        客户端断开连接时关闭分析流程，容器不再为该请求继续工作。
+        """
+        try:
+            body, user_id = await _accept(http_request, AnalyzeBody)
+        except RequestRejected as e:
+            return _rejected(e)
+        
+        image_url = body.image_url
+        
+        try:
+            image_bytes = _uploaded_image(body)
+        except ImageFetchError as e:
+            return {"success": False, "error": str(e)}
+        
+        async def events():
+            try:
+                async with self.metrics.request("stream"):
+                    async with aclosing(self._pipeline(image_url, user_id, stream=True, image_bytes=image_bytes)) as pipeline:
+                        async for event, data in pipeline:
+                            yield format_sse(event, data)
+            except UpstreamBusyError as e:
+                yield format_sse("error", {"error": str(e), "retry_after": e.retry_after})
+            except UnusableImageError as e:
+                yield format_sse("error", {"error": str(e), "reason": e.reason})
+            except Exception as e:
+                yield format_sse("error", {"error": f"Analysis failed: {str(e)}"})
+        
+        return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+    
+    @modal.fastapi_endpoint(method="GET", label="tongue-analyzer-metrics", requires_proxy_auth=True)
+    def export_metrics(self):
+        """
+        Prometheus 指标端点 (只包含处理本次请求的容器的数据)
+        
+        需要 Modal proxy auth token: 请求头 Modal-Key / Modal-Secret
+        """
+        body, content_type = render_metrics()
+        return Response(content=body, media_type=content_type)
+    
+    @modal.fastapi_endpoint(method="GET", label="tongue-analyzer-health")
+    def health(self) -> dict:
+        """
+        健康检查端点 (由分析容器处理，URL 与之前相同)
+        
+        circuit 为处理本次请求的容器中首选模型熔断器的状态；熔断打开或半开时 status 为 "degraded"，
+        此时分析请求会路由到其他模型，或返回缓存 / 本地统计结果 (带 "degraded" 字段)。
+        routing 为各模型的实时 p95 延迟、错误率和成本消耗。
+        """
+        primary = self.router.backends[0]
+        circuit = primary.upstream.breaker.snapshot() if primary.upstream is not None else {"state": "closed"}
+        return {
+            "status": "healthy" if circuit["state"] == "closed" else "degraded",
+            "service": "tongue-analyzer",
+            "version": "2.0.0",
+            "model": primary.name,
+            "circuit": circuit,
+            "routing": self.router.snapshot(),
+        }
+    
+    @modal.fastapi_endpoint(method="POST", docs=True, label="tongue-analyzer-jobs")
+    async def submit_job(self, http_request: "Request"):
+        """
+        异步任务端点 - 立即返回 job_id，分析在后台容器中进行
+        
+        请求格式:
+        POST /jobs
+        Headers:
+            Authorization: Bearer <YOUR_API_TOKEN>
+            Idempotency-Key: <可选，相同的 key 返回同一个任务>
+            X-User-Token: <可选，用户的 Supabase access token>
+        Body:
+            {
+                "image_url": "https://example.com/image.jpg",
+                "webhook_url": "<可选，任务完成后 POST 任务结果到该地址>"
+            }
+        
+        之后用 GET /job_status?job_id=<job_id> 轮询结果
+        """
+        try:
+            body, user_id = await _accept(http_request, JobBody)
+        except RequestRejected as e:
+            return _rejected(e)
+        
+        idempotency_key = http_request.headers.get("idempotency-key")
+        job = Job.new(body.image_url, user_id, idempotency_key, body.webhook_url)
+        
+        if idempotency_key:
+            key = f"key:{idempotency_key}"
+            if not await jobs.put.aio(key, job.id, skip_if_exists=True):
+                existing = await jobs.get.aio(f"job:{await jobs.get.aio(key)}")
+                if existing is not None and not Job.from_dict(existing).expired():
+                    return {"success": True, **Job.from_dict(existing).public()}
+                # 旧任务已过期: 这个 key 重新指向新任务
+                await jobs.put.aio(key, job.id)
+        
+        await jobs.put.aio(f"job:{job.id}", job.as_dict())
+        await TongueAnalyzer().run_job.spawn.aio(job.id)
+        return {"success": True, **job.public()}
+    
+    @modal.fastapi_endpoint(method="GET", label="tongue-analyzer-job-status")
+    async def job_status(self, job_id: str) -> dict:
+        """
+        查询异步任务状态: queued / running / done / failed
+        
+        job_id 为随机生成、不可猜测的 ID，持有它即可查询该任务 (不需要 API token)
+        """
+        data = await jobs.get.aio(f"job:{job_id}")
+        if data is None:
+            return {"success": False, "error": "Job not found or expired"}
+        
+        job = Job.from_dict(data)
+        if job.expired():
+            # 过期记录在查询时删除
+            await jobs.pop.aio(f"job:{job_id}", None)
+            return {"success": False, "error": "Job not found or expired"}
+        
+        return {"success": True, **job.public()}
+    
+    async def _analyze(self, image_url: Optional[str], user_id: Optional[str] = None, image_bytes: Optional[bytes] = None) -> dict:
+        """单张图片分析，只返回最终结果"""
+        async with self.metrics.request("analyze"):
+            async with aclosing(self._pipeline(image_url, user_id, stream=False, image_bytes=image_bytes)) as events:
+                async for event, data in events:
+                    if event == "result":
+                        return data
+    
+    def _cached(self, key: str, allow_stale: bool = False) -> Optional[dict]:
+        """
+        缓存中首选模型 (CACHE_VERSION) 的结果
+        
+        条目没有记录模型 (旧版本写入的，可能来自回退模型) 或不是首选模型给出的，都视为未命中
+        """
+        cached = self.cache.get(key, allow_stale=allow_stale)
+        return cached if cached is not None and cached.get("model") == MODEL_NAME else None
+    
+    def _recommend(self, result: dict) -> dict:
+        """附加当前有库存的推荐产品 (内存索引查表)；缓存结果中的推荐不会过时"""
+        with self.metrics.stage("recommendation"):
+            return {**result, **self.catalog.index.recommend(result["constitution"], result["symptoms"])}
+    
+    def _log(self, image_url: str, user_id: Optional[str], result: dict, started: float, version: str) -> dict:
+        """
+        把分析结果放入后台写入队列 (不等待数据库)
+        
+        写入队列成功时返回的结果附带 result_id (GET tongue-analyzer-result 可取回)
+        """
+        if self.log_writer is None:
+            return result
+        row = AnalysisLogRow(
+            user_id=user_id,
+            image_url=image_url,
+            result=result,
+            latency_ms=(time.perf_counter() - started) * 1000,
+            model_version=version,
+        )
+        return {**result, "result_id": row.id} if self.log_writer.record(row) else result
+    
+    async def _parse_response(self, parser: PartialJSONParser, backend: ModelBackend) -> tuple[Optional[dict], dict]:
+        """
+        解析并校验模型输出: 直接解析 → 从截断/包裹的输出中恢复 → 一次修复重试
+        
+        Returns:
+            (校验后的结果, {"outcome": ..., "ms": 本地解析耗时})，全部失败时结果为 None
+        """
+        parse_started = time.perf_counter()
+        try:
+            # pydantic.ValidationError 也是 ValueError
+            result = validate_analysis(parser.result())
+            outcome = "salvaged" if parser.salvaged else "ok"
+        except ValueError as e:
+            result, error = None, e
+        parse_ms = (time.perf_counter() - parse_started) * 1000
+        
+        if result is None:
+            print(f"⚠️ Model output failed validation: {str(error)[:300]}")
+            result = await self._repair(parser.text, error, backend)
+            outcome = "repaired" if result is not None else "failed"
+        
+        self.metrics.observe("parse", parse_ms / 1000)
+        self.metrics.parse_result(outcome)
+        return result, {"outcome": outcome, "ms": round(parse_ms, 3)}
+    
+    async def _repair(self, output: str, error: Exception, backend: ModelBackend) -> Optional[dict]:
+        """把校验错误反馈给同一个模型，请它只返回修正后的 JSON (最多 REPAIR_TIMEOUT 秒)"""
+        prompt = REPAIR_PROMPT.format(error=str(error)[:1000], output=output[:4000])
+        deadline = asyncio.get_running_loop().time() + REPAIR_TIMEOUT
+        try:
+            async with backend.upstream.slot(deadline):
+                response = await backend.upstream.call(lambda: backend.model.generate_content_async(prompt), deadline)
+            parser = PartialJSONParser()
+            parser.feed(response.text)
+            return validate_analysis(parser.result())
+        except Exception as e:
+            print(f"❌ Repair attempt failed: {str(e)[:300]}")
+            return None
+    
+    async def _pipeline(self, image_url: Optional[str], user_id: Optional[str], stream: bool, image_bytes: Optional[bytes] = None):
+        """
+        单张图片分析流程: 下载 → 缓存查询 → 预处理 → 模型推理 → 解析
+        
+        传入 image_bytes (客户端直接上传) 时跳过下载，直接从请求中的字节解码。
+        以 (事件名, 数据) 的形式产出各阶段进度，最后一个事件总是 "result"。
+        stream=True 时使用 Gemini 流式输出，并在每个顶层字段解析完成时产出 "field" 事件。
+        相同图片正在分析时，直接等待那次分析的结果 (不再重复调用模型)。
+        """
+        started = time.perf_counter()
+        deadline = asyncio.get_running_loop().time() + MODEL_DEADLINE
+        try:
+            # 按内容寻址的图片 (originals/<digest>.jpg) 不用下载就能查缓存
+            digest = digest_from_url(image_url) if image_bytes is None else None
+            if digest is not None and self.cache is not None:
+                key = cache_key_for_digest(digest, CACHE_VERSION)
+                cached = self._cached(key)
+                if cached is not None:
+                    self.metrics.cache_lookup(True)
+                    print(f"⚡ Cache hit by URL: {digest[:12]}")
+                    result = self._recommend({**cached, "cached": True})
+                    yield "result", self._log(image_url, user_id, result, started, CACHE_VERSION)
+                    return
             
-            result = json.loads(result_text)
+            if image_bytes is None:
+                print(f"📸 Fetching image from: {image_url[:80]}...")
+                # 下载图片 (流式读取，超过大小限制或不是图片时立即中止)
+                with self.metrics.stage("download"):
+                    image_bytes = await self.fetcher.fetch_bytes(image_url)
+            else:
+                print(f"📸 Using uploaded image ({len(image_bytes)} bytes)")
+            yield "fetched", {"bytes": len(image_bytes)}
             
-            # 添加产品推荐
-            result["recommendation"] = self._get_recommendation(result["constitution"])
+            # 相同图片 + 相同模型/提示词 直接返回缓存结果，不再调用模型
+            key = cache_key(image_bytes, CACHE_VERSION)
+            if self.cache is not None:
+                cached = self._cached(key)
+                self.metrics.cache_lookup(cached is not None)
+                if cached is not None:
+                    print(f"⚡ Cache hit: {key[:12]}")
+                    result = self._recommend({**cached, "cached": True})
+                    yield "result", self._log(image_url, user_id, result, started, CACHE_VERSION)
+                    return
             
-            print(f"✅ Analysis complete: {result['constitution']} (score: {result['score']})")
-            return result
+            # 相同图片已有请求在分析中: 等待它的结果
+            inflight = self.coalescer.get(key)
+            if inflight is not None:
+                print(f"🔗 Joining in-flight analysis: {key[:12]}")
+                self.metrics.upstream_event("coalesced")
+                result, version = await asyncio.shield(inflight)
+                result = self._recommend(result)
+                yield "result", self._log(image_url, user_id, result, started, version)
+                return
             
-        except json.JSONDecodeError as e:
-            print(f"❌ JSON parse error: {str(e)}")
-            print(f"Raw response: {result_text[:500]}")
-            # 返回模拟结果作为降级
-            return self._mock_analyze()
+            with self.coalescer.lead(key) as leader:
+                async for event, data in self._infer(image_bytes, key, stream, deadline):
+                    if event == "result":
+                        leader.set_result(data)
+                        result, version = data
+                        result = self._recommend(result)
+                        yield "result", self._log(image_url, user_id, result, started, version)
+                    else:
+                        yield event, data
             
         except Exception as e:
             print(f"❌ Error analyzing image: {str(e)}")
             raise
     
-    def _get_recommendation(self, constitution: str) -> dict:
-        """根据体质类型推荐产品"""
-        recommendations = {
-            "Qi Deficiency": {"name": "Ginseng Vitality Elixir", "productId": "drink-1", "desc": "Specially formulated to boost Qi and restore energy"},
-            "Yang Deficiency": {"name": "Warming Ginger Tonic", "productId": "drink-2", "desc": "Warming herbs to strengthen Yang energy"},
-            "Yin Deficiency": {"name": "Cooling Chrysanthemum Tea", "productId": "drink-3", "desc": "Nourishing blend to restore Yin balance"},
-            "Damp Heat": {"name": "Bamboo Detox Elixir", "productId": "drink-1", "desc": "Clears heat and resolves dampness"},
-            "Qi Stagnation": {"name": "Jasmine Calm Tea", "productId": "drink-2", "desc": "Promotes smooth Qi flow and emotional balance"},
-            "Blood Stasis": {"name": "Rose Circulation Blend", "productId": "drink-3", "desc": "Invigorates blood circulation"},
-            "Phlegm Dampness": {"name": "Bamboo Detox Elixir", "productId": "drink-1", "desc": "Resolves phlegm and eliminates dampness"},
-            "Balanced": {"name": "Daily Balance Elixir", "productId": "drink-2", "desc": "Maintains overall harmony and wellness"},
-        }
-        return recommendations.get(constitution, recommendations["Balanced"])
+    async def _infer(self, image_bytes: bytes, key: str, stream: bool, deadline: float):
+        """
+        预处理 → 模型推理 → 解析，最后产出 ("result", (结果, 版本号))
+        
+        模型由 self.router 按实时延迟 / 错误率 / 成本预算选择；Gemini 调用经过该模型的
+        UpstreamGuard: 限流、并发上限、带抖动的退避重试，排队和重试的总时间不超过 deadline。
+        """
+        # 预处理: 修正方向、缩小、重新编码 (CPU 密集，放到线程中执行)
+        with self.metrics.stage("preprocess"):
+            prepared = await asyncio.to_thread(preprocess_image, image_bytes)
+        stats = prepared.stats
+        # decode 是 preprocess 的一部分，单独记录便于区分解码和缩放/编码耗时
+        self.metrics.observe("decode", stats.decode_ms / 1000)
+        print(
+            f"🖼️ Preprocessed {stats.original_size} → {stats.output_size}, "
+            f"{stats.original_bytes} → {stats.output_bytes} bytes "
+            f"(decode {stats.decode_ms}ms, total {stats.total_ms}ms)"
+        )
+        yield "preprocessed", stats.as_dict()
+        
+        # 本地预分类: 颜色/纹理统计，拒绝过暗、过曝、模糊或没有舌头的图片 (不消耗模型调用)
+        with self.metrics.stage("precheck"):
+            features = await asyncio.to_thread(extract_features, prepared.image)
+        try:
+            check_usable(features)
+        except UnusableImageError as e:
+            print(f"🚫 Rejected image ({e.reason}): {features.as_dict()}")
+            self.metrics.rejected(e.reason)
+            raise
+        
+        # 本地模式: 直接由特征得到结果，不发起任何网络请求 (不缓存)
+        if LOCAL_ONLY:
+            self.metrics.fallback("local_only")
+            result = {**local_analysis(features), "cached": False, "preprocess": stats.as_dict(), "features": features.as_dict()}
+            yield "result", (result, LOCAL_VERSION)
+            return
+        
+        # 按实时延迟 / 错误率 / 成本预算选择模型后端 (modal_ai/routing.py)
+        backend, reason = self.router.choose()
+        if backend is None:
+            print(f"⚠️ No model available ({reason})")
+            yield "result", self._degraded(key, features, stats, reason)
+            return
+        
+        # 没有 Gemini API Key 时路由中只有模拟模型
+        if backend.kind == MOCK:
+            print("⚠️ Using mock analysis (no API key)")
+            self.metrics.fallback("no_api_key")
+            yield "result", ({**mock_analysis(), "model": MOCK}, MOCK_VERSION)
+            return
+        
+        # 本地模型: 由特征统计得到结果 (其他模型太慢、出错或超出预算时的低成本选择，不缓存)
+        if backend.kind == LOCAL:
+            started = time.perf_counter()
+            result = local_analysis(features)
+            backend.stats.record(time.perf_counter() - started, True)
+            self._start_shadow(backend, result, prepared, features)
+            result = {**result, "cached": False, "model": LOCAL, "preprocess": stats.as_dict(), "features": features.as_dict()}
+            yield "result", (result, LOCAL_VERSION)
+            return
+        
+        # 使用 Gemini Vision 分析
+        print(f"🧠 Analyzing with {backend.name} ({reason})...")
+        yield "model_started", {"model": backend.name}
+        
+        parser = PartialJSONParser()
+        try:
+            with self.metrics.stage("model"):
+                async for field, value in self._generate(backend, self._contents(prepared, features), stream, deadline, parser):
+                    yield "field", {field: value}
+        except Exception as e:
+            # 熔断打开时立即降级；其他上游错误 (重试用尽、超过 deadline) 同样降级，而不是让用户等到超时后报错
+            cause = "circuit_open" if isinstance(e, CircuitOpenError) else "upstream_error"
+            print(f"⚠️ Model call failed ({cause}): {str(e)[:200]}")
+            yield "result", self._degraded(key, features, stats, cause, e, backend)
+            return
+        
+        # 解析并校验模型输出 (容错恢复 + 一次修复重试)
+        result, parse_info = await self._parse_response(parser, backend)
+        if result is None:
+            print(f"Raw response: {parser.text[:500]}")
+            # 修复后仍无法使用，按同样的降级顺序给出结果 (不缓存)
+            self.metrics.fallback("parse_failed")
+            yield "result", self._degraded(key, features, stats, "parse_failed", backend=backend)
+            return
+        
+        # 缓存键使用首选模型的 CACHE_VERSION，所以只缓存首选模型的结果 (回退模型、本地和模拟结果都不缓存)；
+        # 条目记录给出结果的模型，命中时据此确认
+        result = {**result, "model": backend.name}
+        if self.cache is not None and backend.version == CACHE_VERSION:
+            self.cache.set(key, result)
+        self._start_shadow(backend, result, prepared, features)
+        
+        print(f"✅ Analysis complete: {result['constitution']} (score: {result['score']})")
+        result = {**result, "cached": False, "preprocess": stats.as_dict(),
+                  "features": features.as_dict(), "parse": parse_info}
+        yield "result", (result, backend.version)
+    
+    @staticmethod
+    def _contents(prepared, features) -> list:
+        contents = [ANALYSIS_PROMPT, prepared.as_part()]
+        if FEATURE_HINTS:
+            contents.insert(1, prompt_hint(features))
+        return contents
+    
+    async def _generate(self, backend: ModelBackend, contents: list, stream: bool, deadline: float, parser: PartialJSONParser):
+        """
+        调用一个 Gemini 后端，把输出喂给 parser；流式时逐个产出解析完成的 (字段, 值)
+        
+        非流式调用交给该后端的微批处理器，与同时到达的其他图片合并为一次调用。
+        耗时和成败计入该后端的实时统计 (路由依据)；熔断打开时没有发起调用，不计入。
+        """
+        if not stream:
+            if BATCH_MAX_WAIT_MS > 0:
+                parser.feed(await self._batcher(backend).submit((contents, deadline)))
+            else:
+                parser.feed(await self._call(backend, contents, deadline))
+            return
+        
+        started = time.monotonic()
+        try:
+            async with backend.upstream.slot(deadline):
+                response = await backend.upstream.call(
+                    lambda: backend.model.generate_content_async(contents, stream=True), deadline
+                )
+                async for chunk in response:
+                    for field, value in parser.feed(chunk.text):
+                        yield field, value
+        except CircuitOpenError:
+            raise
+        except Exception:
+            backend.stats.record(time.monotonic() - started, False)
+            raise
+        backend.stats.record(time.monotonic() - started, True)
+    
+    async def _call(self, backend: ModelBackend, contents: list, deadline: float, **kwargs) -> str:
+        """一次非流式 Gemini 调用，返回输出文本 (计入该后端的实时统计)"""
+        started = time.monotonic()
+        try:
+            async with backend.upstream.slot(deadline):
+                response = await backend.upstream.call(
+                    lambda: backend.model.generate_content_async(contents, **kwargs), deadline
+                )
+                text = response.text
+        except CircuitOpenError:
+            raise
+        except Exception:
+            backend.stats.record(time.monotonic() - started, False)
+            raise
+        backend.stats.record(time.monotonic() - started, True)
+        return text
+    
+    def _batcher(self, backend: ModelBackend) -> MicroBatcher:
+        batcher = self._batchers.get(backend.name)
+        if batcher is None:
+            batcher = MicroBatcher(functools.partial(self._generate_batch, backend), BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+            self._batchers[backend.name] = batcher
+        return batcher
     
-    def _mock_analyze(self) -> dict:
-        """模拟分析结果 (当没有 API Key 时使用)"""
-        import random
+    async def _generate_batch(self, backend: ModelBackend, items: list[tuple[list, float]]) -> list:
+        """
+        把一批 (contents, deadline) 合并为一次多图调用，返回每张图片对应的 JSON 文本
         
-        constitutions = ["Qi Deficiency", "Yang Deficiency", "Yin Deficiency", 
-                        "Damp Heat", "Qi Stagnation", "Blood Stasis", 
-                        "Phlegm Dampness", "Balanced"]
+        整批共用一次限流令牌、一个并发位和一次往返，deadline 取最早的一个；
+        上游错误 (熔断、重试用尽、超时) 由整批的调用方各自降级。
+        返回的数组无法解析或数量不对时，对每张图片单独重新调用一次。
+        """
+        if len(items) == 1:
+            contents, deadline = items[0]
+            return [await self._call(backend, contents, deadline)]
         
-        constitution = random.choice(constitutions)
-        score = random.randint(55, 95)
+        contents = [BATCH_PROMPT.format(count=len(items))]
+        for i, (item, _) in enumerate(items, 1):
+            contents.append(f"Image {i}:")
+            contents.extend(part for part in item if part is not ANALYSIS_PROMPT)
+        kwargs = {}
+        if STRUCTURED_OUTPUT:
+            kwargs["generation_config"] = genai.GenerationConfig(
+                response_mime_type="application/json",
+                response_schema={"type": "array", "items": RESPONSE_SCHEMA},
+            )
+        self.metrics.upstream_event("batched")
+        text = await self._call(backend, contents, min(deadline for _, deadline in items), **kwargs)
         
-        tongue_features = {
-            "teeth_marks": random.choice([True, False]),
-            "pale_white": random.choice([True, False]),
-            "red": random.choice([True, False]),
-            "cracked": random.choice([True, False]),
-            "peeling": random.choice([True, False]),
-        }
+        try:
+            results = parse_json_array(text)
+            if len(results) == len(items):
+                return [json.dumps(result) for result in results]
+            print(f"⚠️ Batched call returned {len(results)} results for {len(items)} images")
+        except ValueError as e:
+            print(f"⚠️ Batched call output unusable: {str(e)[:200]}")
+        self.metrics.upstream_event("batch_split")
+        return await asyncio.gather(
+            *(self._call(backend, contents, deadline) for contents, deadline in items), return_exceptions=True
+        )
+    
+    def _start_shadow(self, backend: ModelBackend, result: dict, prepared, features) -> None:
+        """按 SHADOW_RATE 抽样，在后台用影子模型分析同一张图片 (不影响本次响应的延迟)"""
+        shadow = self.router.shadow_for(backend)
+        if shadow is None:
+            return
+        task = asyncio.create_task(self._shadow(shadow, backend, result, prepared, features))
+        self._shadow_tasks.add(task)
+        task.add_done_callback(self._shadow_tasks.discard)
+    
+    async def _shadow(self, shadow: ModelBackend, primary: ModelBackend, primary_result: dict, prepared, features) -> None:
+        """
+        影子分析: 记录与实际返回结果的一致程度 (指标 + analysis_logs)
         
-        symptoms = {
-            "obesity": round(random.uniform(0.1, 0.9), 2),
-            "high_sugar": round(random.uniform(0.1, 0.7), 2),
-            "indigestion": round(random.uniform(0.2, 0.8), 2),
-            "fatigue": round(random.uniform(0.2, 0.9), 2),
-            "insomnia": round(random.uniform(0.1, 0.8), 2),
-            "acid_reflux": round(random.uniform(0.1, 0.6), 2),
-            "dry_mouth": round(random.uniform(0.2, 0.8), 2),
-            "constipation": round(random.uniform(0.1, 0.7), 2),
-            "irritability": round(random.uniform(0.2, 0.9), 2),
-        }
+        analysis_logs 中的影子记录 user_id 为空 (不计入用户历史)，result.shadow 保存
+        实际返回的模型、其结果摘要和一致程度，可以直接离线统计。
+        """
+        started = time.perf_counter()
+        try:
+            if shadow.kind == GEMINI:
+                parser = PartialJSONParser()
+                deadline = asyncio.get_running_loop().time() + SHADOW_DEADLINE
+                async for _ in self._generate(shadow, self._contents(prepared, features), False, deadline, parser):
+                    pass
+                result = validate_analysis(parser.result())
+            elif shadow.kind == LOCAL:
+                result = local_analysis(features)
+            else:
+                result = mock_analysis()
+        except Exception as e:
+            print(f"👥 Shadow {shadow.name} failed: {str(e)[:200]}")
+            self.metrics.shadow(shadow.name, "failed")
+            return
         
-        issues = []
-        if tongue_features["teeth_marks"]:
-            issues.append("Teeth marks indicate Qi deficiency")
-        if tongue_features["pale_white"]:
-            issues.append("Pale color suggests blood deficiency")
-        if tongue_features["red"]:
-            issues.append("Red color indicates excess heat")
-        if tongue_features["cracked"]:
-            issues.append("Cracks suggest Yin deficiency")
-        if not issues:
-            issues.append("Generally healthy tongue appearance")
+        compared = agreement(primary_result, result)
+        self.metrics.shadow(shadow.name, "agree" if compared["constitution"] else "disagree")
+        if self.log_writer is not None:
+            self.log_writer.record(AnalysisLogRow(
+                user_id=None,
+                image_url=None,
+                result={**result, "shadow": {
+                    "primary": primary.name,
+                    "primary_version": primary.version,
+                    "primary_result": {
+                        name: primary_result.get(name) for name in ("constitution", "score", "tongue_features", "symptoms")
+                    },
+                    "agreement": compared,
+                }},
+                latency_ms=(time.perf_counter() - started) * 1000,
+                model_version=shadow.version,
+            ))
+    
+    def _degraded(self, key: str, features, stats, cause: str, error: Optional[Exception] = None,
+                  backend: Optional[ModelBackend] = None) -> tuple[dict, str]:
+        """
+        模型不可用时的降级顺序 (都只在本地完成，不等待上游):
+        同一图片的缓存结果 (包括已过期的) → 本地特征统计结果 → 抛出 UpstreamBusyError 请用户稍后重试
         
-        return {
-            "score": score,
-            "constitution": constitution,
-            "issues": issues[:3],
-            "recommendation": self._get_recommendation(constitution),
-            "tongue_features": tongue_features,
-            "symptoms": symptoms,
-        }
+        降级结果带有 "degraded" 字段，不写入缓存。
+        """
+        if self.cache is not None:
+            cached = self._cached(key, allow_stale=True)
+            if cached is not None:
+                self.metrics.degraded(cause, "stale_cache")
+                return {**cached, "cached": True, "degraded": "stale_cache"}, CACHE_VERSION
+        
+        if DEGRADE_TO_LOCAL:
+            self.metrics.degraded(cause, "local")
+            result = {**local_analysis(features), "cached": False, "degraded": "local",
+                      "preprocess": stats.as_dict(), "features": features.as_dict()}
+            return result, LOCAL_VERSION
+        
+        self.metrics.degraded(cause, "unavailable")
+        upstream = (backend or self.router.backends[0]).upstream
+        breaker = upstream.breaker if upstream is not None else None
+        retry_after = breaker.retry_after() if breaker is not None and breaker.is_open() else getattr(error, "retry_after", 5)
+        raise UpstreamBusyError("Analysis is temporarily unavailable, please try again later", retry_after=retry_after) from error
 
 
 # =============================================================================
-# 4. Web Endpoint - 接收请求
+# 4. Web Endpoint - 认证与批量请求
 # =============================================================================
 
+def _uploaded_image(body: "AnalyzeBody") -> Optional[bytes]:
+    """解码请求体中的 image_base64；没有上传图片时返回 None (超过大小上限或不是图片时抛出 ImageFetchError)"""
+    if not body.image_base64:
+        return None
+    return decode_base64_image(body.image_base64)
+
+
+@functools.cache
+def request_gate() -> "RequestGate":
+    """认证 token 和图片地址白名单 (每个容器只从环境变量读取一次)"""
+    return RequestGate.from_env()
+
+
+async def _accept(http_request: "Request", model, max_urls: Optional[int] = None):
+    """
+    认证 → 解析请求体 → 检查图片地址，不通过时抛出 RequestRejected
+    
+    认证只看请求头，失败时不读取请求体；这些检查都不涉及网络或模型。
+    
+    Returns:
+        (请求体, X-User-Token 中的用户 ID 或 None)
+    """
+    gate = request_gate()
+    gate.authenticate(http_request.headers.get("authorization"))
+    user_id = request_user(http_request.headers.get("x-user-token"))
+    body = parse_body(model, await http_request.body())
+    urls = body.urls()
+    if max_urls is not None and len(urls) > max_urls:
+        raise RequestRejected(400, f"Too many images: at most {max_urls} per request")
+    for url in urls:
+        gate.check_image_url(url)
+    return body, user_id
+
+
+def _rejected(error: "RequestRejected") -> "JSONResponse":
+    return JSONResponse({"success": False, "error": str(error)}, status_code=error.status)
+
+
 @app.function(
     image=image,
     secrets=[modal.Secret.from_name("tongue-analyzer-secrets")],
+    timeout=600,
 )
-@modal.web_endpoint(method="POST", docs=True)
-def analyze_tongue(request: dict) -> dict:
+@modal.fastapi_endpoint(method="POST", docs=True)
+async def analyze_batch(http_request: "Request"):
     """
-    Web API 端点 - 接收图片分析请求
+    批量分析端点 - 一次提交多张图片 (例如诊所上传历史照片)
     
     请求格式:
-    POST /analyze_tongue
+    POST /analyze_batch
     Headers:
         Authorization: Bearer <YOUR_API_TOKEN>
         Content-Type: application/json
     Body:
         {
-            "image_url": "https://example.com/image.jpg"
+            "image_urls": ["https://example.com/1.jpg", "https://example.com/2.jpg"]
         }
-    """
-    import os
-    
-    # 安全验证
-    expected_token = os.environ.get("API_TOKEN")
-    auth_header = request.get("headers", {}).get("authorization", "")
     
-    if auth_header.startswith("Bearer "):
-        provided_token = auth_header[7:]
-    else:
-        provided_token = auth_header
+    响应中 results 与 image_urls 顺序一致，每项为
+    {"success": true, "data": {...}} 或 {"success": false, "error": "..."}
     
-    if not expected_token:
-        return {"success": False, "error": "Server configuration error: API_TOKEN not set"}
-    
-    if provided_token != expected_token:
-        return {"success": False, "error": "Unauthorized: Invalid or missing API token"}
+    所有地址都在本函数内校验，任何一个不通过时整个请求返回 400，不会调用 TongueAnalyzer
+    """
+    try:
+        body, user_id = await _accept(http_request, BatchBody, max_urls=BATCH_MAX_URLS)
+    except RequestRejected as e:
+        return _rejected(e)
     
-    # 处理分析请求
-    image_url = request.get("body", {}).get("image_url")
+    image_urls = body.image_urls
     
-    if not image_url:
-        return {"success": False, "error": "Missing required field: image_url"}
+    # 按 BATCH_MAX_SIZE 分块，各块在不同容器中并行处理
+    chunks = [image_urls[i:i + BATCH_MAX_SIZE] for i in range(0, len(image_urls), BATCH_MAX_SIZE)]
     
     try:
-        analyzer = TongueAnalyzer()
-        result = analyzer.analyze.remote(image_url)
+        results = []
+        user_ids = [[user_id] * len(chunk) for chunk in chunks]
+        async for chunk_results in TongueAnalyzer().analyze_batch.map.aio(chunks, user_ids):
+            results.extend(chunk_results)
         
-        return {"success": True, "data": result}
+        return {"success": True, "results": results}
         
     except Exception as e:
-        return {"success": False, "error": f"Analysis failed: {str(e)}"}
-
+        return {"success": False, "error": f"Batch analysis failed: {str(e)}"}
 
-# =============================================================================
-# 5. 健康检查端点
-# =============================================================================
 
-@app.function(image=image)
-@modal.web_endpoint(method="GET")
-def health() -> dict:
-    """健康检查端点"""
-    return {
-        "status": "healthy",
-        "service": "tongue-analyzer",
-        "version": "2.0.0",
-        "model": "gemini-2.0-flash"
-    }
+@app.function(
+    image=image,
+    secrets=[modal.Secret.from_name("tongue-analyzer-secrets")],
+    timeout=24 * 3600,
+)
+async def reanalyze_catalog(retry_failed: bool = False, limit: Optional[int] = None,
+                            page_size: int = REANALYSIS_PAGE_SIZE, restart: bool = False) -> dict:
+    """
+    用当前的模型路由 (版本 CACHE_VERSION) 重新分析 analysis-images 中的全部历史图片 (modal_ai/reanalysis.py)
+    
+    每页 page_size 张图片交给 TongueAnalyzer.reanalyze.map()，同时在途的图片不超过一页；
+    结果和进度按页写入 REANALYSIS_DSN，中断后再次运行会从上次的进度继续。
+    """
+    dsn = os.environ.get("REANALYSIS_DSN")
+    if not dsn:
+        raise RuntimeError("REANALYSIS_DSN not set")
+    store = store_from_env()
+    if not isinstance(store, SupabaseStore):
+        raise RuntimeError("Re-analysis on Modal needs the Supabase bucket (SUPABASE_URL / SUPABASE_SERVICE_ROLE_KEY)")
+    analyzer = TongueAnalyzer()
+    
+    async def run_page(refs) -> list[dict]:
+        urls = [store.public_url(ref.name) for ref in refs]
+        return [
+            outcome if isinstance(outcome, dict) else {"success": False, "error": str(outcome) or type(outcome).__name__}
+            async for outcome in analyzer.reanalyze.map.aio(urls, return_exceptions=True)
+        ]
+    
+    sink = results_from_dsn(dsn)
+    await sink.open()
+    try:
+        return await run_reanalysis(store, run_page, sink, CACHE_VERSION, retry_failed, page_size, limit, restart)
+    finally:
+        await sink.close()
 
 
 # =============================================================================
-# 6. 本地测试入口
+# 5. 本地测试入口
 # =============================================================================
 
 @app.local_entrypoint()
@@ -305,4 +1243,14 @@ def main():
     print(f"  Constitution: {result['constitution']}")
     print(f"  Score: {result['score']}")
     print(f"  Issues: {result['issues']}")
-    print(f"  Recommendation: {result['recommendation']['name']}")
+    print(f"  Recommendation: {(result['recommendation'] or {}).get('name')}")
+
+
+@app.local_entrypoint()
+def reanalyze(retry_failed: bool = False, limit: int = 0, page_size: int = REANALYSIS_PAGE_SIZE, restart: bool = False):
+    """
+    批量重新分析历史图片并与上一个版本对比:
+    modal run modal_ai/main.py::reanalyze [--limit 1000] [--retry-failed] [--restart]
+    """
+    report = reanalyze_catalog.remote(retry_failed, limit or None, page_size, restart)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
@@ -0,0 +1,113 @@
+# 模型输出解析: 从流式返回的文本中逐步提取 JSON 字段
+
+import json
+
+
+class PartialJSONParser:
+    """
+    增量解析 Gemini 流式输出的 JSON 对象
+
+    每次 feed 一段文本，返回这段文本中新完成的顶层字段 [(key, value), ...]。
+    会跳过 JSON 之前的 markdown 代码块标记等前缀。完整文本保存在 text 属性中。
+    全部文本 feed 完后调用 result() 取得解析结果，输出被截断时返回已完成的字段。
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = 0            # 下一个待扫描字符的位置
+        self._start = None       # 顶层 "{" 的位置
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._field_start = None # 当前顶层字段开始的位置
+        self._end = None         # 顶层 "}" 之后的位置
+        self.fields = {}         # 已完成的顶层字段
+        self.done = False
+        self.salvaged = False    # result() 是否只能从部分字段中恢复
+
+    def feed(self, chunk: str) -> list[tuple[str, object]]:
+        self.text += chunk
+        fields = []
+        text = self.text
+
+        while self._pos < len(text) and not self.done:
+            ch = text[self._pos]
+
+            if self._start is None:
+                if ch == "{":
+                    self._start = self._pos
+                    self._depth = 1
+                    self._field_start = self._pos + 1
+                self._pos += 1
+                continue
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    fields.extend(self._take_field(self._pos))
+                    self._end = self._pos + 1
+                    self.done = True
+            elif ch == "," and self._depth == 1:
+                fields.extend(self._take_field(self._pos))
+                self._field_start = self._pos + 1
+
+            self._pos += 1
+
+        self.fields.update(fields)
+        return fields
+
+    def result(self) -> dict:
+        """
+        返回解析出的 JSON 对象
+
+        对象完整时直接解析 (忽略前后的代码块标记等文本)；对象被截断或内部有语法错误时，
+        返回已完整解析的顶层字段并将 salvaged 置为 True。一个字段都没有时抛出 ValueError。
+        """
+        if self.done:
+            try:
+                value = json.loads(self.text[self._start:self._end])
+                if isinstance(value, dict):
+                    return value
+            except json.JSONDecodeError:
+                pass
+        if not self.fields:
+            raise ValueError("No JSON object found in model output")
+        self.salvaged = True
+        return dict(self.fields)
+
+    def _take_field(self, end: int) -> list[tuple[str, object]]:
+        """解析 [_field_start, end) 之间的 "key": value 片段"""
+        segment = self.text[self._field_start:end].strip()
+        if not segment:
+            return []
+        try:
+            field = json.loads("{" + segment + "}")
+        except json.JSONDecodeError:
+            return []
+        return list(field.items())
+
+
+def parse_json_array(text: str) -> list:
+    """
+    解析一次批量调用返回的 JSON 数组 (忽略前后的代码块标记等文本)
+
+    找不到完整数组或数组无法解析时抛出 ValueError (json.JSONDecodeError 也是 ValueError)。
+    """
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end < start:
+        raise ValueError("No JSON array found in model output")
+    value = json.loads(text[start:end + 1])
+    if not isinstance(value, list):
+        raise ValueError("Model output is not a JSON array")
+    return value
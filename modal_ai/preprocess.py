@@ -0,0 +1,148 @@
+# 图片预处理: 在送入模型前修正方向、裁剪、缩小并重新编码
+#
+# 手机拍摄的照片可达 12MP，直接上传给 Gemini 会增加流量、token 成本和延迟。
+# 舌象诊断只需要 ~1000px 的图片即可看清颜色、舌苔和裂纹。
+
+import os
+import time
+from dataclasses import asdict, dataclass
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# 最长边像素上限
+MAX_EDGE = int(os.environ.get("PREPROCESS_MAX_EDGE", "1024"))
+# 重新编码格式 (JPEG / WEBP) 和质量
+OUTPUT_FORMAT = os.environ.get("PREPROCESS_FORMAT", "JPEG").upper()
+OUTPUT_QUALITY = int(os.environ.get("PREPROCESS_QUALITY", "85"))
+# 是否裁剪到舌头区域
+CROP_TO_TONGUE = os.environ.get("PREPROCESS_CROP", "0") == "1"
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# 舌头区域至少占画面的比例，低于此值认为检测失败，不裁剪
+_MIN_TONGUE_FRACTION = 0.02
+# 裁剪框四周保留的边距比例
+_CROP_PADDING = 0.08
+
+
+@dataclass
+class PreprocessStats:
+    """单次预处理的统计数据，用于观察节省了多少字节和时间"""
+    original_bytes: int
+    output_bytes: int
+    original_size: tuple[int, int]
+    output_size: tuple[int, int]
+    decode_ms: float
+    total_ms: float
+    cropped: bool
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class PreprocessedImage:
+    image: Image.Image
+    data: bytes
+    mime_type: str
+    stats: PreprocessStats
+
+    def as_part(self) -> dict:
+        """转换成 Gemini 的 inline blob，直接上传编码后的字节"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+
+def decode_image(image_bytes: bytes, max_edge: int = MAX_EDGE) -> tuple[Image.Image, tuple[int, int]]:
+    """
+    解码图片并修正 EXIF 方向
+
+    JPEG 使用 Image.draft() 让解码器直接按 1/2、1/4、1/8 缩放解码，
+    12MP 照片的解码时间可缩短数倍。返回 (RGB 图片, 原始尺寸)。
+    """
+    img = Image.open(BytesIO(image_bytes))
+    original_size = img.size
+    if img.format == "JPEG":
+        # draft 只会缩小到不小于请求尺寸的最近比例，方向修正前后都安全
+        img.draft("RGB", (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+    return img.convert("RGB"), original_size
+
+
+def tongue_bbox(img: Image.Image) -> tuple[int, int, int, int] | None:
+    """
+    用颜色阈值估计舌头所在的矩形区域
+
+    舌体偏红/粉: R 通道明显高于 G 和 B。整个计算在 NumPy 数组上向量化完成，
+    不逐像素循环。检测区域过小时返回 None。
+    """
+    rgb = np.asarray(img, dtype=np.int16)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    mask = (r > 90) & (r - g > 30) & (r - b > 15)
+
+    if mask.mean() < _MIN_TONGUE_FRACTION:
+        return None
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    top, bottom = rows[0], rows[-1] + 1
+    left, right = cols[0], cols[-1] + 1
+
+    height, width = mask.shape
+    pad_y = int((bottom - top) * _CROP_PADDING)
+    pad_x = int((right - left) * _CROP_PADDING)
+    return (
+        max(0, left - pad_x),
+        max(0, top - pad_y),
+        min(width, right + pad_x),
+        min(height, bottom + pad_y),
+    )
+
+
+def preprocess_image(
+    image_bytes: bytes,
+    max_edge: int = MAX_EDGE,
+    output_format: str = OUTPUT_FORMAT,
+    quality: int = OUTPUT_QUALITY,
+    crop: bool = CROP_TO_TONGUE,
+) -> PreprocessedImage:
+    """
+    完整预处理流程: 解码 (draft) → EXIF 方向 → 可选裁剪 → 缩小 → 重新编码
+
+    Args:
+        image_bytes: 原始图片字节
+        max_edge: 输出图片最长边
+        output_format: "JPEG" 或 "WEBP"
+        quality: 编码质量 (1-100)
+        crop: 是否裁剪到舌头区域
+    """
+    started = time.perf_counter()
+
+    img, original_size = decode_image(image_bytes, max_edge)
+    decode_ms = (time.perf_counter() - started) * 1000
+
+    cropped = False
+    if crop:
+        bbox = tongue_bbox(img)
+        if bbox is not None:
+            img = img.crop(bbox)
+            cropped = True
+
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    buffer = BytesIO()
+    img.save(buffer, format=output_format, quality=quality)
+    data = buffer.getvalue()
+
+    stats = PreprocessStats(
+        original_bytes=len(image_bytes),
+        output_bytes=len(data),
+        original_size=original_size,
+        output_size=img.size,
+        decode_ms=round(decode_ms, 2),
+        total_ms=round((time.perf_counter() - started) * 1000, 2),
+        cropped=cropped,
+    )
+    return PreprocessedImage(image=img, data=data, mime_type=_MIME_TYPES[output_format], stats=stats)
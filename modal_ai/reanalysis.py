@@ -0,0 +1,531 @@
+# 历史图片批量重新分析: 修改 ANALYSIS_PROMPT、模型路由或本地特征模型后，用新版本重新评估全部历史图片
+#
+# 图片来源是 analysis-images 中的 inference/<摘要>.jpg (backend/image_store.py 生成，每张不同的照片一份，
+# 原图过期删除后仍保留)。按 page_size 分页列出，无论有多少张图片内存占用都不变。
+# 每页最多 page_size 张同时分析，然后该页的结果和进度 (列表偏移量) 在同一个事务中写入结果库:
+#   - analysis_reanalysis: 每个 (版本, 图片摘要) 一行，带体质 / 评分 / 症状向量 / 完整结果 / 错误
+#   - reanalysis_runs: 每次运行的进度和累计统计
+# 中断后再次运行从最后提交的一页之后继续；崩溃时重放的一页按 (版本, 摘要) 覆盖自身。
+# inference/ 只会新增图片 (按创建时间排序)，已完成的运行再次执行时只分析新增的图片。
+#
+# 两种执行方式:
+#   - Modal: TongueAnalyzer.reanalyze.map() (当前部署的模型路由，版本为 CACHE_VERSION)
+#         modal run modal_ai/main.py::reanalyze --limit 1000
+#   - 本地: 进程池运行本地特征模型 (modal_ai/features.py，版本为 LOCAL_VERSION)
+#         python -m modal_ai.reanalysis run --local ./bucket --dsn sqlite:///reanalysis.db --workers 8
+#
+# 失败的图片 (包括被路由到其他模型的) 可以单独重试，最后与之前的版本对比:
+#     python -m modal_ai.reanalysis run --retry-failed ...
+#     python -m modal_ai.reanalysis report --dsn ... --version <新版本> [--baseline <旧版本>]
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+from backend.analysis_core import SYMPTOM_NAMES
+from backend.history import symptom_vector
+from backend.image_store import INFERENCE, LocalStore, ObjectStore, inference_name, store_from_env
+from modal_ai.routing import LOCAL
+
+# 每页列出 / 同时分析的图片数
+PAGE_SIZE = int(os.environ.get("REANALYSIS_PAGE_SIZE", "200"))
+# 对比报告中列出的评分变化最大的图片数
+REPORT_MOVERS = 10
+
+
+@dataclass(slots=True)
+class ImageRef:
+    digest: str
+    name: str  # 桶中的对象名 (inference/<摘要>.jpg)
+
+
+@dataclass(slots=True)
+class ReanalysisRow:
+    digest: str
+    version: str                  # 本次运行的版本
+    model_version: Optional[str]  # 实际给出结果的模型版本
+    result: Optional[dict]
+    error: Optional[str]
+    created_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+    @property
+    def constitution(self) -> Optional[str]:
+        return self.result.get("constitution") if self.result else None
+
+    @property
+    def score(self) -> Optional[int]:
+        return self.result.get("score") if self.result else None
+
+    @property
+    def symptoms(self) -> Optional[list[float]]:
+        return symptom_vector(self.result.get("symptoms")) if self.result else None
+
+
+# 分析一页图片: 返回与 refs 顺序一致的
+# {"success": True, "data": 结果, "version": 模型版本} 或 {"success": False, "error": ...}
+PageRunner = Callable[[list[ImageRef]], Awaitable[list[dict]]]
+
+
+# =============================================================================
+# 图片来源: page(游标, 数量) → (图片列表, 下一页游标)，游标为 None 表示从头开始
+# =============================================================================
+
+class CatalogSource:
+    """桶中 inference/ 下的全部图片，游标是列表偏移量"""
+
+    def __init__(self, store: ObjectStore):
+        self.store = store
+
+    async def page(self, cursor: Optional[str], limit: int) -> tuple[list[ImageRef], str]:
+        offset = int(cursor or 0)
+        while True:
+            objects = await asyncio.to_thread(self.store.list_page, INFERENCE, limit, offset)
+            # 子文件夹也占列表位置: 偏移量按全部条目计算，只有文件夹的一页继续往下取
+            offset += len(objects)
+            refs = [ImageRef(Path(obj.name).stem, obj.name) for obj in objects if not obj.folder]
+            if refs or len(objects) < limit:
+                return refs, str(offset)
+
+
+class FailedSource:
+    """某个版本中失败的图片 (按摘要顺序)，游标是上一页最后的摘要"""
+
+    def __init__(self, sink, version: str):
+        self.sink = sink
+        self.version = version
+
+    async def page(self, cursor: Optional[str], limit: int) -> tuple[list[ImageRef], Optional[str]]:
+        digests = await self.sink.failed(self.version, cursor, limit)
+        return [ImageRef(digest, inference_name(digest)) for digest in digests], digests[-1] if digests else cursor
+
+
+# =============================================================================
+# 结果库: analysis_reanalysis + reanalysis_runs (Postgres 或本地 SQLite)
+# =============================================================================
+
+def _symptom_diffs(column: str) -> str:
+    """每个症状的平均绝对差; column 是取第 i 个症状的表达式模板 ({t} 表别名, {i} 从 0 开始, {n} 从 1 开始)"""
+    return ", ".join(
+        f"avg(abs({column.format(t='n', i=i, n=i + 1)} - {column.format(t='b', i=i, n=i + 1)}))"
+        for i in range(len(SYMPTOM_NAMES))
+    )
+
+
+def _report(totals, baseline_totals, compared, transitions, movers) -> dict:
+    count, constitution_changed, score_delta, score_mae, *symptom_mae = compared
+    return {
+        "rows": totals[0], "failed": totals[1],
+        "baseline_rows": baseline_totals[0], "baseline_failed": baseline_totals[1],
+        "compared": count,
+        "constitution_changed": constitution_changed or 0,
+        "constitution_change_rate": round((constitution_changed or 0) / count, 4) if count else None,
+        "score_delta": round(score_delta, 2) if score_delta is not None else None,
+        "score_mae": round(score_mae, 2) if score_mae is not None else None,
+        "symptom_mae": {
+            name: round(value, 4) if value is not None else None for name, value in zip(SYMPTOM_NAMES, symptom_mae)
+        },
+        "transitions": [{"from": old, "to": new, "count": n} for old, new, n in transitions],
+        "score_movers": [{"digest": digest, "from": old, "to": new} for digest, old, new in movers],
+    }
+
+
+class PostgresResults:
+    """结果写入 Postgres (表结构见 initial_schema.sql)，一页一个事务"""
+
+    UPSERT = (
+        "insert into public.analysis_reanalysis "
+        "(version, digest, model_version, constitution, score, symptoms, result, error, created_at) "
+        "values ($1, $2, $3, $4, $5, $6, $7::jsonb, $8, $9) "
+        "on conflict (version, digest) do update set model_version = excluded.model_version, "
+        "constitution = excluded.constitution, score = excluded.score, symptoms = excluded.symptoms, "
+        "result = excluded.result, error = excluded.error, created_at = excluded.created_at"
+    )
+    PAIRS = (
+        "from public.analysis_reanalysis n join public.analysis_reanalysis b on b.digest = n.digest "
+        "where n.version = $1 and b.version = $2 and n.error is null and b.error is null"
+    )
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._pool = None
+
+    async def open(self) -> None:
+        import asyncpg
+
+        self._pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=2)
+
+    async def checkpoint(self, run_id: str) -> Optional[dict]:
+        row = await self._pool.fetchrow(
+            "select cursor, stats, done from public.reanalysis_runs where run_id = $1", run_id
+        )
+        return {"cursor": row[0], "stats": json.loads(row[1]), "done": row[2]} if row else None
+
+    async def commit(self, run_id: str, version: str, rows: list[ReanalysisRow], cursor: Optional[str],
+                     stats: dict, done: bool) -> None:
+        async with self._pool.acquire() as conn, conn.transaction():
+            if rows:
+                await conn.executemany(self.UPSERT, [
+                    (r.version, r.digest, r.model_version, r.constitution, r.score, r.symptoms,
+                     json.dumps(r.result) if r.result else None, r.error, r.created_at)
+                    for r in rows
+                ])
+            await conn.execute(
+                "insert into public.reanalysis_runs (run_id, version, cursor, stats, done) "
+                "values ($1, $2, $3, $4::jsonb, $5) on conflict (run_id) do update set "
+                "cursor = excluded.cursor, stats = excluded.stats, done = excluded.done, updated_at = now()",
+                run_id, version, cursor, json.dumps(stats), done,
+            )
+
+    async def failed(self, version: str, after: Optional[str], limit: int) -> list[str]:
+        rows = await self._pool.fetch(
+            "select digest from public.analysis_reanalysis where version = $1 and error is not null "
+            "and digest > $2 order by digest limit $3",
+            version, after or "", limit,
+        )
+        return [row[0] for row in rows]
+
+    async def previous_version(self, version: str) -> Optional[str]:
+        return await self._pool.fetchval(
+            "select version from public.reanalysis_runs where version <> $1 order by updated_at desc limit 1", version
+        )
+
+    async def report(self, version: str, baseline: str) -> dict:
+        totals = "select count(*), count(*) filter (where error is not null) from public.analysis_reanalysis where version = $1"
+        compared = (
+            "select count(*), count(*) filter (where n.constitution is distinct from b.constitution), "
+            "avg(n.score - b.score)::float8, avg(abs(n.score - b.score))::float8, "
+            f"{_symptom_diffs('{t}.symptoms[{n}]')} {self.PAIRS}"
+        )
+        return _report(
+            await self._pool.fetchrow(totals, version),
+            await self._pool.fetchrow(totals, baseline),
+            await self._pool.fetchrow(compared, version, baseline),
+            await self._pool.fetch(
+                f"select b.constitution, n.constitution, count(*) {self.PAIRS} "
+                "and n.constitution is distinct from b.constitution group by 1, 2 order by 3 desc limit 20",
+                version, baseline,
+            ),
+            await self._pool.fetch(
+                f"select n.digest, b.score, n.score {self.PAIRS} order by abs(n.score - b.score) desc limit $3",
+                version, baseline, REPORT_MOVERS,
+            ),
+        )
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+
+
+SQLITE_SYMPTOM = "json_extract({t}.symptoms, '$[{i}]')"
+
+
+class SQLiteResults:
+    """本地 SQLite 结果库，表结构与 Postgres 相同 (症状向量存为 JSON 数组)"""
+
+    PAIRS = (
+        "from analysis_reanalysis n join analysis_reanalysis b on b.digest = n.digest "
+        "where n.version = ? and b.version = ? and n.error is null and b.error is null"
+    )
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+
+    async def open(self) -> None:
+        import sqlite3
+
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute(
+            """
+            create table if not exists analysis_reanalysis (
+                version text not null,
+                digest text not null,
+                model_version text,
+                constitution text,
+                score integer,
+                symptoms text,
+                result text,
+                error text,
+                created_at text not null,
+                primary key (version, digest)
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            create table if not exists reanalysis_runs (
+                run_id text primary key,
+                version text not null,
+                cursor text,
+                stats text not null,
+                done integer not null,
+                updated_at text not null
+            )
+            """
+        )
+
+    async def checkpoint(self, run_id: str) -> Optional[dict]:
+        row = self._conn.execute("select cursor, stats, done from reanalysis_runs where run_id = ?", (run_id,)).fetchone()
+        return {"cursor": row[0], "stats": json.loads(row[1]), "done": bool(row[2])} if row else None
+
+    def _commit(self, run_id: str, version: str, rows: list[ReanalysisRow], cursor: Optional[str],
+                stats: dict, done: bool) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "insert or replace into analysis_reanalysis "
+                "(version, digest, model_version, constitution, score, symptoms, result, error, created_at) "
+                "values (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (r.version, r.digest, r.model_version, r.constitution, r.score,
+                     json.dumps(r.symptoms) if r.symptoms else None, json.dumps(r.result) if r.result else None,
+                     r.error, r.created_at.isoformat())
+                    for r in rows
+                ],
+            )
+            self._conn.execute(
+                "insert or replace into reanalysis_runs (run_id, version, cursor, stats, done, updated_at) "
+                "values (?, ?, ?, ?, ?, ?)",
+                (run_id, version, cursor, json.dumps(stats), done, datetime.now(timezone.utc).isoformat()),
+            )
+
+    async def commit(self, run_id: str, version: str, rows: list[ReanalysisRow], cursor: Optional[str],
+                     stats: dict, done: bool) -> None:
+        await asyncio.to_thread(self._commit, run_id, version, rows, cursor, stats, done)
+
+    async def failed(self, version: str, after: Optional[str], limit: int) -> list[str]:
+        rows = self._conn.execute(
+            "select digest from analysis_reanalysis where version = ? and error is not null "
+            "and digest > ? order by digest limit ?",
+            (version, after or "", limit),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    async def previous_version(self, version: str) -> Optional[str]:
+        row = self._conn.execute(
+            "select version from reanalysis_runs where version <> ? order by updated_at desc limit 1", (version,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _report(self, version: str, baseline: str) -> dict:
+        totals = "select count(*), coalesce(sum(error is not null), 0) from analysis_reanalysis where version = ?"
+        compared = (
+            "select count(*), sum(n.constitution is not b.constitution), "
+            "avg(n.score - b.score), avg(abs(n.score - b.score)), "
+            f"{_symptom_diffs(SQLITE_SYMPTOM)} {self.PAIRS}"
+        )
+        return _report(
+            self._conn.execute(totals, (version,)).fetchone(),
+            self._conn.execute(totals, (baseline,)).fetchone(),
+            self._conn.execute(compared, (version, baseline)).fetchone(),
+            self._conn.execute(
+                f"select b.constitution, n.constitution, count(*) {self.PAIRS} "
+                "and n.constitution is not b.constitution group by 1, 2 order by 3 desc limit 20",
+                (version, baseline),
+            ).fetchall(),
+            self._conn.execute(
+                f"select n.digest, b.score, n.score {self.PAIRS} order by abs(n.score - b.score) desc limit ?",
+                (version, baseline, REPORT_MOVERS),
+            ).fetchall(),
+        )
+
+    async def report(self, version: str, baseline: str) -> dict:
+        return await asyncio.to_thread(self._report, version, baseline)
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def results_from_dsn(dsn: str):
+    """sqlite:///path 写入本地 SQLite 文件，postgres://... 写入 Postgres (例如 Supabase 连接串)"""
+    if dsn.startswith("sqlite:///"):
+        return SQLiteResults(dsn[len("sqlite:///"):])
+    return PostgresResults(dsn)
+
+
+# =============================================================================
+# 运行: 逐页分析 → 批量写入结果和进度
+# =============================================================================
+
+class Reanalysis:
+    """
+    一次重新分析运行 (run_id 为 "<版本>" 或重试失败时的 "<版本>:retry")
+
+    分析当前页的同时列出下一页；limit 限制本次调用最多分析的图片数 (试运行用，进度照常保存)。
+    返回的模型版本与 version 不同的结果 (路由到了其他模型或降级) 记为失败，可以之后重试。
+    """
+
+    def __init__(self, source, runner: PageRunner, sink, version: str, run_id: str,
+                 page_size: int = PAGE_SIZE, limit: Optional[int] = None, restart: bool = False):
+        self.source = source
+        self.runner = runner
+        self.sink = sink
+        self.version = version
+        self.run_id = run_id
+        self.page_size = page_size
+        self.limit = limit
+        self.restart = restart
+
+    def _row(self, ref: ImageRef, outcome: dict) -> ReanalysisRow:
+        if not outcome.get("success"):
+            return ReanalysisRow(ref.digest, self.version, None, None, outcome.get("reason") or outcome.get("error") or "failed")
+        version = outcome.get("version")
+        if version != self.version:
+            return ReanalysisRow(ref.digest, self.version, version, outcome["data"], f"served by {version}")
+        return ReanalysisRow(ref.digest, self.version, version, outcome["data"], None)
+
+    async def run(self) -> dict:
+        checkpoint = None if self.restart else await self.sink.checkpoint(self.run_id)
+        # 重试在上一轮完成后从头开始；目录运行总是接着上次的偏移量 (只分析新增图片)
+        if checkpoint is not None and checkpoint["done"] and self.run_id != self.version:
+            checkpoint = None
+        cursor = checkpoint["cursor"] if checkpoint else None
+        stats = checkpoint["stats"] if checkpoint else {"processed": 0, "ok": 0, "failed": 0, "seconds": 0.0}
+        print(f"Re-analysis {self.run_id}: " + (f"resuming at {cursor} ({stats['processed']} done)" if checkpoint else "starting"))
+
+        remaining = self.limit
+        started = time.perf_counter()
+        listing = asyncio.ensure_future(self.source.page(cursor, self._page_limit(remaining)))
+        while True:
+            refs, next_cursor = await listing
+            if not refs:
+                await self.sink.commit(self.run_id, self.version, [], cursor, stats, True)
+                break
+            if remaining is not None:
+                remaining -= len(refs)
+            if remaining is None or remaining > 0:
+                listing = asyncio.ensure_future(self.source.page(next_cursor, self._page_limit(remaining)))
+
+            page_started = time.perf_counter()
+            rows = [self._row(ref, outcome) for ref, outcome in zip(refs, await self.runner(refs))]
+            failed = sum(1 for row in rows if row.error)
+            stats["processed"] += len(rows)
+            stats["ok"] += len(rows) - failed
+            stats["failed"] += failed
+            stats["seconds"] = round(stats["seconds"] + time.perf_counter() - page_started, 1)
+            cursor = next_cursor
+            await self.sink.commit(self.run_id, self.version, rows, cursor, stats, False)
+            print(f"  {stats['processed']} done ({failed}/{len(rows)} failed on this page, "
+                  f"{len(rows) / (time.perf_counter() - page_started):.1f} images/s)")
+            if remaining is not None and remaining <= 0:
+                break
+
+        print(f"Re-analysis {self.run_id}: {stats} in {time.perf_counter() - started:.1f}s")
+        return stats
+
+    def _page_limit(self, remaining: Optional[int]) -> int:
+        return self.page_size if remaining is None else min(self.page_size, remaining)
+
+
+async def run_reanalysis(store: ObjectStore, runner: PageRunner, sink, version: str, retry_failed: bool = False,
+                    page_size: int = PAGE_SIZE, limit: Optional[int] = None, restart: bool = False) -> dict:
+    """目录运行或失败重试，结束后附上与上一个版本的对比报告"""
+    source = FailedSource(sink, version) if retry_failed else CatalogSource(store)
+    run_id = f"{version}:retry" if retry_failed else version
+    stats = await Reanalysis(source, runner, sink, version, run_id, page_size, limit, restart).run()
+    baseline = await sink.previous_version(version)
+    return {"version": version, "stats": stats,
+            "report": await sink.report(version, baseline) if baseline else None, "baseline": baseline}
+
+
+# =============================================================================
+# 本地执行: 进程池运行本地特征模型
+# =============================================================================
+
+_worker_store: Optional[ObjectStore] = None
+
+
+def _init_worker(store_dir: Optional[str]) -> None:
+    global _worker_store
+    _worker_store = LocalStore(store_dir) if store_dir else store_from_env()
+
+
+def _analyze_local(name: str) -> dict:
+    """在工作进程中: 读取图片 → 预处理 → 特征 → 本地结果 (与 TongueAnalyzer 的本地路由相同)"""
+    from modal_ai.features import LOCAL_VERSION, UnusableImageError, check_usable, extract_features, local_analysis
+    from modal_ai.preprocess import preprocess_image
+
+    try:
+        prepared = preprocess_image(_worker_store.get(name))
+        features = extract_features(prepared.image)
+        check_usable(features)
+        result = {**local_analysis(features), "model": LOCAL, "features": features.as_dict()}
+        return {"success": True, "data": result, "version": LOCAL_VERSION}
+    except UnusableImageError as e:
+        return {"success": False, "error": str(e), "reason": e.reason}
+    except Exception as e:
+        return {"success": False, "error": f"Analysis failed: {type(e).__name__}"}
+
+
+class LocalRunner:
+    """
+    每页的图片分给 workers 个进程 (每个进程自己读取桶中的图片)
+
+    version 是结果记入的版本: 调整特征阈值后还没改 LOCAL_VERSION 时可以先用别的名字试运行
+    """
+
+    def __init__(self, store_dir: Optional[str], workers: int, version: str):
+        self.version = version
+        self._pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(store_dir,))
+
+    async def __call__(self, refs: list[ImageRef]) -> list[dict]:
+        loop = asyncio.get_running_loop()
+        outcomes = await asyncio.gather(*(loop.run_in_executor(self._pool, _analyze_local, ref.name) for ref in refs))
+        return [{**outcome, "version": self.version} if outcome["success"] else outcome for outcome in outcomes]
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+
+async def _run(args) -> dict:
+    from modal_ai.features import LOCAL_VERSION
+
+    sink = results_from_dsn(args.dsn)
+    await sink.open()
+    try:
+        if args.command == "report":
+            baseline = args.baseline or await sink.previous_version(args.version)
+            if baseline is None:
+                raise SystemExit(f"No other version to compare {args.version} with")
+            return {"version": args.version, "baseline": baseline, "report": await sink.report(args.version, baseline)}
+        store = LocalStore(args.local) if args.local else store_from_env()
+        version = args.version or LOCAL_VERSION
+        runner = LocalRunner(args.local, args.workers, version)
+        try:
+            return await run_reanalysis(store, runner, sink, version, args.retry_failed, args.page_size, args.limit, args.restart)
+        finally:
+            runner.close()
+    finally:
+        await sink.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-analyze stored images and compare model versions.")
+    parser.add_argument("command", choices=("run", "report"))
+    parser.add_argument("--dsn", default=os.environ.get("REANALYSIS_DSN", "sqlite:///reanalysis.db"),
+                        help="Results database (sqlite:///path or postgres://...)")
+    parser.add_argument("--local", help="Directory standing in for the bucket")
+    parser.add_argument("--version", help="Version to write (run: defaults to the local model's) or report on")
+    parser.add_argument("--baseline", help="Version to compare with (defaults to the most recent other run)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 4, help="Analysis processes")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Images listed and analyzed per page")
+    parser.add_argument("--limit", type=int, help="Stop after this many images (progress is kept)")
+    parser.add_argument("--retry-failed", action="store_true", help="Re-run the images that failed in --version")
+    parser.add_argument("--restart", action="store_true", help="Ignore the saved progress")
+    args = parser.parse_args()
+    if args.command == "report" and not args.version:
+        parser.error("report needs --version")
+    print(json.dumps(asyncio.run(_run(args)), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# 多模型路由: 模型注册表、按实时延迟 / 错误率 / 成本预算为每个请求选择后端、影子流量对比
+#
+# MODEL_ROUTE 按优先顺序列出后端，例如
+#     gemini-2.0-flash-exp,gemini-2.0-flash-lite:0.4,local
+# 每个请求选第一个可用的后端，以下情况跳过:
+#   - circuit_open: 该模型的熔断器打开 (每个 Gemini 模型各有一份限流 / 重试 / 熔断)
+#   - budget: 加上本次调用会超出每个容器每小时的成本预算 (MODEL_COST_BUDGET)
+#   - slow / errors: 最近一段时间的 p95 延迟超过 MODEL_LATENCY_SLO，或错误率超过 MODEL_MAX_ERROR_RATE
+# slow / errors 只是 "软" 跳过: 所有后端都被跳过时，仍使用第一个只因软原因被跳过的后端。
+# 统计窗口按时间滑动，被跳过的模型没有新调用，旧样本过期后自然重新参与选择。
+
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Optional
+
+GEMINI = "gemini"
+LOCAL = "local"
+MOCK = "mock"
+
+# 已知模型每次调用的相对成本 (用于成本预算)；MODEL_ROUTE 中可以用 "名称:成本" 覆盖
+MODEL_COSTS = {
+    "gemini-2.0-flash-exp": 1.0,
+    "gemini-2.0-flash": 1.0,
+    "gemini-2.0-flash-lite": 0.4,
+    "gemini-1.5-flash": 0.8,
+    "gemini-1.5-flash-8b": 0.2,
+}
+
+# 软跳过原因: 所有后端都不可用时仍可以退回使用
+_SOFT = ("slow", "errors")
+
+
+def parse_route(spec: str) -> list[tuple[str, Optional[float]]]:
+    """"a,b:0.5,local" → [("a", None), ("b", 0.5), ("local", None)]"""
+    route = []
+    for item in spec.split(","):
+        name, _, cost = item.strip().partition(":")
+        if name:
+            route.append((name, float(cost) if cost else None))
+    return route
+
+
+class LiveStats:
+    """最近 window 秒内的调用记录: 调用数、p95 延迟、错误率"""
+
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self._calls: deque[tuple[float, float, bool]] = deque()  # (时间, 耗时, 是否成功)
+
+    def record(self, seconds: float, ok: bool) -> None:
+        now = time.monotonic()
+        self._calls.append((now, seconds, ok))
+        self._trim(now)
+
+    def _trim(self, now: float) -> None:
+        while self._calls and self._calls[0][0] < now - self.window:
+            self._calls.popleft()
+
+    def snapshot(self) -> dict:
+        self._trim(time.monotonic())
+        calls = len(self._calls)
+        if calls == 0:
+            return {"calls": 0, "p95": None, "error_rate": 0.0}
+        latencies = sorted(seconds for _, seconds, _ in self._calls)
+        errors = sum(1 for _, _, ok in self._calls if not ok)
+        return {
+            "calls": calls,
+            "p95": round(latencies[min(calls - 1, int(calls * 0.95))], 3),
+            "error_rate": round(errors / calls, 3),
+        }
+
+
+@dataclass
+class ModelBackend:
+    """注册表中的一个模型后端"""
+
+    name: str
+    kind: str                 # GEMINI / LOCAL / MOCK
+    version: str              # 写入 analysis_logs 的 model_version
+    cost: float = 0.0         # 每次调用的相对成本
+    model: Any = None         # genai.GenerativeModel (仅 GEMINI)
+    upstream: Any = None      # UpstreamGuard (仅 GEMINI)
+    stats: LiveStats = field(default_factory=LiveStats)
+
+    def circuit_open(self) -> bool:
+        return self.upstream is not None and self.upstream.breaker is not None and self.upstream.breaker.is_open()
+
+    def snapshot(self) -> dict:
+        data = {"kind": self.kind, "version": self.version, "cost": self.cost, **self.stats.snapshot()}
+        if self.upstream is not None and self.upstream.breaker is not None:
+            data["circuit"] = self.upstream.breaker.snapshot()["state"]
+        return data
+
+
+class ModelRouter:
+    """按优先顺序和实时统计为每个请求选择后端"""
+
+    def __init__(
+        self,
+        backends: list[ModelBackend],
+        latency_slo: float = 0.0,
+        max_error_rate: float = 1.0,
+        min_calls: int = 5,
+        budget: float = 0.0,
+        budget_window: float = 3600.0,
+        shadow: Optional[ModelBackend] = None,
+        shadow_rate: float = 0.0,
+        on_route: Optional[Callable[[str, str], None]] = None,
+    ):
+        if not backends:
+            raise ValueError("ModelRouter needs at least one backend")
+        self.backends = backends
+        self.latency_slo = latency_slo       # 0 表示不按延迟跳过
+        self.max_error_rate = max_error_rate
+        self.min_calls = min_calls           # 样本少于该数时不按统计跳过
+        self.budget = budget                 # 0 表示不限成本
+        self.budget_window = budget_window
+        self.shadow = shadow
+        self.shadow_rate = shadow_rate
+        self.on_route = on_route
+        self._spend: deque[tuple[float, float]] = deque()  # (时间, 成本)
+        self._spent = 0.0
+
+    def _skip_reason(self, backend: ModelBackend) -> Optional[str]:
+        if backend.circuit_open():
+            return "circuit_open"
+        if self.budget and backend.cost and self._spent + backend.cost > self.budget:
+            return "budget"
+        stats = backend.stats.snapshot()
+        if stats["calls"] >= self.min_calls:
+            if self.latency_slo and stats["p95"] > self.latency_slo:
+                return "slow"
+            if stats["error_rate"] > self.max_error_rate:
+                return "errors"
+        return None
+
+    def choose(self) -> tuple[Optional[ModelBackend], str]:
+        """
+        返回 (后端, 原因)。原因为 "primary" (首选后端可用)、前面的后端被跳过的原因，
+        或 "fallback_soft" (全部被跳过，退回第一个只因延迟 / 错误率被跳过的后端)。
+        所有后端都因熔断或预算不可用时返回 (None, 原因)，由调用方降级。
+        """
+        now = time.monotonic()
+        while self._spend and self._spend[0][0] < now - self.budget_window:
+            self._spent -= self._spend.popleft()[1]
+
+        first_reason, soft = None, None
+        for backend in self.backends:
+            reason = self._skip_reason(backend)
+            if reason is None:
+                return self._routed(backend, first_reason or "primary", now)
+            first_reason = first_reason or reason
+            if soft is None and reason in _SOFT:
+                soft = backend
+        if soft is not None:
+            return self._routed(soft, "fallback_soft", now)
+        if self.on_route is not None:
+            self.on_route("none", first_reason)
+        return None, first_reason
+
+    def _routed(self, backend: ModelBackend, reason: str, now: float) -> tuple[ModelBackend, str]:
+        if backend.cost:
+            self._spend.append((now, backend.cost))
+            self._spent += backend.cost
+        if self.on_route is not None:
+            self.on_route(backend.name, reason)
+        return backend, reason
+
+    def shadow_for(self, backend: ModelBackend) -> Optional[ModelBackend]:
+        """按 shadow_rate 抽样: 返回需要同时调用的影子后端 (与本次后端相同、熔断打开或超出预算时不调用)"""
+        shadow = self.shadow
+        if shadow is None or shadow is backend or random.random() >= self.shadow_rate:
+            return None
+        if shadow.circuit_open() or (self.budget and shadow.cost and self._spent + shadow.cost > self.budget):
+            return None
+        if shadow.cost:
+            self._spend.append((time.monotonic(), shadow.cost))
+            self._spent += shadow.cost
+        return shadow
+
+    def snapshot(self) -> dict:
+        return {
+            "route": [backend.name for backend in self.backends],
+            "shadow": self.shadow.name if self.shadow is not None else None,
+            "spent": round(self._spent, 3),
+            "budget": self.budget or None,
+            "models": {backend.name: backend.snapshot() for backend in self.backends},
+        }
+
+
+def agreement(primary: dict, shadow: dict) -> dict:
+    """两个模型对同一张图片结果的一致程度 (离线对比用)"""
+    symptoms = primary.get("symptoms", {})
+    other = shadow.get("symptoms", {})
+    diffs = [abs(symptoms[name] - other.get(name, 0.0)) for name in symptoms]
+    features = primary.get("tongue_features", {})
+    same_features = sum(1 for name, value in features.items() if shadow.get("tongue_features", {}).get(name) == value)
+    return {
+        "constitution": primary.get("constitution") == shadow.get("constitution"),
+        "score_diff": shadow.get("score", 0) - primary.get("score", 0),
+        "symptom_mae": round(sum(diffs) / len(diffs), 4) if diffs else None,
+        "features": round(same_features / len(features), 3) if features else None,
+    }
@@ -0,0 +1,72 @@
+# 分析结果的结构定义: Gemini 结构化输出 (JSON mode) 的 response_schema 和 Pydantic 校验模型
+#
+# 字段与 ANALYSIS_PROMPT 中描述的 JSON 结构一致，均由 backend.analysis_core 中的常量生成，
+# 增减症状或舌象特征时只需修改那里。
+
+from typing import Literal
+
+from pydantic import BaseModel, ConfigDict, Field, create_model, field_validator
+
+from backend.analysis_core import CONSTITUTIONS, FEATURE_NAMES, SYMPTOM_NAMES
+
+# 体质名称大小写不敏感匹配，例如 "damp heat" → "Damp Heat"
+_CONSTITUTION_LOOKUP = {name.lower(): name for name in CONSTITUTIONS}
+
+
+# Gemini response_schema (OpenAPI 子集): 约束模型只输出该结构的 JSON
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "constitution": {"type": "string", "enum": list(CONSTITUTIONS)},
+        "score": {"type": "integer"},
+        "tongue_features": {
+            "type": "object",
+            "properties": {name: {"type": "boolean"} for name in FEATURE_NAMES},
+            "required": list(FEATURE_NAMES),
+        },
+        "symptoms": {
+            "type": "object",
+            "properties": {name: {"type": "number"} for name in SYMPTOM_NAMES},
+            "required": list(SYMPTOM_NAMES),
+        },
+        "issues": {"type": "array", "items": {"type": "string"}},
+    },
+    "required": ["constitution", "score", "tongue_features", "symptoms", "issues"],
+}
+
+
+TongueFeatures = create_model(
+    "TongueFeatures",
+    __config__=ConfigDict(extra="ignore"),
+    **{name: (bool, ...) for name in FEATURE_NAMES},
+)
+
+Symptoms = create_model(
+    "Symptoms",
+    __config__=ConfigDict(extra="ignore"),
+    **{name: (float, Field(..., ge=0.0, le=1.0)) for name in SYMPTOM_NAMES},
+)
+
+
+class TongueAnalysis(BaseModel):
+    """模型输出的校验模型，校验失败抛出 pydantic.ValidationError"""
+
+    model_config = ConfigDict(extra="ignore")
+
+    constitution: Literal[CONSTITUTIONS]
+    score: int = Field(ge=0, le=100)
+    tongue_features: TongueFeatures
+    symptoms: Symptoms
+    issues: list[str] = Field(default_factory=list, max_length=10)
+
+    @field_validator("constitution", mode="before")
+    @classmethod
+    def _normalize_constitution(cls, value):
+        if isinstance(value, str):
+            return _CONSTITUTION_LOOKUP.get(value.strip().lower(), value)
+        return value
+
+
+def validate_analysis(data: dict) -> dict:
+    """校验并规范化模型输出，返回普通 dict"""
+    return TongueAnalysis.model_validate(data).model_dump()
@@ -0,0 +1,341 @@
+# 上游 (Gemini) 调用保护: 令牌桶限流、并发上限、带抖动的指数退避重试、熔断器、相同请求合并
+#
+# 每个容器一份，由该容器内所有并发请求共享。多容器部署时，容器数 × GEMINI_RPS
+# 不应超过项目的 Gemini 配额。
+
+import asyncio
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Optional
+
+# 可以重试的上游 HTTP 状态码: 限流 / 服务端错误 / 上游超时
+RETRYABLE_CODES = {429, 500, 502, 503, 504}
+
+
+class UpstreamBusyError(Exception):
+    """在截止时间内拿不到调用额度，或重试次数用尽"""
+
+    def __init__(self, message: str, retry_after: int = 5):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamBusyError):
+    """熔断器处于打开状态，不发起上游调用"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """google.api_core 的异常带有 HTTP 状态码 code 属性；单次调用超时也可以重试"""
+    if isinstance(error, TimeoutError):
+        return True
+    code = getattr(error, "code", None)
+    try:
+        return int(code) in RETRYABLE_CODES
+    except (TypeError, ValueError):
+        return False
+
+
+def _is_client_error(error: BaseException) -> bool:
+    try:
+        code = int(getattr(error, "code", None))
+    except (TypeError, ValueError):
+        return False
+    return 400 <= code < 500 and code != 429
+
+
+class TokenBucket:
+    """令牌桶: 平均每秒 rate 个请求，最多允许 burst 个突发"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self._updated is not None:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, deadline: float) -> None:
+        """取一个令牌；在 deadline (loop.time()) 之前拿不到时抛出 UpstreamBusyError"""
+        loop = asyncio.get_running_loop()
+        # 加锁保证先到先得，等待中的请求不会被后来者插队
+        async with self._lock:
+            now = loop.time()
+            self._refill(now)
+            wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.0
+            if now + wait > deadline:
+                raise UpstreamBusyError("Model rate limit reached, please retry shortly", retry_after=max(1, round(wait)))
+            if wait:
+                await asyncio.sleep(wait)
+                self._refill(loop.time())
+            self._tokens -= 1
+
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+
+
+class CircuitBreaker:
+    """
+    熔断器: 统计最近 window 秒内每次上游调用的结果和耗时
+
+    调用数不少于 min_calls 且失败率 ≥ error_rate 或慢调用 (≥ slow_call 秒) 比例 ≥ slow_rate 时
+    打开熔断，cooldown 秒内的调用直接失败；之后进入半开状态，只放行 probes 个探测调用:
+    探测成功则恢复 (清空统计)，失败则重新打开。状态变化时调用 on_transition(新状态)。
+    """
+
+    def __init__(
+        self,
+        window: float = 60,
+        min_calls: int = 10,
+        error_rate: float = 0.5,
+        slow_call: float = 20,
+        slow_rate: float = 0.5,
+        cooldown: float = 30,
+        probes: int = 1,
+        on_transition: Optional[Callable[[str], None]] = None,
+    ):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        self.probes = probes
+        self.on_transition = on_transition or (lambda state: None)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        # (时间, 是否失败, 是否慢调用)
+        self._calls: deque[tuple[float, bool, bool]] = deque()
+        self._failures = 0
+        self._slow = 0
+        self._probing = 0
+
+    def _transition(self, state: str) -> None:
+        if state != self.state:
+            self.state = state
+            self.on_transition(state)
+
+    def _trim(self, now: float) -> None:
+        while self._calls and self._calls[0][0] < now - self.window:
+            _, failed, slow = self._calls.popleft()
+            self._failures -= failed
+            self._slow -= slow
+
+    def _reset(self) -> None:
+        self._calls.clear()
+        self._failures = self._slow = 0
+
+    def is_open(self) -> bool:
+        """打开且冷却未结束 (此时不必排队等待上游名额)"""
+        return self.state == OPEN and time.monotonic() < self.opened_at + self.cooldown
+
+    def retry_after(self) -> int:
+        """距离下一次探测的秒数"""
+        if self.state != OPEN:
+            return 1
+        return max(1, round(self.opened_at + self.cooldown - time.monotonic()))
+
+    def allow(self) -> bool:
+        """是否可以发起一次调用；返回 True 后必须调用 record()"""
+        if self.state == OPEN:
+            if time.monotonic() < self.opened_at + self.cooldown:
+                return False
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing >= self.probes:
+                return False
+            self._probing += 1
+        return True
+
+    def record(self, ok: Optional[bool], seconds: float = 0.0) -> None:
+        """记录 allow() 之后那次调用的结果；ok=None 表示调用被取消，不计入统计"""
+        if self.state == HALF_OPEN:
+            self._probing = max(0, self._probing - 1)
+            if ok is None:
+                return
+            if ok and seconds < self.slow_call:
+                self._reset()
+                self._transition(CLOSED)
+            else:
+                self._open()
+            return
+        if ok is None or self.state == OPEN:
+            return
+
+        now = time.monotonic()
+        failed, slow = not ok, ok and seconds >= self.slow_call
+        self._calls.append((now, failed, slow))
+        self._failures += failed
+        self._slow += slow
+        self._trim(now)
+        total = len(self._calls)
+        if total >= self.min_calls and (
+            self._failures / total >= self.error_rate or self._slow / total >= self.slow_rate
+        ):
+            self._open()
+
+    def _open(self) -> None:
+        self.opened_at = time.monotonic()
+        self._reset()
+        self._transition(OPEN)
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        self._trim(now)
+        return {
+            "state": self.state,
+            "calls": len(self._calls),
+            "failures": self._failures,
+            "slow_calls": self._slow,
+            "retry_after": self.retry_after() if self.state == OPEN else None,
+        }
+
+
+class UpstreamGuard:
+    """
+    包装对 Gemini 的调用
+
+    slot()  限制同时进行的上游请求数 (流式响应在整个读取期间都占用名额)
+    call()  每次尝试消耗一个令牌，可重试错误按 full-jitter 指数退避重试，
+            所有等待和重试都不超过调用方给出的 deadline
+
+    传入 breaker 时，熔断打开期间 slot() 和 call() 立即抛出 CircuitOpenError，
+    每次尝试的结果和耗时都计入熔断统计。
+    """
+
+    def __init__(
+        self,
+        rate: float = 10,
+        burst: int = 20,
+        max_concurrency: int = 16,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        on_event: Optional[Callable[[str], None]] = None,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.breaker = breaker
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.on_event = on_event or (lambda event: None)
+
+    @asynccontextmanager
+    async def slot(self, deadline: float):
+        self._check_breaker()
+        try:
+            async with asyncio.timeout_at(deadline):
+                await self.semaphore.acquire()
+        except TimeoutError:
+            self.on_event("concurrency_limited")
+            raise UpstreamBusyError("Too many analyses in progress, please retry shortly") from None
+        try:
+            yield
+        finally:
+            self.semaphore.release()
+
+    def _circuit_open(self) -> CircuitOpenError:
+        self.on_event("circuit_open")
+        return CircuitOpenError("Model temporarily unavailable, please retry later", retry_after=self.breaker.retry_after())
+
+    def _check_breaker(self) -> None:
+        if self.breaker is not None and self.breaker.is_open():
+            raise self._circuit_open()
+
+    async def _attempt(self, fn: Callable[[], Awaitable[Any]], deadline: float) -> Any:
+        if self.breaker is None:
+            async with asyncio.timeout_at(deadline):
+                return await fn()
+        if not self.breaker.allow():
+            raise self._circuit_open()
+        started = time.monotonic()
+        ok = None
+        try:
+            async with asyncio.timeout_at(deadline):
+                result = await fn()
+            ok = True
+            return result
+        except Exception as e:
+            # 4xx (429 除外) 是请求本身的问题，不说明上游不健康
+            ok = None if _is_client_error(e) else False
+            raise
+        finally:
+            self.breaker.record(ok, time.monotonic() - started)
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], deadline: float) -> Any:
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            self._check_breaker()
+            try:
+                await self.bucket.acquire(deadline)
+            except UpstreamBusyError:
+                self.on_event("rate_limited")
+                raise
+            try:
+                return await self._attempt(fn, deadline)
+            except Exception as e:
+                if isinstance(e, CircuitOpenError) or not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if loop.time() + delay >= deadline:
+                    raise UpstreamBusyError(f"Model unavailable, please retry shortly ({e})") from e
+                self.on_event("retry")
+                print(f"🔁 Retrying model call in {delay:.2f}s after: {str(e)[:120]}")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+
+class Coalescer:
+    """
+    合并相同 key 的并发请求: 第一个请求 (leader) 真正调用上游，其余请求等待它的结果
+
+        future = coalescer.get(key)
+        if future is not None:
+            result = await asyncio.shield(future)
+        else:
+            with coalescer.lead(key) as future:
+                result = await compute()
+                future.set_result(result)
+    """
+
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    def get(self, key: str) -> Optional[asyncio.Future]:
+        return self._inflight.get(key)
+
+    def lead(self, key: str) -> "_Lead":
+        return _Lead(self._inflight, key)
+
+
+class _Lead:
+    def __init__(self, inflight: dict, key: str):
+        self._inflight = inflight
+        self._key = key
+
+    def __enter__(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # 没有跟随者时避免 "exception was never retrieved" 警告
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[self._key] = self._future = future
+        return future
+
+    def __exit__(self, exc_type, exc, tb):
+        self._inflight.pop(self._key, None)
+        if not self._future.done():
+            if isinstance(exc, Exception):
+                self._future.set_exception(exc)
+            else:
+                # leader 被取消或提前结束 (例如客户端断开)，跟随者收到错误而不是一直等待
+                self._future.set_exception(UpstreamBusyError("Duplicate request was cancelled, please retry"))
+        return False
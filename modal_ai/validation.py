@@ -0,0 +1,150 @@
+# Web 端点的请求校验: 认证、图片地址白名单、请求体解析
+#
+# 无效请求在读取请求体 (认证失败时) 或下载图片 / 调用模型之前就被拒绝，只做字符串和哈希运算，
+# 每次耗时在微秒级 (benchmarks/bench_rejection.py):
+#   - API Token 在容器启动时读取一次。API_TOKEN 可以用逗号分隔多个 (轮换时新旧同时有效)，
+#     只保存 SHA-256 摘要，用 hmac.compare_digest 逐个比较，耗时与 token 内容无关
+#   - image_url 必须落在允许的地址前缀下 (默认是 Supabase analysis-images 公开 bucket)，
+#     服务不会替调用方下载任意地址
+#   - 请求体用 Pydantic 从原始字节直接解析，字段缺失、类型或长度不对时返回 400
+#   - 分析记录的用户来自 X-User-Token 请求头中的 Supabase access token (Authorization 是服务的 API Token)，
+#     本地校验签名 (backend/auth.py)；请求体中的 user_id 一律忽略，没有 token 时按匿名记录
+
+import hashlib
+import hmac
+import os
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, field_validator, model_validator
+
+from backend.auth import InvalidToken, session_user
+from backend.image_fetch import MAX_URL_LENGTH, ImageUrlNotAllowed, ImageUrlPolicy
+from backend.jobs import check_webhook_url
+
+
+class RequestRejected(Exception):
+    """请求未通过校验: status 为应返回的 HTTP 状态码"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+class RequestGate:
+    """
+    认证和图片地址检查 (每个容器一份，创建后只读)
+
+    urls 没有前缀时不限制图片地址 (本地开发)。地址规则与本地后端共用 (backend/image_fetch.py ImageUrlPolicy)。
+    """
+
+    def __init__(self, tokens: list[str], urls: ImageUrlPolicy):
+        self._digests = [_digest(token) for token in tokens if token]
+        self._urls = urls
+
+    @classmethod
+    def from_env(cls) -> "RequestGate":
+        """
+        API_TOKEN: 逗号分隔的有效 token
+        IMAGE_URL_PREFIXES: 逗号分隔的允许地址前缀；未设置时为 SUPABASE_URL 下的公开 bucket，
+        两者都没有设置时不限制
+        """
+        return cls([token.strip() for token in os.environ.get("API_TOKEN", "").split(",")], ImageUrlPolicy.from_env())
+
+    @property
+    def restricts_urls(self) -> bool:
+        return self._urls.restricts
+
+    def authenticate(self, authorization: Optional[str]) -> None:
+        """校验 Authorization: Bearer <token>，失败时抛出 RequestRejected"""
+        if not self._digests:
+            raise RequestRejected(500, "Server configuration error: API_TOKEN not set")
+        token = (authorization or "").removeprefix("Bearer ").strip()
+        provided = _digest(token)
+        # 与每个有效 token 都比较一次，不提前退出
+        matched = False
+        for digest in self._digests:
+            matched |= hmac.compare_digest(provided, digest)
+        if not token or not matched:
+            raise RequestRejected(401, "Unauthorized: Invalid or missing API token")
+
+    def check_image_url(self, url: str) -> None:
+        """image_url 不在允许的前缀下时抛出 RequestRejected"""
+        try:
+            self._urls.check(url)
+        except ImageUrlNotAllowed as e:
+            raise RequestRejected(400, str(e)) from None
+
+
+def request_user(token: Optional[str]) -> Optional[str]:
+    """X-User-Token 对应的 Supabase 用户 ID；没有 token (或未设置 SUPABASE_JWT_SECRET) 时为 None，无效时抛出 RequestRejected(401)"""
+    try:
+        return session_user((token or "").removeprefix("Bearer ").strip())
+    except InvalidToken as e:
+        raise RequestRejected(401, f"Unauthorized: invalid user token ({e})") from None
+
+
+# =============================================================================
+# 请求体
+# =============================================================================
+
+class AnalyzeBody(BaseModel):
+    """analyze_tongue / analyze_tongue_stream 的请求体"""
+
+    model_config = ConfigDict(extra="ignore")
+
+    image_url: Optional[str] = Field(None, max_length=MAX_URL_LENGTH)
+    # 大小和格式由 decode_base64_image 检查 (UPLOAD_MAX_BYTES)
+    image_base64: Optional[str] = None
+
+    @model_validator(mode="after")
+    def _has_image(self):
+        if not self.image_url and not self.image_base64:
+            raise ValueError("Missing required field: image_url or image_base64")
+        return self
+
+    def urls(self) -> list[str]:
+        return [self.image_url] if self.image_url else []
+
+
+class JobBody(BaseModel):
+    """submit_job 的请求体"""
+
+    model_config = ConfigDict(extra="ignore")
+
+    image_url: str = Field(min_length=1, max_length=MAX_URL_LENGTH)
+    webhook_url: Optional[str] = Field(None, max_length=MAX_URL_LENGTH)
+
+    @field_validator("webhook_url")
+    @classmethod
+    def _public_webhook(cls, value):
+        # 只允许 https 的公网地址 (WEBHOOK_ALLOWED_HOSTS 可进一步限制)，不会替调用方请求内网
+        return check_webhook_url(value) if value is not None else None
+
+    def urls(self) -> list[str]:
+        return [self.image_url]
+
+
+class BatchBody(BaseModel):
+    """analyze_batch 的请求体 (数量上限 BATCH_MAX_URLS 由端点检查)"""
+
+    model_config = ConfigDict(extra="ignore")
+
+    image_urls: list[str] = Field(min_length=1)
+
+    def urls(self) -> list[str]:
+        return self.image_urls
+
+
+def parse_body(model: type[BaseModel], raw: bytes):
+    """从原始请求体解析请求模型，失败时抛出 RequestRejected(400)"""
+    try:
+        return model.model_validate_json(raw or b"{}")
+    except ValidationError as e:
+        error = e.errors(include_url=False)[0]
+        field = ".".join(str(part) for part in error["loc"])
+        message = error["msg"].removeprefix("Value error, ")
+        raise RequestRejected(400, f"Invalid request: {field}: {message}" if field else message) from None
@@ -1,35 +1,186 @@
-from PIL import Image
+"""
+Make dark backgrounds transparent for logo and product catalog images.
+
+    python remove_bg.py uploads/logo.png -o public
+    python remove_bg.py raw_catalog/ -o public/images --threshold 40 --feather 12
+
+Directories are processed recursively in parallel. Files whose source has not
+changed since the last run (same mtime/size, or same content hash) and that
+were produced with the same settings are skipped.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
 import numpy as np
+from PIL import Image
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp"}
+MANIFEST_NAME = ".remove_bg_manifest.json"
+
+
+def make_transparent(img, threshold=50, feather=0):
+    """
+    Return an RGBA copy of `img` with near-black pixels made transparent.
+
+    A pixel is background when its R, G and B are all below `threshold`.
+    The bright Neon Pink (255, 20, 147) and Neon Green (0, 255, 0) always
+    have one channel well above that. With `feather` > 0, pixels whose
+    brightest channel is within `feather` levels above the threshold get a
+    partial alpha, which softens the jagged edge around the artwork.
+    """
+    rgba = np.array(img.convert("RGBA"))
+
+    # Brightest channel per pixel; "all channels below threshold" == "peak below threshold"
+    peak = rgba[..., :3].max(axis=-1)
+    background = peak < threshold
+
+    if feather > 0:
+        ramp = np.clip((peak.astype(np.float32) - threshold) / feather, 0.0, 1.0)
+        rgba[..., 3] = (rgba[..., 3] * ramp).astype(np.uint8)
+
+    rgba[background] = 0  # Transparent black, like the original loop
+
+    return Image.fromarray(rgba, "RGBA")
+
+
+def remove_background(input_path, output_path, threshold=50, feather=0, trim=True):
+    img = make_transparent(Image.open(input_path), threshold, feather)
 
-def remove_background(input_path, output_path):
-    img = Image.open(input_path).convert("RGBA")
-    datas = img.getdata()
-
-    newData = []
-    # Threshold for "black" or "dark" background
-    # We want to keep the bright Neon Pink and Neon Green.
-    # Pink is roughly (255, 20, 147), Green is (0, 255, 0).
-    # Background is black (0,0,0) or dark gray.
-    
-    for item in datas:
-        # Check for black/dark pixels
-        # If R, G, and B are all low, it's background
-        if item[0] < 50 and item[1] < 50 and item[2] < 50:
-            newData.append((0, 0, 0, 0))  # Transparent
-        else:
-            newData.append(item)
-
-    img.putdata(newData)
-    
     # Optional: Trim empty space
-    bbox = img.getbbox()
-    if bbox:
-        img = img.crop(bbox)
-        
+    if trim:
+        bbox = img.getbbox()
+        if bbox:
+            img = img.crop(bbox)
+
     img.save(output_path, "PNG")
-    print(f"Saved to {output_path}")
+    return output_path
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def collect_jobs(inputs, output_dir, manifest):
+    """
+    Yield (source, destination, key) for every image under the given paths.
+
+    Files inside a directory input are keyed by their path relative to it and
+    keep that layout in the output. A single-file input is keyed by its
+    resolved path and written as <stem>.png, or <stem>-<hash>.png when another
+    source already owns that name, so same-named files from different
+    directories never overwrite each other.
+    """
+    owners = {entry["output"]: key for key, entry in manifest.items() if "output" in entry}
+    singles = []
+    for raw in inputs:
+        path = Path(raw)
+        if path.is_dir():
+            for source in sorted(path.rglob("*")):
+                if source.suffix.lower() in IMAGE_SUFFIXES:
+                    relative = str(source.relative_to(path).with_suffix(".png"))
+                    owners[relative] = relative
+                    yield source, output_dir / relative, relative
+        elif path.suffix.lower() in IMAGE_SUFFIXES:
+            singles.append(path)
+
+    for path in singles:
+        key = str(path.resolve())
+        name = manifest.get(key, {}).get("output") or path.stem + ".png"
+        if owners.setdefault(name, key) != key:
+            name = f"{path.stem}-{hashlib.blake2b(key.encode(), digest_size=4).hexdigest()}.png"
+            owners[name] = key
+        yield path, output_dir / name, key
+
+
+def is_unchanged(source, destination, entry, settings):
+    """Check the manifest entry: cheap mtime/size test first, content hash second."""
+    if entry is None or not destination.exists() or entry.get("settings") != settings:
+        return False, None
+    stat = source.stat()
+    if entry.get("mtime") == stat.st_mtime and entry.get("size") == stat.st_size:
+        return True, entry["hash"]
+    digest = file_hash(source)
+    return digest == entry.get("hash"), digest
+
+
+def process_one(job):
+    source, destination, settings = job
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    remove_background(source, destination, **settings)
+    return file_hash(source)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Make dark backgrounds transparent.")
+    parser.add_argument("inputs", nargs="+", help="Image files or directories")
+    parser.add_argument("-o", "--output", required=True, help="Output directory")
+    parser.add_argument("--threshold", type=int, default=50, help="Channel value below which a pixel is background")
+    parser.add_argument("--feather", type=int, default=0, help="Width of the soft alpha ramp above the threshold")
+    parser.add_argument("--no-trim", action="store_true", help="Keep the original canvas size")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Parallel worker processes")
+    parser.add_argument("--force", action="store_true", help="Reprocess files even if unchanged")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = output_dir / MANIFEST_NAME
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+
+    settings = {"threshold": args.threshold, "feather": args.feather, "trim": not args.no_trim}
+
+    pending = []
+    skipped = 0
+    for source, destination, key in collect_jobs(args.inputs, output_dir, manifest):
+        if not args.force:
+            unchanged, digest = is_unchanged(source, destination, manifest.get(key), settings)
+            if unchanged:
+                stat = source.stat()
+                manifest[key].update(mtime=stat.st_mtime, size=stat.st_size, hash=digest)
+                skipped += 1
+                continue
+        pending.append((key, source, destination))
+
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {
+                pool.submit(process_one, (source, destination, settings)): (key, source, destination)
+                for key, source, destination in pending
+            }
+            for future in as_completed(futures):
+                key, source, destination = futures[future]
+                try:
+                    digest = future.result()
+                except Exception as e:
+                    # One bad image must not lose the progress of the rest of the run
+                    failed += 1
+                    print(f"Failed {source}: {e}", file=sys.stderr)
+                    continue
+                stat = source.stat()
+                manifest[key] = {
+                    "hash": digest,
+                    "mtime": stat.st_mtime,
+                    "size": stat.st_size,
+                    "settings": settings,
+                    "output": str(destination.relative_to(output_dir)),
+                }
+                print(f"Saved to {destination}")
+    finally:
+        manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
 
-input_file = "/Users/jbxjbx/.gemini/antigravity/brain/01cd112f-0a7e-4113-bd9a-379c4cee65b2/uploaded_image_1767990313128.png"
-output_file = "/Users/jbxjbx/Desktop/Nourish Select/webpage development/public/logo.png"
+    print(f"Processed {len(pending) - failed} image(s), skipped {skipped} unchanged, {failed} failed")
+    if failed:
+        sys.exit(1)
 
-remove_background(input_file, output_file)
+if __name__ == "__main__":
+    main()
@@ -22,13 +22,55 @@ export default function ResultPage() {
 function AnalysisResultContent() {
     const searchParams = useSearchParams();
     const dataParam = searchParams.get('data');
+    const idParam = searchParams.get('id');
     const { t } = useLanguage();
     const [mounted, setMounted] = useState(false);
+    const [fetched, setFetched] = useState<any>(null);
+    const [loadState, setLoadState] = useState<'idle' | 'loading' | 'failed'>(idParam ? 'loading' : 'idle');
+    const [attempt, setAttempt] = useState(0);
 
     useEffect(() => {
         setMounted(true);
     }, []);
 
+    // Results are linked by their id and fetched from the AI service
+    // (GET /results/{id} locally, tongue-analyzer-result?result_id= on Modal).
+    // The service writes results in batches, so a fresh id can 404 for about a
+    // second: retry with backoff, then fall back to ?data= or show an error.
+    useEffect(() => {
+        if (!idParam) return;
+        const resultUrl = process.env.NEXT_PUBLIC_AI_RESULT_URL || 'http://localhost:8000/results/';
+        const delays = [500, 1000, 2000];
+        let cancelled = false;
+        setLoadState('loading');
+
+        const load = async () => {
+            for (let i = 0; i <= delays.length; i++) {
+                try {
+                    const res = await fetch(`${resultUrl}${encodeURIComponent(idParam)}`);
+                    const body = res.ok ? await res.json() : null;
+                    const data = body?.data ?? body;
+                    if (body?.success !== false && data?.constitution) {
+                        if (!cancelled) {
+                            setFetched(data);
+                            setLoadState('idle');
+                        }
+                        return;
+                    }
+                } catch (e) {
+                    console.error("Failed to load result", e);
+                }
+                if (cancelled || i === delays.length) break;
+                await new Promise(resolve => setTimeout(resolve, delays[i]));
+            }
+            if (!cancelled) setLoadState('failed');
+        };
+        load();
+        return () => {
+            cancelled = true;
+        };
+    }, [idParam, attempt]);
+
     // Define types for the result object
     interface Recommendation {
         id: string;
@@ -89,25 +131,24 @@ function AnalysisResultContent() {
         }
     };
 
-    if (dataParam) {
+    if (fetched || dataParam) {
         try {
-            const parsed = JSON.parse(decodeURIComponent(dataParam));
-            if (parsed.constitution) {
+            const parsed = fetched ?? JSON.parse(decodeURIComponent(dataParam as string));
+            if (parsed?.constitution) {
                 result = {
                     constitution: parsed.constitution,
                     score: parsed.score,
                     issues: parsed.issues,
                     tongue_features: parsed.tongue_features || result.tongue_features,
                     symptoms: parsed.symptoms || result.symptoms,
-                    recommendations: [
-                        {
-                            id: parsed.recommendation.productId,
-                            name: parsed.recommendation.name,
-                            type: 'Recommended',
-                            reason: parsed.recommendation.desc,
-                            link: '/shop/drinks'
-                        }
-                    ]
+                    // Ranked in-stock products; older responses only carry a single recommendation
+                    recommendations: (parsed.recommendations ?? (parsed.recommendation ? [parsed.recommendation] : [])).map((rec: any) => ({
+                        id: rec.productId,
+                        name: rec.name,
+                        type: 'Recommended',
+                        reason: rec.reason ?? rec.desc,
+                        link: rec.category === 'foot-masks' ? '/shop/foot-masks' : '/shop/drinks'
+                    }))
                 };
             }
         } catch (e) {
@@ -146,6 +187,28 @@ function AnalysisResultContent() {
 
     if (!mounted) return null;
 
+    // Without a ?data= payload to fall back on, don't render the placeholder result
+    if (!fetched && !dataParam && loadState !== 'idle') {
+        return (
+            <div className="min-h-screen bg-stone-50 flex items-center justify-center px-4 font-sans">
+                {loadState === 'loading' ? (
+                    <p className="text-stone-500">Loading result...</p>
+                ) : (
+                    <div className="text-center max-w-md space-y-6">
+                        <AlertTriangle className="w-10 h-10 mx-auto text-red-500" />
+                        <p className="text-stone-600">{t('analysis.result_unavailable')}</p>
+                        <div className="flex gap-3 justify-center">
+                            <Button onClick={() => setAttempt(n => n + 1)}>{t('analysis.retry')}</Button>
+                            <Button variant="outline" asChild>
+                                <Link href="/analysis/scan">{t('analysis.scan_again')}</Link>
+                            </Button>
+                        </div>
+                    </div>
+                )}
+            </div>
+        );
+    }
+
     return (
         <div className="min-h-screen bg-stone-50 py-12 px-4 font-sans">
             <div className="container max-w-6xl mx-auto">
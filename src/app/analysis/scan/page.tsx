@@ -11,6 +11,63 @@ import { createClient } from '@/utils/supabase/client';
 import { useLanguage } from '@/context/language-context';
 import { useFaceDetection } from '@/hooks/useFaceDetection';
 
+// Longest edge sent for analysis; the model service downsizes to 1024px anyway
+const MAX_UPLOAD_EDGE = 1024;
+const UPLOAD_JPEG_QUALITY = 0.85;
+
+// Draw a frame or image onto the canvas at most MAX_UPLOAD_EDGE px on its longest side
+const drawScaled = (
+    canvas: HTMLCanvasElement,
+    source: CanvasImageSource,
+    width: number,
+    height: number,
+    mirror = false,
+) => {
+    const scale = Math.min(1, MAX_UPLOAD_EDGE / Math.max(width, height));
+    canvas.width = Math.round(width * scale);
+    canvas.height = Math.round(height * scale);
+
+    const ctx = canvas.getContext('2d');
+    if (!ctx) return false;
+    // For front camera, flip the image horizontally
+    if (mirror) {
+        ctx.translate(canvas.width, 0);
+        ctx.scale(-1, 1);
+    }
+    ctx.drawImage(source, 0, 0, canvas.width, canvas.height);
+    return true;
+};
+
+const canvasToJpeg = (canvas: HTMLCanvasElement, name: string) =>
+    new Promise<File | null>((resolve) => {
+        canvas.toBlob(
+            (blob) => resolve(blob ? new File([blob], name, { type: 'image/jpeg' }) : null),
+            'image/jpeg',
+            UPLOAD_JPEG_QUALITY,
+        );
+    });
+
+// Base64 without the data: URL prefix, as expected by the analysis APIs
+const fileToBase64 = (file: Blob) =>
+    new Promise<string>((resolve, reject) => {
+        const reader = new FileReader();
+        reader.onloadend = () => {
+            const dataUrl = reader.result as string;
+            resolve(dataUrl.slice(dataUrl.indexOf(',') + 1));
+        };
+        reader.onerror = () => reject(reader.error);
+        reader.readAsDataURL(file);
+    });
+
+// Storage path named after the SHA-256 of the bytes (same digest the analysis cache uses),
+// so the same photo is stored once and can be looked up by URL without downloading it
+const contentAddressedName = async (file: File) => {
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    const hex = Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+    const extension = file.type === 'image/png' ? 'png' : file.type === 'image/webp' ? 'webp' : 'jpg';
+    return `originals/${hex}.${extension}`;
+};
+
 export default function ScanPage() {
     const router = useRouter();
     const { t } = useLanguage();
@@ -39,16 +96,31 @@ export default function ScanPage() {
         },
     });
 
-    // Handle file upload from local folder
-    const handleFileChange = (e: React.ChangeEvent<HTMLInputElement>) => {
+    // Show a captured or uploaded image; the object URL is revoked when it is replaced or cleared
+    const showImage = (file: File) => {
+        setCapturedFile(file);
+        setImagePreview((previous) => {
+            if (previous) URL.revokeObjectURL(previous);
+            return URL.createObjectURL(file);
+        });
+    };
+
+    // Handle file upload from local folder (downscaled like camera captures)
+    const handleFileChange = async (e: React.ChangeEvent<HTMLInputElement>) => {
         const file = e.target.files?.[0];
-        if (file) {
-            setCapturedFile(file);
-            const reader = new FileReader();
-            reader.onloadend = () => {
-                setImagePreview(reader.result as string);
-            };
-            reader.readAsDataURL(file);
+        if (!file) return;
+
+        try {
+            const bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+            const canvas = document.createElement('canvas');
+            const drawn = drawScaled(canvas, bitmap, bitmap.width, bitmap.height);
+            bitmap.close();
+            const scaled = drawn ? await canvasToJpeg(canvas, `upload-${Date.now()}.jpg`) : null;
+            showImage(scaled ?? file);
+        } catch (err) {
+            // Formats the browser can't decode (e.g. HEIC on some browsers) are sent as-is
+            console.warn('Could not downscale image, using original:', err);
+            showImage(file);
         }
     };
 
@@ -125,38 +197,25 @@ export default function ScanPage() {
     }, [stream]);
 
     // Capture photo from video stream
-    const capturePhoto = () => {
+    const capturePhoto = async () => {
         if (videoRef.current && canvasRef.current) {
             const video = videoRef.current;
             const canvas = canvasRef.current;
 
-            canvas.width = video.videoWidth;
-            canvas.height = video.videoHeight;
-
-            const ctx = canvas.getContext('2d');
-            if (ctx) {
-                // For front camera, flip the image horizontally
-                if (facingMode === 'user') {
-                    ctx.translate(canvas.width, 0);
-                    ctx.scale(-1, 1);
+            // Downscale while drawing, so only a ~1024px JPEG is ever encoded and sent
+            if (drawScaled(canvas, video, video.videoWidth, video.videoHeight, facingMode === 'user')) {
+                const file = await canvasToJpeg(canvas, `capture-${Date.now()}.jpg`);
+                if (file) {
+                    showImage(file);
+                    stopCamera();
                 }
-                ctx.drawImage(video, 0, 0);
-
-                // Convert to blob and create file
-                canvas.toBlob((blob) => {
-                    if (blob) {
-                        const file = new File([blob], `capture-${Date.now()}.jpg`, { type: 'image/jpeg' });
-                        setCapturedFile(file);
-                        setImagePreview(canvas.toDataURL('image/jpeg'));
-                        stopCamera();
-                    }
-                }, 'image/jpeg', 0.9);
             }
         }
     };
 
     // Clear current image and reset
     const clearImage = () => {
+        if (imagePreview) URL.revokeObjectURL(imagePreview);
         setImagePreview(null);
         setCapturedFile(null);
         if (fileInputRef.current) {
@@ -172,33 +231,28 @@ export default function ScanPage() {
         setError(null);
 
         try {
-            const fileName = `${Date.now()}-${capturedFile.name.replace(/[^a-zA-Z0-9.]/g, '')}`;
-
-            // 1. Upload to Supabase Storage
-            const { data, error: uploadError } = await supabase.storage
-                .from('analysis-images')
-                .upload(fileName, capturedFile);
+            const fileName = await contentAddressedName(capturedFile);
 
-            if (uploadError) {
-                console.error("Upload Error:", uploadError);
-                throw new Error("Failed to upload image. Please try again.");
-            }
-
-            // 2. Get Public URL
+            // 1. Work out where the image will be stored (no network call) so the analysis log can reference it
             const { data: { publicUrl } } = supabase.storage
                 .from('analysis-images')
                 .getPublicUrl(fileName);
 
-            console.log("Image uploaded:", publicUrl);
-
-            // 3. Call AI Backend (Modal in production, localhost in development)
+            // 2. Send the image itself to the AI Backend (Modal in production, localhost in development),
+            //    so the service doesn't have to download it back from Storage
+            //    The backend logs the analysis under the session's access token, not a user id in the body
             const backendUrl = process.env.NEXT_PUBLIC_AI_API_URL || 'http://localhost:8000/analyze';
+            const { data: { session } } = await supabase.auth.getSession();
             const response = await fetch(backendUrl, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    ...(session ? { Authorization: `Bearer ${session.access_token}` } : {}),
                 },
-                body: JSON.stringify({ image_url: publicUrl }),
+                body: JSON.stringify({
+                    image_base64: await fileToBase64(capturedFile),
+                    image_url: publicUrl,
+                }),
             });
 
             if (!response.ok) {
@@ -207,9 +261,26 @@ export default function ScanPage() {
 
             const result = await response.json();
 
-            // 4. Redirect with Result
-            const query = encodeURIComponent(JSON.stringify(result));
-            router.push(`/analysis/result?data=${query}`);
+            // 3. Persist to Supabase Storage in the background; the result doesn't wait on it.
+            //    An existing object means this exact photo is already stored.
+            supabase.storage
+                .from('analysis-images')
+                .upload(fileName, capturedFile, { upsert: false, cacheControl: '31536000' })
+                .then(({ error: uploadError }) => {
+                    if (uploadError && !/exists|duplicate/i.test(uploadError.message)) {
+                        console.error("Upload Error:", uploadError);
+                    }
+                });
+
+            // 4. Redirect with the short result id; the result page fetches the result by it.
+            //    Results the service didn't log (no result_id) still travel in the URL.
+            const resultId = result.result_id ?? result.data?.result_id;
+            if (resultId) {
+                router.push(`/analysis/result?id=${encodeURIComponent(resultId)}`);
+            } else {
+                const query = encodeURIComponent(JSON.stringify(result));
+                router.push(`/analysis/result?data=${query}`);
+            }
 
         } catch (err: any) {
             console.error("Analysis Error:", err);
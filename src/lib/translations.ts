@@ -65,6 +65,9 @@ export const translations = {
             camera_denied: 'Camera access denied. Please allow camera permissions.',
             align_tongue: 'Align Tongue Here',
             result_title: 'Your Constitution Analysis',
+            result_unavailable: 'We couldn\'t load this result. Check your connection and try again.',
+            retry: 'Try Again',
+            scan_again: 'New Scan',
             score: 'Health Score',
             issues: 'Detected Issues',
             recommendation: 'Recommended Protocol',
@@ -306,6 +309,9 @@ export const translations = {
             camera_denied: '无法访问摄像头，请检查权限。',
             align_tongue: '请将舌头对准此处',
             result_title: '您的体质分析报告',
+            result_unavailable: '无法加载此分析结果，请检查网络后重试。',
+            retry: '重试',
+            scan_again: '重新拍摄',
             score: '健康评分',
             issues: '检测到的问题',
             recommendation: '推荐调理方案',
@@ -547,6 +553,9 @@ export const translations = {
             camera_denied: 'カメラへのアクセスが拒否されました。',
             align_tongue: '舌をここに合わせてください',
             result_title: 'あなたの体質分析',
+            result_unavailable: '結果を読み込めませんでした。接続を確認して再試行してください。',
+            retry: '再試行',
+            scan_again: '新しく撮影',
             score: '健康スコア',
             issues: '検出された問題',
             recommendation: '推奨プロトコル',
@@ -0,0 +1,24 @@
+import random
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+
+def make_image(color=(200, 80, 80), size=(64, 48), fmt="JPEG") -> bytes:
+    """A small solid-colour image; different colours give different content hashes."""
+    buffer = BytesIO()
+    Image.new("RGB", size, color).save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+def make_tongue(seed=0, size=(240, 320)) -> bytes:
+    """A photo-like JPEG that passes the usability checks: a red tongue on a noisy skin-toned background."""
+    rng = random.Random(seed)
+    width, height = size
+    img = Image.effect_noise(size, 40).convert("RGB")
+    img = Image.blend(img, Image.new("RGB", size, (190, 140, 115)), 0.7)
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((width * 0.25, height * 0.35, width * 0.75, height * 0.85), fill=(rng.randint(180, 230), 70, 85))
+    buffer = BytesIO()
+    img.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
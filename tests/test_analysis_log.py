@@ -0,0 +1,131 @@
+import asyncio
+import sqlite3
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from backend.analysis_log import AnalysisLogRow, AnalysisLogWriter, SQLiteSink
+
+USER = str(uuid.uuid4())
+
+
+def row(score=80, user_id=USER, image_url="https://example.com/tongue.jpg", minutes=0) -> AnalysisLogRow:
+    return AnalysisLogRow(
+        user_id=user_id,
+        image_url=image_url,
+        result={"score": score, "constitution": "Balanced", "symptoms": {"fatigue": 0.2}},
+        latency_ms=12.5,
+        model_version="test-v1",
+        created_at=datetime(2026, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=minutes),
+    )
+
+
+def stored(path) -> list[tuple]:
+    with sqlite3.connect(path) as conn:
+        return conn.execute("select user_id, image_url, score from analysis_logs order by id").fetchall()
+
+
+def run_writer(path, rows, batch_size=100, before_start=None):
+    """Record rows, let the writer drain and stop; returns the writer."""
+    async def go():
+        sink = SQLiteSink(str(path))
+        if before_start is not None:
+            await sink.open()
+            before_start(sink._conn)
+        writer = AnalysisLogWriter(sink, batch_size=batch_size, flush_interval=0.05)
+        await writer.start()
+        for r in rows:
+            assert writer.record(r)
+        await writer.stop()
+        return writer
+    return asyncio.run(go())
+
+
+def test_rows_written_in_batches(tmp_path):
+    path = tmp_path / "logs.db"
+    writer = run_writer(path, [row(score=s, minutes=s) for s in range(5)], batch_size=2)
+
+    assert (writer.written, writer.dropped) == (5, 0)
+    assert [score for _, _, score in stored(path)] == [0, 1, 2, 3, 4]
+
+
+def test_invalid_user_id_stored_as_anonymous(tmp_path):
+    path = tmp_path / "logs.db"
+    writer = run_writer(path, [row(user_id="not-a-uuid"), row(user_id=USER.upper())])
+
+    assert writer.written == 2
+    assert [user_id for user_id, _, _ in stored(path)] == [None, USER]
+
+
+def test_bad_row_does_not_lose_its_batch(tmp_path):
+    def reject_bad_rows(conn):
+        # Stands in for a constraint the row violates (e.g. a user_id missing from auth.users)
+        conn.execute(
+            "create trigger reject_bad before insert on analysis_logs when new.image_url = 'bad' "
+            "begin select raise(abort, 'rejected'); end"
+        )
+        conn.commit()
+
+    path = tmp_path / "logs.db"
+    rows = [row(minutes=0), row(image_url="bad", minutes=1), row(minutes=2), row(minutes=3)]
+    writer = run_writer(path, rows, before_start=reject_bad_rows)
+
+    assert (writer.written, writer.dropped) == (3, 1)
+    assert "bad" not in [image_url for _, image_url, _ in stored(path)]
+
+
+def test_full_queue_drops_instead_of_blocking():
+    writer = AnalysisLogWriter(SQLiteSink(":memory:"), max_queue=1)
+
+    assert writer.record(row())
+    assert not writer.record(row())
+    assert writer.dropped == 1
+
+
+def test_history_stats_and_result(tmp_path):
+    rows = [row(score=60 + s, minutes=s) for s in range(3)]
+
+    async def go():
+        writer = AnalysisLogWriter(SQLiteSink(str(tmp_path / "logs.db")), flush_interval=0.05)
+        await writer.start()
+        for r in rows:
+            writer.record(r)
+        # Not readable by id until its batch is written
+        assert await writer.result(rows[0].id) is None
+        while writer.written < len(rows):
+            await asyncio.sleep(0.01)
+
+        page, cursor = await writer.sink.history(USER, limit=2)
+        rest, end = await writer.sink.history(USER, limit=2, cursor=cursor)
+        stats = await writer.sink.stats(USER)
+        found = await writer.result(rows[1].id)
+        missing = [await writer.result(str(uuid.uuid4())), await writer.result("not-an-id")]
+        await writer.stop()
+        return page, rest, end, stats, found, missing
+
+    page, rest, end, stats, found, missing = asyncio.run(go())
+
+    assert [item["score"] for item in page + rest] == [62, 61, 60]
+    assert end is None
+    assert stats.scans == 3
+    assert found == rows[1].result
+    assert missing == [None, None]
+
+
+def test_reads_wait_for_writes_off_the_event_loop(tmp_path):
+    async def go():
+        sink = SQLiteSink(str(tmp_path / "logs.db"))
+        await sink.open()
+        # Held as if a batch were being written
+        sink._lock.acquire()
+        reads = asyncio.gather(sink.stats(USER), sink.result(str(uuid.uuid4())), sink.history(USER, limit=5))
+        ticks = 0
+        while ticks < 5:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert not reads.done()
+        sink._lock.release()
+        stats, result, (items, _) = await reads
+        await sink.close()
+        return stats, result, items
+
+    assert asyncio.run(go()) == (None, None, [])
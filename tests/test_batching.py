@@ -0,0 +1,169 @@
+import asyncio
+import json
+import types
+
+import pytest
+
+import modal_ai.main as service
+from modal_ai.batching import MicroBatcher
+from modal_ai.parsing import PartialJSONParser
+from modal_ai.routing import GEMINI, ModelBackend
+from modal_ai.upstream import UpstreamGuard
+
+MODEL = "gemini-test"
+
+
+def analysis(tag: str) -> dict:
+    return {"constitution": "Balanced", "score": 80, "issues": [tag]}
+
+
+def image(tag: str) -> dict:
+    return {"mime_type": "image/jpeg", "data": tag.encode()}
+
+
+class FakeGemini:
+    """Answers every image in a request; a multi-image request gets one JSON array."""
+
+    def __init__(self, reply=None):
+        self.calls = []
+        self.reply = reply
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        self.calls.append((contents, kwargs))
+        await asyncio.sleep(0)
+        tags = [part["data"].decode() for part in contents if isinstance(part, dict)]
+        if self.reply is not None and len(tags) > 1:
+            text = self.reply
+        elif len(tags) > 1:
+            text = "```json\n" + json.dumps([analysis(tag) for tag in tags]) + "\n```"
+        else:
+            text = json.dumps(analysis(tags[0]))
+        return types.SimpleNamespace(text=text)
+
+
+class Events:
+    def __init__(self):
+        self.seen = []
+
+    def upstream_event(self, event: str) -> None:
+        self.seen.append(event)
+
+
+def analyzer(model: FakeGemini):
+    """The plain TongueAnalyzer class with just enough state for _generate."""
+    analyzer = service.TongueAnalyzer._get_user_cls()()
+    analyzer._batchers = {}
+    analyzer.metrics = Events()
+    backend = ModelBackend(MODEL, GEMINI, "v1", model=model, upstream=UpstreamGuard(rate=100, burst=100))
+    return analyzer, backend
+
+
+async def generate(analyzer, backend, tag: str) -> dict:
+    parser = PartialJSONParser()
+    deadline = asyncio.get_running_loop().time() + 5
+    contents = [service.ANALYSIS_PROMPT, f"hint for {tag}", image(tag)]
+    async for _ in analyzer._generate(backend, contents, False, deadline, parser):
+        pass
+    return parser.result()
+
+
+def run_concurrently(analyzer, backend, tags):
+    async def go():
+        return await asyncio.gather(*(generate(analyzer, backend, tag) for tag in tags))
+    return asyncio.run(go())
+
+
+@pytest.fixture(autouse=True)
+def structured_output(monkeypatch):
+    monkeypatch.setattr(service, "BATCH_MAX_SIZE", 4)
+    monkeypatch.setattr(service, "BATCH_MAX_WAIT_MS", 20)
+    monkeypatch.setattr(service, "STRUCTURED_OUTPUT", True)
+    # google-generativeai only exists inside the Modal image
+    monkeypatch.setattr(service, "genai", types.SimpleNamespace(GenerationConfig=dict), raising=False)
+
+
+def test_concurrent_calls_share_one_request():
+    model = FakeGemini()
+    analyzer_, backend = analyzer(model)
+
+    results = run_concurrently(analyzer_, backend, ["a", "b", "c"])
+
+    assert [r["issues"] for r in results] == [["a"], ["b"], ["c"]]
+    assert len(model.calls) == 1
+    contents, kwargs = model.calls[0]
+    assert contents[0] == service.BATCH_PROMPT.format(count=3)
+    assert service.ANALYSIS_PROMPT not in contents
+    # Every image keeps its own label and feature hint
+    assert contents[1:4] == ["Image 1:", "hint for a", image("a")]
+    assert kwargs["generation_config"]["response_schema"]["type"] == "array"
+    assert analyzer_.metrics.seen == ["batched"]
+
+
+def test_batches_are_capped_at_max_size():
+    model = FakeGemini()
+    analyzer_, backend = analyzer(model)
+
+    tags = [str(i) for i in range(6)]
+    results = run_concurrently(analyzer_, backend, tags)
+
+    assert [r["issues"] for r in results] == [[tag] for tag in tags]
+    assert sorted(sum(isinstance(p, dict) for p in contents) for contents, _ in model.calls) == [2, 4]
+
+
+def test_single_call_uses_the_plain_prompt():
+    model = FakeGemini()
+    analyzer_, backend = analyzer(model)
+
+    results = run_concurrently(analyzer_, backend, ["solo"])
+
+    assert results[0]["issues"] == ["solo"]
+    contents, kwargs = model.calls[0]
+    assert contents[0] == service.ANALYSIS_PROMPT
+    assert kwargs == {}
+    assert analyzer_.metrics.seen == []
+
+
+def test_unusable_batch_output_is_retried_per_image():
+    model = FakeGemini(reply=json.dumps([analysis("only one")]))
+    analyzer_, backend = analyzer(model)
+
+    results = run_concurrently(analyzer_, backend, ["a", "b"])
+
+    assert [r["issues"] for r in results] == [["a"], ["b"]]
+    assert len(model.calls) == 3
+    assert analyzer_.metrics.seen == ["batched", "batch_split"]
+
+
+def test_batching_disabled(monkeypatch):
+    monkeypatch.setattr(service, "BATCH_MAX_WAIT_MS", 0)
+    model = FakeGemini()
+    analyzer_, backend = analyzer(model)
+
+    run_concurrently(analyzer_, backend, ["a", "b"])
+
+    assert len(model.calls) == 2
+    assert analyzer_._batchers == {}
+
+
+def test_item_errors_only_reach_their_caller():
+    async def handler(items):
+        return [ValueError(item) if item == "bad" else item.upper() for item in items]
+
+    async def go():
+        batcher = MicroBatcher(handler, max_batch_size=8, max_wait_ms=5)
+        return await asyncio.gather(batcher.submit("ok"), batcher.submit("bad"), return_exceptions=True)
+
+    ok, bad = asyncio.run(go())
+    assert ok == "OK"
+    assert isinstance(bad, ValueError)
+
+
+def test_handler_failure_reaches_the_whole_batch():
+    async def handler(items):
+        raise RuntimeError("upstream down")
+
+    async def go():
+        batcher = MicroBatcher(handler, max_batch_size=8, max_wait_ms=5)
+        return await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(go()))
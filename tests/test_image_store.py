@@ -0,0 +1,244 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+from backend.analysis_log import SQLiteSink
+from backend.image_store import ImageRetention, LocalStore, SQLiteReferences, SupabaseStore, inference_name, thumb_name
+from backend.result_cache import content_hash
+from tests.images import make_image
+
+RED, BLUE = make_image((200, 80, 80)), make_image((40, 60, 220))
+GREEN_PNG = make_image((60, 180, 90), fmt="PNG")
+BASE = "https://project.supabase.co/storage/v1/object/public/analysis-images/"
+
+
+def upload(store: LocalStore, name: str, data: bytes, age_days: float = 2) -> None:
+    path = store.root / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    then = time.time() - age_days * 86400
+    os.utime(path, (then, then))
+
+
+def logs_db(path, names: list[str]) -> str:
+    """An analysis_logs file with one row pointing at each object."""
+    sink = SQLiteSink(str(path))
+    asyncio.run(sink.open())
+    sink._conn.executemany(
+        "insert into analysis_logs (image_url, created_at) values (?, '2026-01-01')", [(BASE + n,) for n in names]
+    )
+    sink._conn.commit()
+    asyncio.run(sink.close())
+    return str(path)
+
+
+def image_urls(path) -> list[str]:
+    with sqlite3.connect(path) as conn:
+        return [url.removeprefix(BASE) for (url,) in conn.execute("select image_url from analysis_logs order by id")]
+
+
+def names(store: LocalStore) -> set[str]:
+    return {str(p.relative_to(store.root)) for p in store.root.rglob("*") if p.is_file()}
+
+
+class FailingDeleteStore(LocalStore):
+    """Refuses to delete one object, like a bucket returning an error for it."""
+
+    def __init__(self, root, refuse: str):
+        super().__init__(root)
+        self.refuse = refuse
+
+    def delete(self, names: list[str]) -> None:
+        if self.refuse in names:
+            raise OSError(f"cannot delete {self.refuse}")
+        super().delete(names)
+
+
+class FakeSupabaseStorage:
+    """
+    The Storage REST calls SupabaseStore makes, over an in-memory bucket.
+
+    Like the real listing, folders (id and created_at null) come first and
+    count toward limit and offset.
+    """
+
+    def __init__(self):
+        self.objects: dict[str, tuple[bytes, float]] = {}
+
+    def upload(self, name: str, data: bytes, age_days: float = 2) -> None:
+        self.objects[name] = (data, time.time() - age_days * 86400)
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.removeprefix("/storage/v1/object")
+        if path.startswith("/list/"):
+            return self._list(json.loads(request.content))
+        if request.method == "DELETE":
+            for name in json.loads(request.content)["prefixes"]:
+                self.objects.pop(name, None)
+            return httpx.Response(200, json=[])
+        name = path.split("/", 2)[2]
+        if request.method == "POST":
+            if name in self.objects:
+                return httpx.Response(409, json={"message": "The resource already exists"})
+            self.objects[name] = (request.content, time.time())
+            return httpx.Response(200, json={})
+        if name not in self.objects:
+            return httpx.Response(404)
+        return httpx.Response(200, content=b"" if request.method == "HEAD" else self.objects[name][0])
+
+    def _list(self, body: dict) -> httpx.Response:
+        prefix = body["prefix"] + "/" if body["prefix"] else ""
+        folders, files = set(), []
+        for name, (data, created_at) in self.objects.items():
+            if not name.startswith(prefix):
+                continue
+            head, sep, _ = name[len(prefix):].partition("/")
+            if sep:
+                folders.add(head)
+            else:
+                files.append((created_at, head, len(data)))
+        items = [{"name": f, "id": None, "created_at": None, "metadata": None} for f in sorted(folders)]
+        items += [
+            {"name": n, "id": n, "created_at": datetime.fromtimestamp(t, timezone.utc).isoformat(), "metadata": {"size": size}}
+            for t, n, size in sorted(files)
+        ]
+        return httpx.Response(200, json=items[body["offset"]:body["offset"] + body["limit"]])
+
+
+def supabase_store(fake: FakeSupabaseStorage) -> SupabaseStore:
+    store = SupabaseStore("https://project.supabase.co", "service-key")
+    store._client = httpx.Client(base_url="https://project.supabase.co/storage/v1", transport=httpx.MockTransport(fake.handler))
+    return store
+
+
+def test_ingest_moves_uploads_and_drops_duplicates(tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    upload(store, "1700000000-a.jpg", RED)
+    upload(store, "1700000001-b.jpg", RED)
+    upload(store, "1700000002-c.png", GREEN_PNG)
+    upload(store, "1700000003-fresh.jpg", BLUE, age_days=0)
+    db = logs_db(tmp_path / "logs.db", ["1700000000-a.jpg", "1700000001-b.jpg"])
+
+    stats = ImageRetention(store, references=SQLiteReferences(db), batch_size=2).ingest()
+
+    red, png = content_hash(RED), content_hash(GREEN_PNG)
+    assert stats == {"moved": 2, "duplicates": 1, "relinked": 2, "failed": 0}
+    assert names(store) == {
+        "1700000003-fresh.jpg",
+        f"originals/{red}.jpg", thumb_name(red), inference_name(red),
+        f"originals/{png}.png", thumb_name(png), inference_name(png),
+    }
+    assert image_urls(db) == [f"originals/{red}.jpg"] * 2
+
+
+def test_ingest_skips_unreadable_uploads(tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    upload(store, "1700000000-notes.txt", b"not an image")
+    upload(store, "1700000001-a.jpg", RED)
+
+    stats = ImageRetention(store).ingest()
+
+    assert (stats["moved"], stats["failed"]) == (1, 1)
+    assert "1700000000-notes.txt" in names(store)
+
+
+def test_derive_creates_missing_copies(tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    red, blue = content_hash(RED), content_hash(BLUE)
+    upload(store, f"originals/{red}.jpg", RED)
+    upload(store, f"originals/{blue}.jpg", BLUE)
+    upload(store, thumb_name(blue), b"existing thumb")
+
+    stats = ImageRetention(store).derive()
+
+    assert stats == {"checked": 2, "failed": 0}
+    for name in (thumb_name(red), inference_name(red), inference_name(blue)):
+        assert store.exists(name)
+    assert store.get(thumb_name(blue)) == b"existing thumb"
+
+
+def test_prune_deletes_expired_originals_and_relinks(tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    red, blue = content_hash(RED), content_hash(BLUE)
+    upload(store, f"originals/{red}.jpg", RED, age_days=40)
+    upload(store, f"originals/{blue}.jpg", BLUE, age_days=1)
+    db = logs_db(tmp_path / "logs.db", [f"originals/{red}.jpg", f"originals/{blue}.jpg"])
+
+    stats = ImageRetention(store, retention_days=30, references=SQLiteReferences(db)).prune()
+
+    assert (stats["deleted"], stats["deleted_bytes"], stats["relinked"], stats["kept"]) == (1, len(RED), 1, 0)
+    assert not store.exists(f"originals/{red}.jpg")
+    # Derived copies were made before the only original went away
+    assert store.exists(thumb_name(red)) and store.exists(inference_name(red))
+    assert store.exists(f"originals/{blue}.jpg")
+    assert image_urls(db) == [thumb_name(red), f"originals/{blue}.jpg"]
+
+
+def test_dry_run_changes_nothing(tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    upload(store, "1700000000-a.jpg", RED, age_days=40)
+    before = names(store)
+
+    stats = ImageRetention(store, retention_days=30, dry_run=True).run()
+
+    assert stats["ingest"]["moved"] == 1
+    assert names(store) == before
+
+
+def test_failed_delete_is_counted_per_object(tmp_path):
+    red, blue = content_hash(RED), content_hash(BLUE)
+    store = FailingDeleteStore(str(tmp_path / "bucket"), refuse=f"originals/{red}.jpg")
+    upload(store, f"originals/{red}.jpg", RED, age_days=40)
+    upload(store, f"originals/{blue}.jpg", BLUE, age_days=41)
+
+    stats = ImageRetention(store, retention_days=30).prune()
+
+    assert (stats["deleted"], stats["kept"]) == (1, 1)
+    assert store.exists(f"originals/{red}.jpg")
+    assert not store.exists(f"originals/{blue}.jpg")
+
+
+def test_listing_with_folders_pages_through_everything(tmp_path):
+    fake = FakeSupabaseStorage()
+    images = [make_image((20 * i, 100, 100)) for i in range(7)]
+    for i, data in enumerate(images):
+        fake.upload(f"17000000{i:02d}-scan.jpg", data)
+    # An existing layout: the root listing starts with three folder entries
+    digest = content_hash(images[0])
+    fake.upload(f"originals/{digest}.jpg", images[0], age_days=40)
+    fake.upload(thumb_name(digest), b"thumb")
+    fake.upload(inference_name(digest), b"copy")
+    store = supabase_store(fake)
+
+    page = store.list_page("", 4, 0)
+    assert [obj.folder for obj in page] == [True, True, True, False]
+
+    retention = ImageRetention(store, retention_days=30, batch_size=3)
+    ingest = retention.ingest()
+    prune = retention.prune()
+
+    assert (ingest["moved"], ingest["duplicates"], ingest["failed"]) == (6, 1, 0)
+    assert not [name for name in fake.objects if "/" not in name]
+    assert all(f"originals/{content_hash(data)}.jpg" in fake.objects for data in images[1:])
+    # The old original went after the uploads; its copies were already there
+    assert (prune["deleted"], prune["kept"]) == (1, 0)
+
+
+def test_local_store_lists_folders_like_supabase(tmp_path):
+    store = LocalStore(str(tmp_path / "bucket"))
+    for i in range(5):
+        upload(store, f"17000000{i:02d}-scan.jpg", make_image((40 * i, 60, 60)))
+    for folder in ("originals", "thumbs", "inference"):
+        (store.root / folder).mkdir()
+
+    assert [obj.folder for obj in store.list_page("", 10, 0)] == [True] * 3 + [False] * 5
+
+    stats = ImageRetention(store, batch_size=2).ingest()
+
+    assert stats["moved"] == 5
+    assert [obj.folder for obj in store.list_page("", 10, 0)] == [True] * 3
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import types
+
+import pydantic
+import pytest
+
+import modal_ai.main as service
+from backend.analysis_core import FEATURE_NAMES, SYMPTOM_NAMES
+from modal_ai.parsing import PartialJSONParser
+from modal_ai.routing import GEMINI, ModelBackend
+from modal_ai.schema import validate_analysis
+from modal_ai.upstream import UpstreamGuard
+
+
+def analysis(**overrides) -> dict:
+    return {
+        "constitution": "Damp Heat",
+        "score": 72,
+        "tongue_features": {name: i % 2 == 0 for i, name in enumerate(FEATURE_NAMES)},
+        "symptoms": {name: 0.1 * (i + 1) for i, name in enumerate(SYMPTOM_NAMES)},
+        "issues": ["Yellow coating", "Red tip"],
+        **overrides,
+    }
+
+
+def feed_in_chunks(text: str, size: int = 7) -> tuple[PartialJSONParser, list]:
+    parser = PartialJSONParser()
+    fields = []
+    for i in range(0, len(text), size):
+        fields.extend(parser.feed(text[i:i + size]))
+    return parser, fields
+
+
+def test_fields_arrive_as_they_complete():
+    parser = PartialJSONParser()
+
+    assert parser.feed('{"constitution": "Damp Heat", "sco') == [("constitution", "Damp Heat")]
+    assert parser.feed('re": 72, ') == [("score", 72)]
+    assert parser.feed('"issues": ["a, b", "{c}"]}') == [("issues", ["a, b", "{c}"])]
+    assert parser.done
+    assert parser.result() == {"constitution": "Damp Heat", "score": 72, "issues": ["a, b", "{c}"]}
+    assert not parser.salvaged
+
+
+def test_markdown_fences_are_skipped():
+    data = analysis()
+    parser, fields = feed_in_chunks("```json\n" + json.dumps(data, indent=2) + "\n```")
+
+    assert [name for name, _ in fields] == list(data)
+    assert parser.result() == data
+    assert parser.text.startswith("```json")
+
+
+def test_truncated_output_is_salvaged():
+    data = analysis()
+    text = json.dumps(data)
+    # Cut the response off inside the last field
+    parser, _ = feed_in_chunks(text[:text.index('"issues"') + 12])
+
+    result = parser.result()
+    assert parser.salvaged
+    assert result == {name: data[name] for name in ("constitution", "score", "tongue_features", "symptoms")}
+
+
+def test_salvaged_output_still_validates_when_complete_enough():
+    data = analysis()
+    # Everything is there except the closing brace
+    parser, _ = feed_in_chunks(json.dumps(data)[:-1] + ', "notes": "cut off')
+
+    assert validate_analysis(parser.result())["constitution"] == data["constitution"]
+    assert parser.salvaged
+
+
+def test_no_fields_is_an_error():
+    parser, _ = feed_in_chunks("I could not see a tongue in this image.")
+    with pytest.raises(ValueError):
+        parser.result()
+
+
+def test_validation_normalizes_and_checks_ranges():
+    result = validate_analysis(analysis(constitution=" damp heat ", extra="ignored"))
+    assert result["constitution"] == "Damp Heat"
+    assert "extra" not in result
+
+    with pytest.raises(pydantic.ValidationError):
+        validate_analysis(analysis(score=140))
+    with pytest.raises(pydantic.ValidationError):
+        validate_analysis(analysis(symptoms={**analysis()["symptoms"], "fatigue": 1.5}))
+    with pytest.raises(pydantic.ValidationError):
+        validate_analysis(analysis(constitution="Wind Cold"))
+
+
+# -- Parse → repair in TongueAnalyzer ----------------------------------------
+
+
+class Metrics:
+    def __init__(self):
+        self.outcomes = []
+
+    def observe(self, name, seconds):
+        pass
+
+    def parse_result(self, outcome):
+        self.outcomes.append(outcome)
+
+
+class RepairModel:
+    def __init__(self, reply: str):
+        self.reply = reply
+        self.prompts = []
+
+    async def generate_content_async(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        return types.SimpleNamespace(text=self.reply)
+
+
+def parse(text: str, repair_reply: str):
+    analyzer = service.TongueAnalyzer._get_user_cls()()
+    analyzer.metrics = Metrics()
+    model = RepairModel(repair_reply)
+    backend = ModelBackend("gemini-test", GEMINI, "v1", model=model, upstream=UpstreamGuard())
+    parser, _ = feed_in_chunks(text)
+    result, info = asyncio.run(analyzer._parse_response(parser, backend))
+    return result, info, model, analyzer.metrics.outcomes
+
+
+def test_valid_output_needs_no_repair():
+    result, info, model, outcomes = parse(json.dumps(analysis()), "unused")
+    assert result["score"] == analysis()["score"]
+    assert info["outcome"] == "ok" and outcomes == ["ok"]
+    assert model.prompts == []
+
+
+def test_salvaged_output_is_used_without_repair():
+    result, info, model, _ = parse(json.dumps(analysis())[:-1] + ', "notes": "cut', "unused")
+    assert result is not None
+    assert info["outcome"] == "salvaged"
+    assert model.prompts == []
+
+
+def test_invalid_output_is_repaired_once():
+    truncated = json.dumps(analysis())[:60]
+    result, info, model, outcomes = parse(truncated, "```json\n" + json.dumps(analysis()) + "\n```")
+
+    assert result == validate_analysis(analysis())
+    assert info["outcome"] == "repaired" and outcomes == ["repaired"]
+    assert len(model.prompts) == 1
+    assert truncated in model.prompts[0]
+
+
+def test_failed_repair_gives_up():
+    result, info, model, outcomes = parse('{"score": 500}', '{"score": 500}')
+    assert result is None
+    assert info["outcome"] == "failed" and outcomes == ["failed"]
+    assert len(model.prompts) == 1
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import backend.main as backend_main
+from backend.image_fetch import ImageFetcher, ImageTooLargeError, ImageUrlNotAllowed, ImageUrlPolicy, NotAnImageError
+from backend.result_cache import MemoryCache, SQLiteCache, cache_key, content_hash
+from tests.images import make_image
+
+RESULT = {"score": 80, "constitution": "Balanced"}
+PREFIX = "https://project.supabase.co/storage/v1/object/public/analysis-images/"
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def make_cache(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "memory":
+            return MemoryCache(**kwargs)
+        return SQLiteCache(str(tmp_path / "cache.db"), **kwargs)
+    return make
+
+
+def test_hit_and_miss(make_cache):
+    cache = make_cache()
+    image = make_image()
+    key = cache_key(image, "v1")
+
+    assert cache.get(key) is None
+    cache.set(key, RESULT)
+    assert cache.get(key) == RESULT
+    # Same bytes, same version
+    assert cache.get(cache_key(bytes(image), "v1")) == RESULT
+    # Another image or a new model/prompt version misses
+    assert cache.get(cache_key(make_image(color=(0, 0, 255)), "v1")) is None
+    assert cache.get(cache_key(image, "v2")) is None
+
+
+def test_expired_entries_only_served_stale(make_cache, monkeypatch):
+    cache = make_cache(ttl=10, stale_ttl=60)
+    key = cache_key(make_image(), "v1")
+    cache.set(key, RESULT)
+
+    now = time.time()
+    monkeypatch.setattr("backend.result_cache.time.time", lambda: now + 30)
+    assert cache.get(key) is None
+    assert cache.get(key, allow_stale=True) == RESULT
+
+    monkeypatch.setattr("backend.result_cache.time.time", lambda: now + 100)
+    assert cache.get(key, allow_stale=True) is None
+
+
+class _RedirectHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(302)
+        self.send_header("Location", "http://169.254.169.254/latest/meta-data/")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_fetch_from_local_server(image_server):
+    root, base = image_server
+    image = make_image()
+    (root / "tongue.jpg").write_bytes(image)
+    (root / "page.html").write_text("<html></html>")
+    redirect = ThreadingHTTPServer(("127.0.0.1", 0), _RedirectHandler)
+    threading.Thread(target=redirect.serve_forever, daemon=True).start()
+
+    async def fetch():
+        fetcher = ImageFetcher(max_bytes=len(image))
+        try:
+            assert await fetcher.fetch_bytes(f"{base}/tongue.jpg") == image
+            with pytest.raises(NotAnImageError):
+                await fetcher.fetch_bytes(f"{base}/page.html")
+            # Redirects are not followed
+            with pytest.raises(httpx.HTTPStatusError):
+                await fetcher.fetch_bytes(f"http://127.0.0.1:{redirect.server_address[1]}/tongue.jpg")
+            fetcher.max_bytes = len(image) - 1
+            with pytest.raises(ImageTooLargeError):
+                await fetcher.fetch_bytes(f"{base}/tongue.jpg")
+        finally:
+            await fetcher.aclose()
+
+    try:
+        asyncio.run(fetch())
+    finally:
+        redirect.shutdown()
+        redirect.server_close()
+
+
+def test_image_url_policy():
+    policy = ImageUrlPolicy([PREFIX])
+
+    assert policy.check(PREFIX + "originals/abc.jpg") == PREFIX + "originals/abc.jpg"
+    for url in (
+        "http://127.0.0.1:8000/admin",
+        "https://example.com/storage/v1/object/public/analysis-images/x.jpg",
+        PREFIX.replace("https://", "https://user@") + "x.jpg",
+        PREFIX + "../private/x.jpg",
+        PREFIX + "%2e%2e/private/x.jpg",
+        PREFIX.replace("/analysis-images/", "/other-bucket/") + "x.jpg",
+    ):
+        with pytest.raises(ImageUrlNotAllowed):
+            policy.check(url)
+    # No prefixes: local development
+    assert ImageUrlPolicy([]).check("http://localhost/x.jpg") == "http://localhost/x.jpg"
+
+
+def test_lookup_by_url_never_downloads(image_server, monkeypatch):
+    root, base = image_server
+    image = make_image()
+    digest = content_hash(image)
+    cache = MemoryCache()
+    monkeypatch.setattr(backend_main, "result_cache", cache)
+
+    async def lookups():
+        # Nothing is served: a lookup that tried to download would fail
+        assert await backend_main.lookup_cached_result(f"{base}/upload.jpg") == (None, None)
+        url = f"{base}/originals/{digest}.jpg"
+        key, result = await backend_main.lookup_cached_result(url)
+        assert result is None
+        cache.set(key, RESULT)
+        assert await backend_main.lookup_cached_result(url) == (key, RESULT)
+        # Same key as the uploaded bytes
+        assert await backend_main.lookup_cached_result(None, image) == (key, RESULT)
+
+    asyncio.run(lookups())
+
+
+def test_analyze_rejects_urls_outside_the_bucket(monkeypatch):
+    monkeypatch.setattr(backend_main, "image_urls", ImageUrlPolicy([PREFIX]))
+    client = TestClient(backend_main.app)
+
+    response = client.post("/analyze", json={"image_url": "http://169.254.169.254/latest/meta-data/"})
+    assert response.status_code == 422
+    response = client.post("/jobs", json={"image_url": "http://localhost:5432/"})
+    assert response.status_code == 422
@@ -0,0 +1,211 @@
+import asyncio
+import json
+import types
+
+import pytest
+
+import modal_ai.features as features
+import modal_ai.main as service
+import modal_ai.routing as routing
+from backend.analysis_core import mock_analysis
+from backend.result_cache import cache_key
+from modal_ai.routing import GEMINI, LOCAL, LiveStats, ModelBackend, ModelRouter
+from modal_ai.upstream import CLOSED
+from tests.images import make_tongue
+
+FALLBACK = "gemini-2.0-flash-lite"
+
+
+def backend(name, cost=0.0, kind=GEMINI) -> ModelBackend:
+    return ModelBackend(name, kind, f"{name}-v1", cost=cost, stats=LiveStats(60))
+
+
+def record(b: ModelBackend, seconds: float, ok: bool, times: int = 5) -> None:
+    for _ in range(times):
+        b.stats.record(seconds, ok)
+
+
+def open_circuit(b: ModelBackend) -> None:
+    b.upstream = types.SimpleNamespace(breaker=types.SimpleNamespace(is_open=lambda: True))
+
+
+def test_primary_is_chosen_when_healthy():
+    routed = []
+    primary, fallback = backend("a"), backend("b")
+    router = ModelRouter([primary, fallback], latency_slo=2, on_route=lambda *args: routed.append(args))
+
+    assert router.choose() == (primary, "primary")
+    assert routed == [("a", "primary")]
+
+
+def test_open_circuit_skips_to_the_next_backend():
+    primary, fallback = backend("a"), backend("b")
+    open_circuit(primary)
+    assert ModelRouter([primary, fallback]).choose() == (fallback, "circuit_open")
+
+
+def test_slow_and_failing_backends_are_skipped():
+    primary, fallback = backend("a"), backend("b")
+    record(primary, 3.0, True)
+    assert ModelRouter([primary, fallback], latency_slo=2).choose() == (fallback, "slow")
+
+    primary, fallback = backend("a"), backend("b")
+    record(primary, 0.1, False)
+    assert ModelRouter([primary, fallback], max_error_rate=0.5).choose() == (fallback, "errors")
+
+
+def test_stats_need_min_calls():
+    primary, fallback = backend("a"), backend("b")
+    record(primary, 3.0, False, times=4)
+    assert ModelRouter([primary, fallback], latency_slo=2, max_error_rate=0.5).choose() == (primary, "primary")
+
+
+def test_budget_moves_to_cheaper_backends():
+    primary, cheap = backend("a", cost=1.0), backend("b", cost=0.4)
+    router = ModelRouter([primary, cheap], budget=2.5)
+
+    assert [router.choose() for _ in range(3)] == [(primary, "primary"), (primary, "primary"), (cheap, "budget")]
+    assert router.snapshot()["spent"] == 2.4
+
+
+def test_soft_skips_fall_back_to_the_first_soft_backend():
+    primary, fallback = backend("a"), backend("b")
+    record(primary, 3.0, True)
+    open_circuit(fallback)
+    assert ModelRouter([primary, fallback], latency_slo=2).choose() == (primary, "fallback_soft")
+
+
+def test_nothing_available():
+    routed = []
+    primary = backend("a")
+    open_circuit(primary)
+    router = ModelRouter([primary], on_route=lambda *args: routed.append(args))
+
+    assert router.choose() == (None, "circuit_open")
+    assert routed == [("none", "circuit_open")]
+
+
+def test_shadow_sampling(monkeypatch):
+    primary, shadow = backend("a"), backend("s", cost=0.5)
+    router = ModelRouter([primary], shadow=shadow, shadow_rate=0.25, budget=10)
+
+    monkeypatch.setattr(routing.random, "random", lambda: 0.2)
+    assert router.shadow_for(primary) is shadow
+    assert router.snapshot()["spent"] == 0.5
+    # Never shadow a backend with itself
+    assert router.shadow_for(shadow) is None
+
+    monkeypatch.setattr(routing.random, "random", lambda: 0.3)
+    assert router.shadow_for(primary) is None
+
+
+def test_shadow_skipped_when_unavailable(monkeypatch):
+    monkeypatch.setattr(routing.random, "random", lambda: 0.0)
+    primary, shadow = backend("a", cost=1.0), backend("s", cost=1.0)
+
+    router = ModelRouter([primary], shadow=shadow, shadow_rate=1.0, budget=1.5)
+    router.choose()
+    assert router.shadow_for(primary) is None
+
+    open_circuit(shadow)
+    assert ModelRouter([primary], shadow=shadow, shadow_rate=1.0).shadow_for(primary) is None
+
+
+def test_parse_route():
+    assert routing.parse_route("a, b:0.5,local") == [("a", None), ("b", 0.5), (LOCAL, None)]
+
+
+# -- Router + result cache in TongueAnalyzer ----------------------------------
+
+
+class FakeGemini:
+    def __init__(self):
+        self.calls = 0
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        self.calls += 1
+        result = mock_analysis()
+        result.pop("recommendation")
+        return types.SimpleNamespace(text=json.dumps(result))
+
+
+@pytest.fixture
+def analyzer(monkeypatch):
+    """The plain TongueAnalyzer class routed to two fake Gemini models."""
+    monkeypatch.delenv("GEMINI_API_KEY", raising=False)
+    monkeypatch.delenv("ANALYSIS_LOG_DSN", raising=False)
+    monkeypatch.delenv("CATALOG_DSN", raising=False)
+    monkeypatch.setenv("RESULT_CACHE", "memory")
+    monkeypatch.setattr(features, "MIN_SHARPNESS", 0)
+    monkeypatch.setattr(service, "SHADOW_MODEL", "")
+
+    cls = service.TongueAnalyzer._get_user_cls()
+
+    def raw(name):
+        return getattr(cls, name)._get_raw_f()
+
+    analyzer = cls()
+    raw("load_model")(analyzer)
+    analyzer.log_writer = None
+    analyzer.catalog = service.catalog_from_env()
+    backends = []
+    for name in (service.MODEL_NAME, FALLBACK):
+        b = analyzer._backend(name, None, "test-key")
+        b.model = FakeGemini()
+        backends.append(b)
+    analyzer.router.backends = backends
+    return analyzer
+
+
+def analyze(analyzer, image: bytes) -> dict:
+    async def go():
+        await analyzer.catalog.start()
+        try:
+            return await analyzer._analyze_one(None, None, image)
+        finally:
+            await analyzer.catalog.stop()
+    outcome = asyncio.run(go())
+    assert outcome["success"], outcome
+    return outcome["data"]
+
+
+def test_primary_results_are_cached(analyzer):
+    primary = analyzer.router.backends[0]
+    image = make_tongue(1)
+
+    first = analyze(analyzer, image)
+    second = analyze(analyzer, image)
+
+    assert first["cached"] is False and first["model"] == service.MODEL_NAME
+    assert second["cached"] is True and second["model"] == service.MODEL_NAME
+    assert primary.model.calls == 1
+
+
+def test_fallback_results_are_not_cached(analyzer):
+    primary, fallback = analyzer.router.backends
+    image = make_tongue(2)
+
+    primary.upstream.breaker._open()
+    result = analyze(analyzer, image)
+    assert result["model"] == FALLBACK
+    assert analyzer.cache.get(cache_key(image, service.CACHE_VERSION)) is None
+
+    # Once the primary recovers, the same image goes to the primary model
+    primary.upstream.breaker._transition(CLOSED)
+    result = analyze(analyzer, image)
+    assert result["cached"] is False and result["model"] == service.MODEL_NAME
+    assert (primary.model.calls, fallback.model.calls) == (1, 1)
+
+
+def test_non_primary_entries_are_not_served_as_hits(analyzer):
+    primary = analyzer.router.backends[0]
+    image = make_tongue(3)
+    key = cache_key(image, service.CACHE_VERSION)
+    stale = {**mock_analysis(), "model": FALLBACK}
+    analyzer.cache.set(key, stale)
+
+    result = analyze(analyzer, image)
+
+    assert result["cached"] is False and result["model"] == service.MODEL_NAME
+    assert primary.model.calls == 1
+    assert analyzer.cache.get(key)["model"] == service.MODEL_NAME
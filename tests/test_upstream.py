@@ -0,0 +1,324 @@
+import asyncio
+import types
+
+import pytest
+
+import modal_ai.upstream as upstream
+from modal_ai.upstream import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    Coalescer,
+    TokenBucket,
+    UpstreamBusyError,
+    UpstreamGuard,
+)
+
+
+class UpstreamError(Exception):
+    """Shaped like a google.api_core error: carries the HTTP status as code."""
+
+    def __init__(self, code: int):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class Flaky:
+    """Fails with the given status codes in turn, then returns "ok"."""
+
+    def __init__(self, *codes: int):
+        self.codes = list(codes)
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        if self.codes:
+            raise UpstreamError(self.codes.pop(0))
+        return "ok"
+
+
+def guard(events=None, **kwargs) -> UpstreamGuard:
+    kwargs.setdefault("backoff_base", 0.001)
+    return UpstreamGuard(on_event=(events.append if events is not None else None), **kwargs)
+
+
+def in_seconds(seconds: float) -> float:
+    return asyncio.get_running_loop().time() + seconds
+
+
+@pytest.fixture
+def longest_backoff(monkeypatch):
+    """Full jitter always picks the top of the range, so backoff is deterministic."""
+    monkeypatch.setattr(upstream.random, "uniform", lambda low, high: high)
+
+
+def test_bucket_allows_a_burst_then_paces():
+    async def go():
+        bucket = TokenBucket(rate=20, burst=3)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for _ in range(3):
+            await bucket.acquire(in_seconds(1))
+        burst = loop.time() - started
+        await bucket.acquire(in_seconds(1))
+        return burst, loop.time() - started
+
+    burst, paced = asyncio.run(go())
+    assert burst < 0.02
+    assert paced >= 0.04
+
+
+def test_bucket_rejects_when_the_wait_passes_the_deadline():
+    async def go():
+        bucket = TokenBucket(rate=1, burst=1)
+        await bucket.acquire(in_seconds(1))
+        with pytest.raises(UpstreamBusyError) as excinfo:
+            await bucket.acquire(in_seconds(0.1))
+        return excinfo.value
+
+    assert asyncio.run(go()).retry_after == 1
+
+
+def test_retryable_errors_are_retried():
+    events = []
+    fn = Flaky(429, 503)
+
+    async def go():
+        return await guard(events).call(fn, in_seconds(5))
+
+    assert asyncio.run(go()) == "ok"
+    assert fn.calls == 3
+    assert events == ["retry", "retry"]
+
+
+def test_client_errors_are_not_retried():
+    fn = Flaky(400)
+
+    async def go():
+        await guard().call(fn, in_seconds(5))
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(go())
+    assert fn.calls == 1
+
+
+def test_retries_stop_at_max_retries():
+    fn = Flaky(503, 503, 503)
+
+    async def go():
+        await guard(max_retries=2).call(fn, in_seconds(5))
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(go())
+    assert fn.calls == 3
+
+
+def test_no_retry_past_the_deadline(longest_backoff):
+    events = []
+    fn = Flaky(503)
+
+    async def go():
+        await guard(events, backoff_base=1).call(fn, in_seconds(0.2))
+
+    with pytest.raises(UpstreamBusyError):
+        asyncio.run(go())
+    assert fn.calls == 1
+    assert events == []
+
+
+def test_slow_attempt_is_cut_at_the_deadline():
+    async def hang():
+        await asyncio.sleep(10)
+
+    async def go():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        with pytest.raises(TimeoutError):
+            await guard(max_retries=0).call(hang, in_seconds(0.05))
+        return loop.time() - started
+
+    assert asyncio.run(go()) < 1
+
+
+def test_slot_limits_concurrency():
+    events = []
+
+    async def go():
+        g = guard(events, max_concurrency=1)
+        async with g.slot(in_seconds(1)):
+            with pytest.raises(UpstreamBusyError):
+                async with g.slot(in_seconds(0.05)):
+                    pass
+        # Released again once the first holder leaves
+        async with g.slot(in_seconds(0.05)):
+            pass
+
+    asyncio.run(go())
+    assert events == ["concurrency_limited"]
+
+
+def test_coalescer_shares_one_result():
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"score": 80}
+
+    async def analyze(coalescer):
+        future = coalescer.get("key")
+        if future is not None:
+            return await asyncio.shield(future)
+        with coalescer.lead("key") as future:
+            result = await compute()
+            future.set_result(result)
+            return result
+
+    async def go():
+        coalescer = Coalescer()
+        results = await asyncio.gather(*(analyze(coalescer) for _ in range(5)))
+        return results, coalescer.get("key")
+
+    results, leftover = asyncio.run(go())
+    assert calls == 1
+    assert all(result == {"score": 80} for result in results)
+    assert leftover is None
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(upstream, "time", types.SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def breaker(transitions=None, **kwargs) -> CircuitBreaker:
+    kwargs = {"window": 60, "min_calls": 4, "error_rate": 0.5, "slow_call": 5, "slow_rate": 0.5, "cooldown": 30, **kwargs}
+    return CircuitBreaker(on_transition=(transitions.append if transitions is not None else None), **kwargs)
+
+
+def record(b: CircuitBreaker, *outcomes) -> None:
+    for ok, seconds in outcomes:
+        assert b.allow()
+        b.record(ok, seconds)
+
+
+def test_breaker_opens_on_error_rate(clock):
+    transitions = []
+    b = breaker(transitions)
+
+    record(b, (True, 1), (False, 1), (True, 1))
+    assert b.state == CLOSED
+    record(b, (False, 1))
+
+    assert b.state == OPEN
+    assert transitions == [OPEN]
+    assert b.is_open() and not b.allow()
+    assert b.retry_after() == 30
+
+
+def test_breaker_opens_on_slow_calls(clock):
+    b = breaker()
+    record(b, (True, 1), (True, 6), (True, 1), (True, 7))
+    assert b.state == OPEN
+
+
+def test_breaker_needs_min_calls(clock):
+    b = breaker()
+    record(b, (False, 1), (False, 1), (False, 1))
+    assert b.state == CLOSED
+
+
+def test_old_failures_leave_the_window(clock):
+    b = breaker()
+    record(b, (False, 1), (False, 1), (False, 1))
+    clock.now += 61
+    record(b, (True, 1), (True, 1), (True, 1), (False, 1))
+    assert b.state == CLOSED
+
+
+def test_client_errors_do_not_count(clock):
+    b = breaker()
+    for _ in range(6):
+        assert b.allow()
+        b.record(None)
+    assert b.snapshot()["calls"] == 0
+
+
+def test_half_open_probe_success_closes(clock):
+    transitions = []
+    b = breaker(transitions)
+    record(b, *[(False, 1)] * 4)
+
+    clock.now += 30
+    assert b.allow()
+    assert b.state == HALF_OPEN
+    # Only one probe at a time
+    assert not b.allow()
+    b.record(True, 1)
+
+    assert b.state == CLOSED
+    assert transitions == [OPEN, HALF_OPEN, CLOSED]
+    assert b.snapshot()["calls"] == 0
+
+
+def test_half_open_probe_failure_reopens(clock):
+    transitions = []
+    b = breaker(transitions)
+    record(b, *[(False, 1)] * 4)
+
+    clock.now += 30
+    record(b, (False, 1))
+
+    assert b.state == OPEN
+    assert transitions == [OPEN, HALF_OPEN, OPEN]
+    # The cooldown starts again from the failed probe
+    clock.now += 29
+    assert not b.allow()
+
+
+def test_slow_probe_reopens(clock):
+    b = breaker()
+    record(b, *[(False, 1)] * 4)
+    clock.now += 30
+    record(b, (True, 6))
+    assert b.state == OPEN
+
+
+def test_guard_fails_fast_while_open(clock):
+    events = []
+    fn = Flaky()
+    g = guard(events, breaker=breaker(min_calls=1))
+    g.breaker.allow()
+    g.breaker.record(False, 1)
+
+    async def go():
+        with pytest.raises(CircuitOpenError) as excinfo:
+            await g.call(fn, in_seconds(5))
+        return excinfo.value
+
+    assert asyncio.run(go()).retry_after == 30
+    assert fn.calls == 0
+    assert events == ["circuit_open"]
+
+
+def test_guard_records_attempts_in_the_breaker(clock):
+    g = guard(breaker=breaker(min_calls=2), max_retries=1)
+
+    async def go():
+        with pytest.raises(UpstreamError):
+            await g.call(Flaky(503, 503), in_seconds(5))
+
+    asyncio.run(go())
+    assert g.breaker.state == OPEN